@@ -32,16 +32,23 @@ from urllib2 import Request, urlopen, HTTPError, URLError
 from urllib import quote
 from urlparse import urlparse
 from tempfile import NamedTemporaryFile
+from StringIO import StringIO
+from collections import deque
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
 from tarfile import TarFile, TarInfo
-import os, tarfile, shutil, os.path
+import os, tarfile, shutil, os.path, time
 
 from django.conf import settings
 from django.db import transaction
 from django.contrib.auth.models import User
 
+from tardis.tardis_portal.accesslog import record_access
 from tardis.tardis_portal.metsexporter import MetsExporter
+from tardis.tardis_portal.transfer import TransferError
 
-from tardis.apps.migration import MigrationError
+from tardis.apps.migration import MigrationError, ArchivingError
+from tardis.apps.migration.compression import ParallelGzipFile
 from tardis.apps.migration.models import Archive
 from tardis.tardis_portal.models import \
     Experiment, Dataset, Dataset_File, Replica, Location
@@ -50,40 +57,126 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-def create_experiment_archive(exp, outfile):
+# Remote files up to this size are read into memory by the fetch threads;
+# larger ones are streamed into the archive when their turn comes.
+PREFETCH_SIZE = 8 * 1024 * 1024
+
+def create_experiment_archive(exp, outfile, fetch_threads=None,
+                              compress_threads=None):
     """Create an experiment archive for 'exp' writing it to the 
     file object given by 'outfile'.  The archive is in tar/gzip
     format, and contains a METs manifest and the data files for
     all Datasets currently in the Experiment.
 
+    The data files are streamed into the archive from their preferred
+    verified Replicas.  Up to 'fetch_threads' files are opened (and small
+    remote files read) ahead of the one being archived, and the archive
+    is compressed on 'compress_threads' threads.  These default to the
+    ARCHIVE_FETCH_THREADS and ARCHIVE_COMPRESSION_THREADS settings.
+
     On completion, 'outfile' is closed.
     """
+    if fetch_threads is None:
+        fetch_threads = getattr(settings, 'ARCHIVE_FETCH_THREADS', 4)
+    if compress_threads is None:
+        compress_threads = getattr(settings, 'ARCHIVE_COMPRESSION_THREADS', 4)
     with NamedTemporaryFile() as manifest:
-        tf = tarfile.open(mode='w:gz', fileobj=outfile)
         MetsExporter().export_to_file(exp, manifest)
         manifest.flush()
+        gz = ParallelGzipFile(outfile, threads=compress_threads)
+        tf = tarfile.open(mode='w|', fileobj=gz)
         # (Note to self: path creation by string bashing is correct
         # here because these are not 'os' paths.  They are paths in 
         # the namespace of a TAR file, and '/' is always the separator.)
         tf.add(manifest.name, arcname=('%s/Manifest' % exp.id))
-        for datafile in exp.get_datafiles():
-            replica = datafile.get_preferred_replica(verified=True)
-            try:
-                fdst = NamedTemporaryFile(prefix='mytardis_tmp_ar_')
-                f = datafile.get_file()
-                shutil.copyfileobj(f, fdst)
-                fdst.flush()
-                arcname = '%s/%s/%s' % (exp.id, datafile.dataset.id,
-                                        datafile.filename)
-                tf.add(fdst.name, arcname=arcname)
-            except URLError:
-                logger.warn("Unable to fetch %s for archive creation." % 
-                            datafile.filename)
-            finally:
-                fdst.close()
-                f.close()
+        archived = []
+        for datafile, f, size in _fetch_datafiles(exp, fetch_threads):
+            if f is None:
+                continue
+            with closing(f):
+                info = TarInfo('%s/%s/%s' % (exp.id, datafile.dataset_id,
+                                             datafile.filename))
+                info.size = size
+                info.mtime = time.time()
+                info.mode = 0644
+                try:
+                    tf.addfile(info, f)
+                except (IOError, URLError, TransferError) as e:
+                    # Part of the file is in the archive already
+                    raise ArchivingError(
+                        "Unable to read %s for archive creation: %s" %
+                        (datafile.filename, e))
+                archived.append(datafile.id)
         tf.close()
+        gz.close()
         outfile.close()
+    record_access(archived)
+
+def _fetch_datafiles(exp, threads):
+    """Yield (datafile, file, size) for each of the Experiment's Datafiles
+    that has a verified Replica, in order, opening the files (and reading
+    small remote ones) on a pool of threads.  'file' is None if the file
+    couldn't be fetched.
+    """
+    replicas = {}
+    for replica in Replica.objects.filter(datafile__dataset__experiments=exp,
+                                          verified=True) \
+                                  .select_related('datafile', 'location') \
+                                  .order_by('datafile__id'):
+        best = replicas.get(replica.datafile_id)
+        if not best or best.location.get_priority() < \
+                replica.location.get_priority():
+            replicas[replica.datafile_id] = replica
+    replicas = [replicas[id] for id in sorted(replicas)]
+    # Share one Location (and transfer provider) between the replicas at
+    # each, and build the providers here: that needs the database, which
+    # the fetch threads don't use.
+    locations = {}
+    for replica in replicas:
+        if replica.location_id not in locations:
+            locations[replica.location_id] = replica.location
+            replica.location.provider
+        replica.location = locations[replica.location_id]
+    if not threads:
+        for replica in replicas:
+            yield _open_replica(replica)
+        return
+    pool = ThreadPool(threads)
+    try:
+        pending = deque()
+        for replica in replicas:
+            pending.append(pool.apply_async(_open_replica, (replica,)))
+            if len(pending) > threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+        pool.join()
+
+def _open_replica(replica):
+    """Open a replica for archiving, returning (datafile, file, size).
+    Remote files that are small enough are read into memory, and files
+    whose size isn't recorded are spooled to find it.
+    """
+    datafile = replica.datafile
+    try:
+        f = replica.get_file()
+        size = datafile.size_bytes
+        if size is None or (size <= PREFETCH_SIZE and
+                            not replica.is_local()):
+            with closing(f):
+                spool = NamedTemporaryFile(prefix='mytardis_tmp_ar_') \
+                    if size is None else StringIO()
+                shutil.copyfileobj(f, spool)
+                size = spool.tell()
+                spool.seek(0)
+                f = spool
+        return (datafile, f, size)
+    except (IOError, URLError, TransferError) as e:
+        logger.warn("Unable to fetch %s for archive creation: %s" %
+                    (datafile.filename, e))
+        return (datafile, None, None)
 
 def remove_experiment(exp):
     """Completely remove an Experiment, together with any Datasets,
@@ -109,29 +202,35 @@ def remove_experiment_data(exp, archive_url, archive_location):
     offline replicas whose 'url' consists of the archive_url, with the 
     archive pathname for the datafile as a url fragment id.
     """
-    for ds in Dataset.objects.filter(experiments=exp):
-        if ds.experiments.count() == 1:
-            for df in Dataset_File.objects.filter(dataset=ds):
-                replicas = Replica.objects.filter(datafile=df, 
-                                                  location__type='online')
-                if replicas.count() > 0:
-                    for replica in replicas:
-                        location = Location.get_location(replica.location.name)
-                        location.provider.remove_file(replica)
-                        if archive_url:
-                            old_replica = replicas[0]
-                            path_in_archive = '%s/%s/%s' % (
-                                exp.id, ds.id, df.filename)
-                            new_replica_url = '%s#%s' % (
-                                archive_url, quote(path_in_archive))
-                            new_replica = Replica(datafile=old_replica.datafile,
-                                                  url=new_replica_url,
-                                                  protocol=old_replica.protocol,
-                                                  verified=True,
-                                                  stay_remote=False,
-                                                  location=archive_location)
-                            new_replica.save()
-                    replicas.delete()
+    from django.db.models import Count
+    # (Annotating before filtering counts all of each Dataset's Experiments)
+    datasets = Dataset.objects.annotate(nos_experiments=Count('experiments')) \
+                              .filter(experiments=exp, nos_experiments=1)
+    replicas = Replica.objects.filter(datafile__dataset__in=list(datasets),
+                                      location__type='online') \
+                              .select_related('datafile', 'location')
+    providers = {}
+    removed = []
+    new_replicas = {}
+    for replica in replicas:
+        if replica.location_id not in providers:
+            providers[replica.location_id] = replica.location.provider
+        providers[replica.location_id].remove_file(replica)
+        removed.append(replica.id)
+        df = replica.datafile
+        if archive_url and df.id not in new_replicas:
+            path_in_archive = '%s/%s/%s' % (exp.id, df.dataset_id, 
+                                            df.filename)
+            new_replica_url = '%s#%s' % (archive_url, quote(path_in_archive))
+            new_replicas[df.id] = Replica(datafile=df,
+                                          url=new_replica_url,
+                                          protocol=replica.protocol,
+                                          verified=True,
+                                          stay_remote=False,
+                                          location=archive_location)
+    Replica.objects.bulk_create(new_replicas.values())
+    for i in range(0, len(removed), 500):
+        Replica.objects.filter(id__in=removed[i:i + 500]).delete()
                             
 def create_archive_record(exp, url):
     """Create an Archive for an archive of the 'exp' Experiment.  The
@@ -0,0 +1,136 @@
+#
+# Copyright (c) 2012, Centre for Microscopy and Microanalysis
+#   (University of Queensland, Australia)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the University of Queensland nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+Gzip compression on several threads.
+
+:py:class:`ParallelGzipFile` works like pigz: the data is cut into blocks,
+each block is deflated independently on a thread pool (zlib releases the
+GIL while it compresses), and the compressed blocks are written out in order
+as a single gzip member that any gzip reader can decompress.
+"""
+
+import struct
+import time
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# The amount of uncompressed data deflated in each block
+BLOCK_SIZE = 128 * 1024
+
+
+def _deflate(block, level, last):
+    """ Deflate a block as a raw deflate stream.  All but the last block end
+    with a sync flush, which byte-aligns the output without marking it as
+    the end of the stream, so the blocks can simply be concatenated. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + \
+        compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(object):
+    """
+    A write-only file object that gzip-compresses what is written to it onto
+    'fileobj'.  Closing it writes the gzip trailer, but (like
+    :py:class:`gzip.GzipFile`) doesn't close 'fileobj'.
+
+    :param threads: the number of blocks to compress at once.  With 0 or 1,
+        blocks are compressed in the writing thread.
+    :param level: the zlib compression level
+    :param block_size: the uncompressed size of each block
+    """
+
+    def __init__(self, fileobj, threads=4, level=6, block_size=BLOCK_SIZE,
+                 mtime=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads
+        self.closed = False
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        # Compressed blocks still being worked on, in order
+        self._pending = deque()
+        self._buffer = []
+        self._buffered = 0
+        self._crc = zlib.crc32('')
+        self._size = 0
+        if mtime is None:
+            mtime = time.time()
+        # Magic, method (deflate), flags (none), mtime, extra flags, OS
+        self.fileobj.write('\037\213\010\000' +
+                           struct.pack('<L', long(mtime) & 0xffffffffL) +
+                           '\000\377')
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write() on closed ParallelGzipFile')
+        data = str(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            data = ''.join(self._buffer)
+            end = len(data) - len(data) % self.block_size
+            for start in range(0, end, self.block_size):
+                self._submit(data[start:start + self.block_size], False)
+            self._buffer = [data[end:]]
+            self._buffered = len(data) - end
+
+    def flush(self):
+        # Blocks are only written once they are full
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self._submit(''.join(self._buffer), True)
+        self._buffer = []
+        self._drain(0)
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+        self.fileobj.write(struct.pack('<LL', self._crc & 0xffffffffL,
+                                       self._size & 0xffffffffL))
+        self.closed = True
+
+    def _submit(self, block, last):
+        if not self._pool:
+            self.fileobj.write(_deflate(block, self.level, last))
+            return
+        self._pending.append(self._pool.apply_async(
+                _deflate, (block, self.level, last)))
+        # Bound the memory used by blocks that are waiting to be written
+        self._drain(2 * self.threads)
+
+    def _drain(self, limit):
+        while len(self._pending) > limit:
+            self.fileobj.write(self._pending.popleft().get())
@@ -0,0 +1,195 @@
+#
+# Copyright (c) 2012, Centre for Microscopy and Microanalysis
+#   (University of Queensland, Australia)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the University of Queensland nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""
+Migrates many replicas at once.
+
+The :py:class:`MigrationExecutor` keeps a pool of worker threads for each
+destination Location, so that several files are being copied to each
+destination at a time (and a slow destination doesn't hold up the others).
+Transfers that fail with an I/O or transfer error are retried after a delay that
+doubles with each attempt.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from Queue import Queue, Empty
+
+from django.db import connection
+
+from tardis.tardis_portal.transfer import TransferError
+from tardis.tardis_portal.verification import Progress
+
+from tardis.apps.migration import MigrationError
+from tardis.apps.migration.migration import migrate_replica_by_id
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MigrationResult(namedtuple('MigrationResult',
+                                 'replica_id datafile_id transferred error '
+                                 'size attempts tag')):
+    """ The outcome of migrating a replica.  'transferred' is the result of
+    migrate_replica, and 'error' the reason it failed (or None). """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class MigrationExecutor(object):
+    """
+    Migrates replicas concurrently.  Replicas are submitted with
+    :py:meth:`submit`, and the results collected with :py:meth:`results`.
+
+    :param workers: the number of replicas to migrate to each destination
+        at once.  With 0, replicas are migrated as they are submitted, in
+        the submitting thread.
+    :param retries: the number of times to retry a transfer that fails
+        with an I/O or transfer error
+    :param backoff: the seconds to wait before the first retry; the wait is
+        doubled for each retry after that
+    :param report: a function to call with progress reports, or None for
+        no reports
+    :param report_interval: the seconds between progress reports
+    """
+
+    def __init__(self, workers=4, retries=3, backoff=5,
+                 report=None, report_interval=60):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.report = report
+        self.report_interval = report_interval
+        self.progress = Progress(0, 0, verb='migrated')
+        # Work queues, by destination Location name
+        self._queues = {}
+        self._threads = []
+        self._done = Queue()
+        self._pending = 0
+
+    def submit(self, replica, location, noRemove=False, mirror=False,
+               tag=None):
+        """
+        Queue a replica to be migrated to the location.  'tag' is passed
+        back in the result.
+        """
+        try:
+            size = long(replica.datafile.size)
+        except (TypeError, ValueError):
+            size = 0
+        job = (replica.id, replica.datafile_id, size, location,
+               noRemove, mirror, tag)
+        self._pending += 1
+        self.progress.total_files += 1
+        self.progress.total_bytes += size
+        if not self.workers:
+            self._done.put(self._migrate(*job))
+            return
+        if location.name not in self._queues:
+            queue = self._queues[location.name] = Queue()
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queues[location.name].put(job)
+
+    def results(self):
+        """
+        Yield the :py:class:`MigrationResult` of each replica submitted
+        (in the order they finish), until all are done.
+        """
+        last_report = time.time()
+        while self._pending:
+            try:
+                result = self._done.get(True, 1)
+            except Empty:
+                result = None
+            if result:
+                self._pending -= 1
+                self.progress.add(result)
+                yield result
+            if self.report and \
+                    time.time() - last_report >= self.report_interval:
+                self.report(str(self.progress))
+                last_report = time.time()
+        if self.report and self.progress.files:
+            self.report(str(self.progress))
+
+    def close(self):
+        """ Stop the worker threads, once they have finished their work. """
+        for queue in self._queues.values():
+            for _ in range(self.workers):
+                queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._queues = {}
+        self._threads = []
+
+    def _work(self, queue):
+        try:
+            for job in iter(queue.get, None):
+                self._done.put(self._migrate(*job))
+        finally:
+            # Each thread has its own database connection
+            connection.close()
+
+    def _migrate(self, replica_id, datafile_id, size, location,
+                 noRemove, mirror, tag):
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                transferred = migrate_replica_by_id(replica_id, location,
+                                                    noRemove=noRemove,
+                                                    mirror=mirror)
+                error = None
+            except MigrationError as e:
+                transferred, error = False, e.args[0]
+            except (EnvironmentError, TransferError) as e:
+                # Network and storage errors, which may well be transient
+                if attempts <= self.retries:
+                    delay = self.backoff * 2 ** (attempts - 1)
+                    logger.warning('Migration of replica %s failed (%s):'
+                                   ' retrying in %s seconds' %
+                                   (replica_id, e, delay))
+                    time.sleep(delay)
+                    continue
+                transferred, error = False, str(e)
+            except Exception as e:
+                logger.exception('Migration of replica %s failed' %
+                                 replica_id)
+                transferred, error = False, str(e)
+            return MigrationResult(replica_id, datafile_id, transferred,
+                                   error, size, attempts, tag)
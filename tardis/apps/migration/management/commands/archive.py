@@ -33,7 +33,6 @@ Management command to migrate datafiles, datasets and experiments
 
 import sys, re, os.path
 from optparse import make_option
-from tempfile import NamedTemporaryFile
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
@@ -41,6 +40,7 @@ from django.utils.log import dictConfig
 
 from tardis.tardis_portal.models import Location, Experiment
 from tardis.tardis_portal.transfer import TransferError
+from tardis.tardis_portal.transfer.local import ArchiveFile
 
 from tardis.apps.migration import ArchivingError, create_experiment_archive, \
     create_archive_record, remove_experiment, remove_experiment_data
@@ -134,25 +134,27 @@ class Command(BaseCommand):
         if self.dryRun:
             self.stdout.write('Would have archived experiment %s\n' % exp.id)
             return
-        tmp_file = None
         try:
+            # The archive is written straight to its destination
             if self.directory:
+                archive_url = None
                 pathname = os.path.join(self.directory, 
                                         '%s-archive.tar.gz' % exp.id)
+                archive_file = ArchiveFile(pathname)
             else:
-                tmp_file = NamedTemporaryFile(prefix='mytardis_tmp_ar',
-                                              suffix='.tar.gz',
-                                              delete=False)
-                create_experiment_archive(exp, tmp_file)
+                archive_url, archive_file = \
+                    self.location.provider.open_archive(exp)
+            try:
+                create_experiment_archive(exp, archive_file)
+            except:
+                archive_file.discard()
+                raise
             if not self.directory:
-                archive_url = self.location.provider.put_archive(
-                    tmp_file.name, exp)
                 create_archive_record(exp, archive_url)
                 if self.verbosity > 0:
                     self.stdout.write('Archived experiment %s to %s\n' %
                                       (exp.id, archive_url))
             else:
-                archive_url = None
                 if self.verbosity > 0:
                     self.stdout.write('Archived experiment %s to %s\n' %
                                       (exp.id, pathname))
@@ -173,9 +175,6 @@ class Command(BaseCommand):
                 'archive export failed experiment %s : %s\n' % \
                     (exp.id, e.args[0]))
             self.error_count += 1
-        finally:
-            if tmp_file:
-                os.unlink(tmp_file.name)
         
     def _ping(self, location, label):
         if not location.provider.alive():
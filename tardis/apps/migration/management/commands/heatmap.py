@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2013, Centre for Microscopy and Microanalysis
+#   (University of Queensland, Australia)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the University of Queensland nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+"""
+Management command to report how recently the data at each Location has
+been accessed
+"""
+
+from datetime import date, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Sum
+
+from tardis.tardis_portal.models import Location, Replica, DatafileAccess
+
+
+class Command(BaseCommand):
+    args = ''
+    help = """Report the number and total size of the verified replicas at
+each Location, grouped by how long ago their Datafiles were last accessed
+(downloaded, rendered or archived).  With --top, also list the most
+accessed Datafiles at each Location."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('-l', '--location',
+                    action='append',
+                    dest='locations',
+                    default=[],
+                    metavar='LOCATION',
+                    help="Report on the named Location (may be repeated; " \
+                        "the default is all Locations)"),
+        make_option('--days',
+                    dest='days',
+                    default='7,30,90',
+                    help="The numbers of days to group the last accesses " \
+                        "by (default 7,30,90)"),
+        make_option('--top',
+                    type='int',
+                    dest='top',
+                    default=0,
+                    metavar='N',
+                    help="List the N most accessed Datafiles at each " \
+                        "Location over the longest number of days"),
+        )
+
+    def handle(self, *args, **options):
+        try:
+            periods = sorted(set(int(days)
+                                 for days in options['days'].split(',')))
+        except ValueError:
+            raise CommandError('--days must be a comma separated list of ' \
+                                   'numbers of days')
+        if not periods or periods[0] < 1:
+            raise CommandError('--days must be at least 1')
+        locations = Location.objects.order_by('name')
+        if options['locations']:
+            locations = locations.filter(name__in=options['locations'])
+            unknown = set(options['locations']) - \
+                set(location.name for location in locations)
+            if unknown:
+                raise CommandError('Unknown location(s): %s' %
+                                   ', '.join(sorted(unknown)))
+        today = date.today()
+        for location in locations:
+            self._report(location, periods, today, options['top'])
+
+    def _report(self, location, periods, today, top):
+        replicas = Replica.objects.filter(location=location, verified=True)
+        labels = ['under %d days' % periods[0]]
+        labels += ['%d to %d days' % (low, high - 1)
+                   for low, high in zip(periods, periods[1:])]
+        labels += ['%d days or more' % periods[-1], 'never']
+        counts = [0] * len(labels)
+        sizes = [0] * len(labels)
+        rows = replicas.values('datafile', 'datafile__size_bytes') \
+                       .annotate(last=Max('datafile__accesses__date'))
+        for row in rows.iterator():
+            if row['last'] is None:
+                bucket = len(labels) - 1
+            else:
+                days = (today - row['last']).days
+                bucket = len([p for p in periods if p <= days])
+            counts[bucket] += 1
+            sizes[bucket] += row['datafile__size_bytes'] or 0
+
+        self.stdout.write('Location %s (%s): %d files, %d bytes\n' %
+                          (location.name, location.type, sum(counts),
+                           sum(sizes)))
+        for label, count, size in zip(labels, counts, sizes):
+            self.stdout.write('  %-20s %10d files %16d bytes\n' %
+                              (label, count, size))
+        if top > 0:
+            since = today - timedelta(days=periods[-1] - 1)
+            hottest = DatafileAccess.objects \
+                .filter(date__gte=since,
+                        datafile__in=replicas.values('datafile')) \
+                .values('datafile', 'datafile__dataset_id',
+                        'datafile__filename') \
+                .annotate(total=Sum('count')) \
+                .order_by('-total', 'datafile')[:top]
+            self.stdout.write('  Most accessed in the last %d days:\n' %
+                              periods[-1])
+            for row in hottest:
+                self.stdout.write('    %6d  %s/%s (datafile %s)\n' %
+                                  (row['total'], row['datafile__dataset_id'],
+                                   row['datafile__filename'],
+                                   row['datafile']))
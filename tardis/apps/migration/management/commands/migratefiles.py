@@ -42,8 +42,8 @@ from tardis.tardis_portal.util import get_free_space
 from tardis.tardis_portal.models import Replica, Location, Dataset, \
     Dataset_File, Experiment
 
-from tardis.apps.migration import MigrationError, \
-    MigrationScorer, migrate_replica
+from tardis.apps.migration import \
+    MigrationScorer, MigrationExecutor
 from tardis.tardis_portal.logging_middleware import LOGGING
 
 class Command(BaseCommand):
@@ -93,7 +93,25 @@ class Command(BaseCommand):
                     default=False,
                     help='No-remove mode migrates without removing' \
                         ' the actual file corresponding to the' \
-                        ' source replica') 
+                        ' source replica'), 
+        make_option('--workers',
+                    type='int',
+                    dest='workers',
+                    default=getattr(settings, 'MIGRATION_WORKERS', 4),
+                    help='The number of files to transfer at once' \
+                        ' (default %s)' % \
+                        getattr(settings, 'MIGRATION_WORKERS', 4)),
+        make_option('--retries',
+                    type='int',
+                    dest='retries',
+                    default=3,
+                    help='The number of times to retry a transfer that' \
+                        ' fails with an I/O error (default 3)'),
+        make_option('--progress',
+                    action='store_true',
+                    dest='progress',
+                    default=False,
+                    help='Report progress and throughput every minute')
         )
 
     conf = dictConfig(LOGGING)
@@ -131,6 +149,18 @@ class Command(BaseCommand):
             return
         self.transfer_count = 0
         self.error_count = 0
+        self.executor = MigrationExecutor(
+            workers=options.get('workers', 4),
+            retries=options.get('retries', 3),
+            report=self._report if options.get('progress') else None)
+        try:
+            self._run(subcommand, args, all)
+            self._collect()
+        finally:
+            self.executor.close()
+        self._stats()
+
+    def _run(self, subcommand, args, all):
         if subcommand == 'reclaim':
             if not self.source.name == 'local':
                 raise CommandError("Can only 'reclaim' for source 'local'")
@@ -160,7 +190,9 @@ class Command(BaseCommand):
                 raise CommandError("Unknown target: %s" % target)
         else:
             raise CommandError("Unrecognized subcommand: %s" % subcommand)    
-        self._stats()
+
+    def _report(self, progress):
+        self.stdout.write('%s\n' % progress)
 
     def _stats(self):
         if not self.dryRun and self.verbosity > 0:
@@ -216,28 +248,40 @@ class Command(BaseCommand):
             replica = Replica.objects.get(datafile__id=id,
                                           location__id=self.source.id)
             if subcommand == 'migrate':
-                ok = migrate_replica(replica, self.dest,
-                                     noRemove=self.noRemove)
+                self.executor.submit(replica, self.dest,
+                                     noRemove=self.noRemove, tag=subcommand)
             elif subcommand == 'mirror':
-                ok = migrate_replica(replica, self.dest, mirror=True)
-            if self.verbosity > 1:
-                if ok: 
-                    self.stdout.write('%s datafile %s\n' % \
-                                          (self._verb(subcommand), id))
-                elif self.verbosity > 2:
-                    self.stdout.write('Did not %s datafile %s\n' % \
-                                          (subcommand, id))
-            if ok:
-                self.transfer_count += 1
+                self.executor.submit(replica, self.dest, mirror=True,
+                                     tag=subcommand)
         except Replica.DoesNotExist:
             if explicit and self.verbosity > 2:
                 self.stderr.write('No replica of %s exists at %s\n' % \
                                       (id, self.source.name))
-        except MigrationError as e:              
-            self.stderr.write(
-                '%s failed for datafile %s : %s\n' % \
-                    (self._noun(subcommand), id, e.args[0]))
-            self.error_count += 1
+
+    def _collect(self, show_transfers=True):
+        """
+        Wait for the migrations submitted so far, and report how they went.
+        Returns the number of bytes transferred.
+        """
+        transferred = 0
+        for result in self.executor.results():
+            subcommand = result.tag
+            id = result.datafile_id
+            if result.error:
+                self.stderr.write(
+                    '%s failed for datafile %s : %s\n' % \
+                        (self._noun(subcommand), id, result.error))
+                self.error_count += 1
+            elif result.transferred:
+                if show_transfers and self.verbosity > 1:
+                    self.stdout.write('%s datafile %s\n' % \
+                                          (self._verb(subcommand), id))
+                self.transfer_count += 1
+                transferred += result.size
+            elif show_transfers and self.verbosity > 2:
+                self.stdout.write('Did not %s datafile %s\n' % \
+                                      (subcommand, id))
+        return transferred
 
     def _ping(self, location, label):
         if not location.provider.alive():
@@ -346,32 +390,32 @@ class Command(BaseCommand):
     def _do_reclaim(self, required):
         scores = self._do_score_all()
         total = 0
-        for entry in scores:
-            if total >= required:
-                break
-            datafile, replica, _ = entry
-            if self.verbosity > 1:
-                if self.dryRun:
-                    self.stdout.write("Would have migrated %s / %s " \
-                                          "saving %s bytes\n" % \
-                                          (replica.url, datafile.id, 
-                                           datafile.size))
-                else:
-                    self.stdout.write("Migrating %s / %s saving %s bytes\n" % \
-                                          (replica.url, datafile.id, 
-                                           datafile.size))
+        next = 0
+        while total < required and next < len(scores):
+            # Queue enough migrations to make up the shortfall, and then
+            # see how many of them succeed
+            planned = total
+            while planned < required and next < len(scores):
+                datafile, replica, _ = scores[next]
+                next += 1
+                if self.verbosity > 1:
+                    if self.dryRun:
+                        self.stdout.write("Would have migrated %s / %s " \
+                                              "saving %s bytes\n" % \
+                                              (replica.url, datafile.id, 
+                                               datafile.size))
+                    else:
+                        self.stdout.write("Migrating %s / %s saving %s " \
+                                              "bytes\n" % \
+                                              (replica.url, datafile.id, 
+                                               datafile.size))
+                planned += int(datafile.size)
+                if not self.dryRun:
+                    self.executor.submit(replica, self.dest, tag='migrate')
             if self.dryRun:
-                total += int(datafile.size) 
+                total = planned
             else:
-                try:
-                    if migrate_replica(replica, self.dest):
-                        total += int(datafile.size) 
-                        self.transfer_count += 1
-                except MigrationError as e:              
-                    self.stderr.write(
-                        '%s failed for datafile %s : %s\n' % \
-                            (self._noun(subcommand), id, e.args[0]))
-                    self.error_count += 1
+                total += self._collect(show_transfers=False)
         if self.dryRun:
             self.stdout.write("Would have reclaimed %d bytes\n" % total)
         else:
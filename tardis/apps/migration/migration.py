@@ -63,68 +63,110 @@ def migrate_replica(replica, location, noRemove=False, mirror=False):
     effect will be that the datafile will be stored at the new location and 
     removed from the current location, and the datafile metadata will be
     updated to reflect this.
+
+    The file is copied before the replica is locked, and the lock is only
+    held while the new replica is recorded and the old one removed, so a
+    slow transfer doesn't hold a database transaction open.
     """
 
     from tardis.tardis_portal.models import Replica, Location
 
-    with transaction.commit_on_success():
-        replica = Replica.objects.select_for_update().get(pk=replica.pk)
-        source = Location.get_location(replica.location.name)
-        
-        if not replica.verified or location.provider.trust_length:
-            raise MigrationError('Only verified datafiles can be migrated' \
-                                     ' to this destination')
-        
-        filename = replica.get_absolute_filepath()
-        try:
-            newreplica = Replica.objects.get(datafile=replica.datafile,
-                                             location=location)
-            created_replica = False
-            # We've most likely mirrored this file previously.  But if
-            # we are about to delete the source Replica, we need to check
-            # that the target Replica still verifies.
-            if not mirror and not check_file_transferred(newreplica, location):
-                raise MigrationError('Previously mirrored / migrated Replica' \
-                                         ' no longer verifies locally!')
-        except Replica.DoesNotExist:
-            newreplica = Replica()
-            newreplica.location = location
-            newreplica.datafile = replica.datafile
-            newreplica.protocol = ''
-            newreplica.stay_remote = location != Location.get_default_location()
-            newreplica.verified = False
-            url = location.provider.generate_url(newreplica)
-            
-            if newreplica.url == url:
-                # We should get here ...
-                raise MigrationError('Cannot migrate a replica to its' \
-                                         ' current location')
-            newreplica.url = url
-            location.provider.put_file(replica, newreplica) 
-            verified = False
+    replica = Replica.objects.get(pk=replica.pk)
+    source = Location.get_location(replica.location.name)
+    if not replica.verified or location.provider.trust_length:
+        raise MigrationError('Only verified datafiles can be migrated' \
+                                 ' to this destination')
+
+    filename = replica.get_absolute_filepath()
+    newreplica, created_replica = _copy_replica(replica, location, mirror)
+
+    try:
+        with transaction.commit_on_success():
             try:
-                verified = check_file_transferred(newreplica, location)
-            except:
-                # FIXME - should we always do this?
-                location.provider.remove_file(newreplica)
-                raise
-            
-            newreplica.verified = verified
-            newreplica.save()
-            logger.info('Transferred file %s for replica %s' %
-                        (filename, replica.id))
-            created_replica = True
-        
-        if mirror:
-            return created_replica
-
-        # FIXME - do this more reliably ...
-        replica.delete()
-        if not noRemove:
-            source.provider.remove_file(replica)
-            logger.info('Removed local file %s for replica %s' %
-                        (filename, replica.id))
-        return True
+                replica = Replica.objects.select_for_update() \
+                                         .get(pk=replica.pk)
+            except Replica.DoesNotExist:
+                raise MigrationError('Replica was removed while it was being' \
+                                         ' copied')
+            if created_replica:
+                # Concurrent migrations of the replica are serialized by the
+                # lock, so only the first records the new replica.  (Some
+                # providers have already saved this call's replica, unverified,
+                # so it doesn't count.)
+                if Replica.objects.filter(datafile=replica.datafile,
+                                          location=location) \
+                                  .exclude(pk=newreplica.pk).exists():
+                    created_replica = False
+                    if newreplica.pk:
+                        newreplica.delete()
+                else:
+                    newreplica.save()
+                    logger.info('Transferred file %s for replica %s' %
+                                (filename, replica.id))
+
+            if mirror:
+                return created_replica
+
+            replica.delete()
+    except MigrationError:
+        # A concurrent migration has removed the replica, so the copy isn't
+        # needed.  (It is dropped once the transaction has been rolled
+        # back, as some providers have already saved it.)
+        if created_replica and newreplica.pk:
+            newreplica.delete()
+        raise
+
+    # Only remove the file once the change is committed
+    if not noRemove:
+        source.provider.remove_file(replica)
+        logger.info('Removed local file %s for replica %s' %
+                    (filename, replica.id))
+    return True
+
+def _copy_replica(replica, location, mirror):
+    """
+    Copy the replica's file to the location, unless it has already been,
+    and check the copy.  Returns the new replica (unsaved if it was
+    created), and whether it was created.
+    """
+
+    from tardis.tardis_portal.models import Replica, Location
+
+    try:
+        newreplica = Replica.objects.get(datafile=replica.datafile,
+                                         location=location)
+        # We've most likely mirrored this file previously.  But if
+        # we are about to delete the source Replica, we need to check
+        # that the target Replica still verifies.
+        if not mirror and not check_file_transferred(newreplica, location):
+            raise MigrationError('Previously mirrored / migrated Replica' \
+                                     ' no longer verifies locally!')
+        return newreplica, False
+    except Replica.DoesNotExist:
+        newreplica = Replica()
+        newreplica.location = location
+        newreplica.datafile = replica.datafile
+        newreplica.protocol = ''
+        newreplica.stay_remote = location != Location.get_default_location()
+        newreplica.verified = False
+        url = location.provider.generate_url(newreplica)
+
+        if newreplica.url == url:
+            # We should get here ...
+            raise MigrationError('Cannot migrate a replica to its' \
+                                     ' current location')
+        newreplica.url = url
+        location.provider.put_file(replica, newreplica) 
+        verified = False
+        try:
+            verified = check_file_transferred(newreplica, location)
+        except:
+            # FIXME - should we always do this?
+            location.provider.remove_file(newreplica)
+            raise
+
+        newreplica.verified = verified
+        return newreplica, True
 
 def check_file_transferred(replica, location):
     """
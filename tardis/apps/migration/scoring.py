@@ -27,15 +27,22 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
-import math, time, os
+import heapq, math, time, os
+from collections import defaultdict
 
 import logging
 
-from tardis.tardis_portal.models import Replica
+from tardis.tardis_portal.models import Replica, Location
 
 
 logger = logging.getLogger(__name__)
 
+# The number of replicas scored per query
+SCORING_CHUNK_SIZE = 5000
+
+# The number of ids in each "IN" clause (SQLite allows at most 999 parameters)
+ID_CHUNK_SIZE = 500
+
 DEFAULT_PARAMS = {
     'user_priority_weighting': [5.0, 2.0, 1.0, 0.5, 0.2],
     'file_size_threshold': 0,
@@ -43,7 +50,13 @@ DEFAULT_PARAMS = {
     'file_access_threshold': 0,
     'file_access_weighting': 0.0,
     'file_age_threshold': 0,
-    'file_age_weighting': 0.0}
+    'file_age_weighting': 0.0,
+    'file_times': 'access_log'}
+
+def _chunks(ids, size=ID_CHUNK_SIZE):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
 
 class MigrationScorer:
     """
@@ -54,6 +67,10 @@ class MigrationScorer:
 
     A MigrationScorer instance memoizes the score contributions of users
     and experiments and datasets.  It is therefore stateful. 
+
+    The score_datafiles_* methods score a group of Datafiles with a handful
+    of queries per few thousand files, rather than several per file, and
+    can return just the 'limit' highest scoring ones.
     """
 
     def __init__(self, loc_id, params=DEFAULT_PARAMS):
@@ -72,87 +89,236 @@ class MigrationScorer:
         self.file_age_threshold = params['file_age_threshold']
         self.use_file_timestamps = \
             self.file_access_weighting > 0.0 or self.file_age_weighting > 0.0
+        # Where file ages and access times come from: 'access_log' (the
+        # Datafiles' creation times and recorded accesses) or 'filesystem'
+        # (the files' modification and access times)
+        self.use_access_log = \
+            params.get('file_times', 'filesystem') == 'access_log'
     
     def score_datafile(self, datafile):
         return self.datafile_score(datafile) * \
             self.dataset_score(datafile.dataset)
 
-    def score_datafiles_in_dataset(self, dataset):
-        from tardis.tardis_portal.models import Dataset_File
-        ds_score = self.dataset_score(dataset)
-        def score_it(datafile):
-            return ds_score * self.datafile_score(datafile)
-        datafiles = Dataset_File.objects.filter(dataset=dataset)
-        return self._filter_map_sort(datafiles, score_it)
-
-    def score_datafiles_in_experiment(self, experiment):
-        from tardis.tardis_portal.models import Dataset_File
-        def score_it(datafile):
-            ds_score = self.dataset_score(datafile.dataset)
-            return ds_score * self.datafile_score(datafile)
-        datafiles = Dataset_File.objects.\
-            filter(dataset__experiments__id=experiment.id)
-        return self._filter_map_sort(datafiles, score_it)
-
-    def score_all_datafiles(self):
-        from tardis.tardis_portal.models import Dataset_File
-        def score_it(datafile):
-            ds_score = self.dataset_score(datafile.dataset)
-            return ds_score * self.datafile_score(datafile)
-        datafiles = Dataset_File.objects.all()
-        return self._filter_map_sort(datafiles, score_it)
-
-    def _filter_map_sort(self, datafiles, score_it):
-        from tardis.tardis_portal.models import Dataset_File
-        def compare(tpl, tpl2):
-            if tpl[2] != tpl2[2]:
-                return -1 if tpl2[2] - tpl[2] < 0 else +1
+    def score_datafiles_in_dataset(self, dataset, limit=None):
+        return self._score_replicas(limit, datafile__dataset=dataset.id)
+
+    def score_datafiles_in_experiment(self, experiment, limit=None):
+        return self._score_replicas(
+            limit, datafile__dataset__experiments__id=experiment.id)
+
+    def score_all_datafiles(self, limit=None):
+        return self._score_replicas(limit)
+
+    def _score_replicas(self, limit, **filters):
+        """
+        Return a list of (datafile, replica, score) tuples for the Datafiles
+        (selected by 'filters') with a verified Replica at our location,
+        highest score first and then by Datafile id.  If 'limit' is given,
+        only that many of the highest scoring are returned.
+        """
+        def key(entry):
+            score, datafile_id, _ = entry
+            return (score, -datafile_id)
+
+        scored = self._iter_scores(filters)
+        if limit is None:
+            best = sorted(scored, key=key, reverse=True)
+        else:
+            best = heapq.nlargest(limit, scored, key=key)
+        if not best:
+            return []
+        replicas = {}
+        query = Replica.objects.select_related('datafile')
+        for ids in _chunks(replica_id for _, _, replica_id in best):
+            replicas.update(query.in_bulk(ids))
+        return [(replicas[replica_id].datafile, replicas[replica_id], score)
+                for score, _, replica_id in best]
+
+    def _iter_scores(self, filters):
+        """
+        Yield (score, datafile id, replica id) for each verified Replica at
+        our location whose Datafile matches 'filters'.  The replicas are
+        fetched a chunk at a time, as bare values, and the dataset scores
+        for each chunk are computed together.
+        """
+        location = Location.objects.get(id=self.loc_id)
+        replicas = Replica.objects.filter(location=location, verified=True,
+                                          **filters) \
+                                  .order_by('id') \
+                                  .values_list('id', 'datafile_id', 'url',
+                                               'datafile__size',
+                                               'datafile__dataset_id',
+                                               'datafile__created_time')
+        last_id = 0
+        while True:
+            chunk = list(replicas.filter(id__gt=last_id)
+                         [:SCORING_CHUNK_SIZE])
+            if not chunk:
+                return
+            last_id = chunk[-1][0]
+            self._load_dataset_scores(set(row[4] for row in chunk))
+            if self.use_file_timestamps and self.use_access_log:
+                last_accesses = self._get_last_accesses(
+                    [row[1] for row in chunk])
+            for replica_id, datafile_id, url, size, dataset_id, created \
+                    in chunk:
+                if not self.use_file_timestamps:
+                    get_times = None
+                elif self.use_access_log:
+                    get_times = self._access_log_times(
+                        created, last_accesses.get(datafile_id))
+                else:
+                    get_times = self._filesystem_times(
+                        Replica(url=url, location=location)
+                        .get_absolute_filepath)
+                try:
+                    file_score = self._file_score(size, get_times)
+                except Exception as e:
+                    logger.debug('Problem scoring datafile %d: %s' %
+                                 (datafile_id, e))
+                    file_score = 0.0
+                yield (self.dataset_scores[dataset_id] * file_score,
+                       datafile_id, replica_id)
+
+    def _load_dataset_scores(self, dataset_ids):
+        """
+        Compute and memoize the scores of the given Datasets, along with
+        those of their Experiments and the Experiments' owners, using a
+        few queries for the lot.
+        """
+        from django.contrib.contenttypes.models import ContentType
+        from tardis.tardis_portal.models import Dataset, Experiment, \
+            ObjectACL
+        from tardis.apps.migration.models import UserPriority, \
+            DEFAULT_USER_PRIORITY
+        dataset_ids = set(dataset_ids) - set(self.dataset_scores)
+        if not dataset_ids:
+            return
+        links = []
+        for ids in _chunks(dataset_ids):
+            links.extend(Dataset.experiments.through.objects
+                         .filter(dataset__in=ids)
+                         .values_list('dataset_id', 'experiment_id'))
+        experiment_ids = set(exp_id for _, exp_id in links) - \
+            set(self.experiment_scores)
+
+        owners = defaultdict(set)
+        experiment_ct = ContentType.objects.get_for_model(Experiment)
+        for ids in _chunks(experiment_ids):
+            acls = ObjectACL.objects.filter(pluginId='django_user',
+                                            content_type=experiment_ct,
+                                            object_id__in=ids,
+                                            isOwner=True)
+            for exp_id, user_id in acls.values_list('object_id', 'entityId'):
+                owners[exp_id].add(int(user_id))
+
+        user_ids = set().union(*owners.values()) - set(self.user_scores)
+        priorities = {}
+        for ids in _chunks(user_ids):
+            priorities.update(UserPriority.objects.filter(user__in=ids)
+                              .values_list('user_id', 'priority'))
+        for user_id in user_ids:
+            priority = priorities.get(user_id, DEFAULT_USER_PRIORITY)
+            self.user_scores[user_id] = self.user_priority_weighting[priority]
+
+        for exp_id in experiment_ids:
+            self.experiment_scores[exp_id] = \
+                max([self.user_scores[user_id]
+                     for user_id in owners[exp_id]] + [0.0])
+
+        for dataset_id in dataset_ids:
+            self.dataset_scores[dataset_id] = 0.0
+        for dataset_id, exp_id in links:
+            self.dataset_scores[dataset_id] = \
+                max(self.dataset_scores[dataset_id],
+                    self.experiment_scores[exp_id])
+
+    def _get_last_accesses(self, datafile_ids):
+        """
+        Return the date of the last recorded access to each of the Datafiles
+        that have been accessed, by Datafile id.
+        """
+        from django.db.models import Max
+        from tardis.tardis_portal.models import DatafileAccess
+        last_accesses = {}
+        for ids in _chunks(datafile_ids):
+            last_accesses.update(
+                (row['datafile'], row['last'])
+                for row in DatafileAccess.objects.filter(datafile__in=ids)
+                                         .values('datafile')
+                                         .annotate(last=Max('date')))
+        return last_accesses
+
+    def _access_log_times(self, created, last_access):
+        """
+        Return a function giving the (age, access) timestamps of a Datafile
+        created at 'created' and last accessed on 'last_access'.  A file
+        that has never been accessed counts as accessed when it was created,
+        and one with no creation time as new.
+        """
+        def get_times():
+            if created:
+                mtime = time.mktime(created.timetuple())
+            else:
+                mtime = self.now
+            if last_access:
+                atime = time.mktime(last_access.timetuple())
             else:
-                return tpl[0].id - tpl2[0].id
-
-        results = []
-        for datafile in datafiles:
-            try:
-                replica = Replica.objects.get(datafile=datafile,
-                                              location_id=self.loc_id,
-                                              verified=True)
-                results.append((datafile, replica, score_it(datafile)))
-            except Replica.DoesNotExist:
-                pass
-        return sorted(results, compare)
+                atime = mtime
+            return (mtime, atime)
+        return get_times
+
+    def _filesystem_times(self, get_filepath):
+        """
+        Return a function giving the modification and access timestamps of
+        the file at the path returned by 'get_filepath'.
+        """
+        def get_times():
+            # FIXME - these are sensitive to inadvertent "touching" from
+            # outside of MyTardis, and don't work for remote files.  The
+            # 'access_log' file times avoid both problems.
+            stat = os.stat(get_filepath())
+            return (stat.st_mtime, stat.st_atime)
+        return get_times
 
     def datafile_score(self, datafile):
         try:
-            score = self._adjust(math.log10(float(datafile.size)),
-                                 self.file_size_threshold,
-                                 self.file_size_weighting)
-            if self.use_file_timestamps:
-                print 'filepath is %s\n' % datafile.get_absolute_filepath()
-                stat = os.stat(datafile.get_absolute_filepath())
-                # FIXME - it would be better to use creation / access 
-                # times maintained by MyTardis rather that file timestamps.
-                # The former would allow us to deal with remote files.  The
-                # latter is sensitive to inadvertent "touching" from outside
-                # of MyTardis.
-                score += self._adjust(self._days_ago(stat.st_mtime),
-                                      self.file_age_threshold,
-                                      self.file_age_weighting)
-                score += self._adjust(self._days_ago(stat.st_atime),
-                                      self.file_access_threshold,
-                                      self.file_access_weighting)
-                logger.info('Scored datafile %s (%s, %d, %d) as %f',
-                            datafile.id, datafile.size, stat.st_mtime,
-                            stat.st_atime, score)
+            if not self.use_file_timestamps:
+                get_times = None
+            elif self.use_access_log:
+                get_times = self._access_log_times(
+                    datafile.created_time,
+                    self._get_last_accesses([datafile.id]).get(datafile.id))
             else:
-                logger.info('Scored datafile %s (%s) as %f',
-                            datafile.id, datafile.size, score)
-            return score
+                get_times = self._filesystem_times(
+                    datafile.get_absolute_filepath)
+            return self._file_score(datafile.size, get_times)
         except:
             # Size is zero, or file is missing or something else we 
             # can't cope with
             logger.exception('Problem scoring datafile %d' % datafile.id)
             return 0.0
 
+    def _file_score(self, size, get_times):
+        """
+        Score a file on its size and (if they are weighted) its age and
+        access time.  'get_times' returns the (age, access) timestamps; it
+        is only called when they are needed.  Raises an exception for sizes
+        that aren't positive numbers and missing files.
+        """
+        score = self._adjust(math.log10(float(size)),
+                             self.file_size_threshold,
+                             self.file_size_weighting)
+        if self.use_file_timestamps:
+            mtime, atime = get_times()
+            score += self._adjust(self._days_ago(mtime),
+                                  self.file_age_threshold,
+                                  self.file_age_weighting)
+            score += self._adjust(self._days_ago(atime),
+                                  self.file_access_threshold,
+                                  self.file_access_weighting)
+        return score
+
     def _days_ago(self, ts):
         delta = self.now - ts
         if delta < 0:
@@ -32,7 +32,9 @@ from compare import expect
 from nose.tools import ok_, eq_
 
 import logging, base64, os, urllib2, os.path, tarfile
+from gzip import GzipFile
 from tempfile import NamedTemporaryFile
+from StringIO import StringIO
 from urllib2 import HTTPError, URLError, urlopen
 
 from tardis.tardis_portal.models import Dataset_File, Replica, Location
@@ -43,6 +45,7 @@ from tardis.tardis_portal.tests.transfer.generate import \
 
 from tardis.apps.migration import MigrationError, \
     create_experiment_archive, create_archive_record
+from tardis.apps.migration.compression import ParallelGzipFile
 from tardis.apps.migration.models import Archive
 
 class ArchivingTestCase(TestCase):
@@ -86,9 +89,50 @@ class ArchivingTestCase(TestCase):
         finally:
             os.unlink(tmp.name)
 
+    def testArchiveContents(self):
+        contents = ["Hi mum", "Hello father" * 20000]
+        datafiles = [generate_datafile(None, self.dataset, content)[0]
+                     for content in contents]
+        for threads in (0, 3):
+            out = StringIO()
+            out.close = lambda: None
+            create_experiment_archive(self.experiment, out,
+                                      fetch_threads=threads,
+                                      compress_threads=threads)
+            out.seek(0)
+            tf = tarfile.open(fileobj=out, mode='r:gz')
+            names = tf.getnames()
+            self.assertEqual(len(names), 1 + len(contents))
+            for datafile, content in zip(datafiles, contents):
+                name = '%s/%s/%s' % (self.experiment.id, self.dataset.id,
+                                     datafile.filename)
+                self.assertTrue(name in names)
+                self.assertEqual(tf.extractfile(name).read(), content)
+            tf.close()
+
     def testCreateArchiveRecord(self):
         count = Archive.objects.count()
         archive = create_archive_record(self.experiment, 'http://example.com')
         self.assertEqual(Archive.objects.count(), count + 1)
         self.assertEqual(archive.experiment_owner, 'fred')
-        
+
+
+class ParallelGzipFileTestCase(TestCase):
+
+    def testRoundTrip(self):
+        data = os.urandom(100000) + 'x' * 300000
+        for threads in (0, 1, 4):
+            out = StringIO()
+            gz = ParallelGzipFile(out, threads=threads, block_size=65536)
+            for i in range(0, len(data), 10000):
+                gz.write(data[i:i + 10000])
+            gz.close()
+            self.assertTrue(len(out.getvalue()) < len(data))
+            out.seek(0)
+            self.assertEqual(GzipFile(fileobj=out).read(), data)
+
+    def testEmpty(self):
+        out = StringIO()
+        ParallelGzipFile(out).close()
+        out.seek(0)
+        self.assertEqual(GzipFile(fileobj=out).read(), '')
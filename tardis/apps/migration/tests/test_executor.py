@@ -0,0 +1,104 @@
+#
+# Copyright (c) 2012, Centre for Microscopy and Microanalysis
+#   (University of Queensland, Australia)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the  University of Queensland nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+from django.test import TestCase
+
+from tardis.tardis_portal.models import Location
+from tardis.tardis_portal.tests.transfer import SimpleHttpTestServer
+from tardis.tardis_portal.tests.transfer.generate import \
+    generate_datafile, generate_dataset, generate_experiment, generate_user
+
+from tardis.apps.migration import MigrationExecutor, executor
+
+class MigrationExecutorTestCase(TestCase):
+
+    def setUp(self):
+        self.user = generate_user('fred')
+        Location.force_initialize()
+        self.experiment = generate_experiment(users=[self.user])
+        self.dataset = generate_dataset(experiments=[self.experiment])
+        self.server = SimpleHttpTestServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.dataset.delete()
+        self.experiment.delete()
+        self.user.delete()
+        self.server.stop()
+
+    def testMigrate(self):
+        dest = Location.get_location('test')
+        reports = []
+        runner = MigrationExecutor(workers=0, report=reports.append)
+        datafiles = []
+        for content in ('Hi mum', 'Hi dad'):
+            datafile, replica = generate_datafile(None, self.dataset, content)
+            datafiles.append(datafile)
+            runner.submit(replica, dest, tag='migrate')
+        results = list(runner.results())
+        self.assertEquals([(r.datafile_id, r.transferred, r.error, r.size,
+                            r.tag) for r in results],
+                          [(d.id, True, None, 6, 'migrate')
+                           for d in datafiles])
+        for datafile in datafiles:
+            self.assertEquals(datafile.get_preferred_replica().location,
+                              dest)
+        self.assertEquals(runner.progress.files, 2)
+        self.assertEquals(runner.progress.bytes, 12)
+        self.assertEquals(len(reports), 1)
+
+    def testRetry(self):
+        dest = Location.get_location('test')
+        datafile, replica = generate_datafile(None, self.dataset, "Hi mum")
+        failures = [IOError('Connection reset'), IOError('Connection reset')]
+        migrate_replica_by_id = executor.migrate_replica_by_id
+
+        def flaky_migrate(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return migrate_replica_by_id(*args, **kwargs)
+
+        executor.migrate_replica_by_id = flaky_migrate
+        try:
+            runner = MigrationExecutor(workers=0, retries=2, backoff=0)
+            runner.submit(replica, dest)
+            [result] = runner.results()
+            self.assertEquals((result.transferred, result.attempts),
+                              (True, 3))
+
+            # Gives up after the retries
+            datafile, replica = generate_datafile(None, self.dataset, "Hi")
+            failures.extend([IOError('Connection reset')] * 2)
+            runner = MigrationExecutor(workers=0, retries=1, backoff=0)
+            runner.submit(replica, dest)
+            [result] = runner.results()
+            self.assertEquals((result.ok, result.error, result.attempts),
+                              (False, 'Connection reset', 2))
+        finally:
+            executor.migrate_replica_by_id = migrate_replica_by_id
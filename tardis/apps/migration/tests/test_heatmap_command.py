@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2012-2013, Centre for Microscopy and Microanalysis
+#   (University of Queensland, Australia)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the  University of Queensland nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" 
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE 
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE 
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDERS AND CONTRIBUTORS BE 
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR 
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF 
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS 
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN 
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) 
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE 
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+from datetime import date, timedelta
+from StringIO import StringIO
+
+from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from tardis.tardis_portal.models import DatafileAccess, Location
+from tardis.tardis_portal.tests.transfer.generate import \
+    generate_datafile, generate_dataset, generate_experiment, \
+    generate_user
+from tardis.apps.migration.management.commands.heatmap import Command
+
+
+class HeatmapCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.dummy_user = generate_user('joe')
+        Location.force_initialize()
+
+    def tearDown(self):
+        self.dummy_user.delete()
+
+    def testHeatmap(self):
+        dataset = generate_dataset()
+        experiment = generate_experiment([dataset], [self.dummy_user])
+        hot, _ = generate_datafile(None, dataset, "Hi")
+        cool, _ = generate_datafile(None, dataset, "Hello")
+        cold, _ = generate_datafile(None, dataset, "Hey there")
+        today = date.today()
+        DatafileAccess.objects.create(datafile=hot, date=today, count=2)
+        DatafileAccess.objects.create(datafile=hot,
+                                      date=today - timedelta(days=3),
+                                      count=1)
+        DatafileAccess.objects.create(datafile=cool,
+                                      date=today - timedelta(days=40),
+                                      count=5)
+
+        out = StringIO()
+        call_command('heatmap', locations=['local'], days='7,30', top=1,
+                     stdout=out)
+        self.assertEquals(out.getvalue(),
+                          'Location local (online): 3 files, 16 bytes\n'
+                          '  under 7 days                  1 files'
+                          '                2 bytes\n'
+                          '  7 to 29 days                  0 files'
+                          '                0 bytes\n'
+                          '  30 days or more               1 files'
+                          '                5 bytes\n'
+                          '  never                         1 files'
+                          '                9 bytes\n'
+                          '  Most accessed in the last 30 days:\n'
+                          '         3  %s/%s (datafile %s)\n' %
+                          (dataset.id, hot.filename, hot.id))
+
+        # (call_command would exit rather than raise CommandError)
+        command = Command()
+        with self.assertRaises(CommandError):
+            command.handle(locations=['nowhere'], days='7,30', top=0)
+        with self.assertRaises(CommandError):
+            command.handle(locations=[], days='soon', top=0)
@@ -29,6 +29,7 @@
 
 from django.test import TestCase
 from compare import expect
+from flexmock import flexmock
 from nose.tools import ok_, eq_
 
 import logging, base64, os, urllib2
@@ -42,6 +43,7 @@ from tardis.tardis_portal.tests.transfer.generate import \
 
 
 from tardis.apps.migration import MigrationError, migrate_replica
+from tardis.apps.migration import migration
 
 class MigrationTestCase(TestCase):
 
@@ -162,4 +164,24 @@ class MigrationTestCase(TestCase):
         migrate_replica(replica, dest)
         self.assertFalse(os.path.exists(path))
 
-
+    def testReplicaRemovedDuringCopy(self):
+        dest = Location.get_location('test')
+        datafile, replica = generate_datafile(None, self.dataset, "Hi aunty")
+        copy_replica = migration._copy_replica
+
+        def copy_and_remove(*args):
+            # As if the provider saved the new replica, and a concurrent
+            # migration then removed the source
+            newreplica, created = copy_replica(*args)
+            newreplica.save()
+            Replica.objects.filter(pk=replica.pk).delete()
+            return newreplica, created
+
+        flexmock(migration).should_receive('_copy_replica') \
+            .replace_with(copy_and_remove)
+        with self.assertRaises(MigrationError):
+            migrate_replica(replica, dest)
+        # The copy's replica isn't left behind
+        self.assertFalse(Replica.objects.filter(datafile=datafile,
+                                                location__name='test')
+                                        .exists())
@@ -28,6 +28,7 @@
 #
 
 import os, tempfile, time
+from datetime import date, datetime, timedelta
 from StringIO import StringIO
 
 from django.test import TestCase
@@ -38,7 +39,8 @@ from tardis.apps.migration.models import get_user_priority
 
 from tardis.tardis_portal.tests.transfer.generate import \
     generate_datafile, generate_dataset, generate_experiment, generate_user
-from tardis.tardis_portal.models import Replica, Location
+from tardis.tardis_portal.models import Replica, Location, \
+    Dataset_File, DatafileAccess
 
 class MigrateScorerTestCase(TestCase):
 
@@ -131,3 +133,45 @@ class MigrateScorerTestCase(TestCase):
         self.assertEquals(5.0, scorer.datafile_score(self.df1))
 
         f.close()
+
+    def testScoringWithAccessLog(self):
+        self._setup()
+        scorer = MigrationScorer(
+            Location.get_location('local').id, {
+                'user_priority_weighting': [5.0, 2.0, 1.0, 0.5, 0.2],
+                'file_size_weighting': 1.0,
+                'file_access_weighting': 1.0,
+                'file_age_weighting': 1.0,
+                'file_size_threshold': 0,
+                'file_access_threshold': 0,
+                'file_age_threshold': 0,
+                'file_times': 'access_log'})
+        # No creation time counts as new
+        self.assertEquals(2.0, scorer.datafile_score(self.df1))
+
+        created = datetime.now() - timedelta(days=3, seconds=300)
+        Dataset_File.objects.filter(id=self.df1.id) \
+                            .update(created_time=created)
+        df1 = Dataset_File.objects.get(id=self.df1.id)
+        # Never accessed, so last accessed when it was created
+        self.assertEquals(8.0, scorer.datafile_score(df1))
+
+        DatafileAccess.objects.create(datafile=df1, date=date.today(),
+                                      count=1)
+        self.assertEquals(5.0, scorer.datafile_score(df1))
+        self.assertEquals([(self.df1, self.rep1, 10.0)],
+                          scorer.score_datafiles_in_dataset(self.ds1))
+
+    def testTopScores(self):
+        self._setup()
+        scorer = MigrationScorer(Location.get_location('local').id)
+        self.assertEquals([(self.df5, self.rep5, 8.0), 
+                           (self.df4, self.rep4, 6.0), 
+                           (self.df6, self.rep6, 5.0)],
+                          scorer.score_all_datafiles(limit=3))
+        # Ties are broken by datafile id
+        self.assertEquals([(self.df7, self.rep7, 0.0)], 
+                          scorer.score_datafiles_in_dataset(self.ds4,
+                                                            limit=1))
+        self.assertEquals([], scorer.score_datafiles_in_experiment(
+                self.exp1, limit=0))
@@ -1,9 +1,9 @@
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.http import HttpResponse
 from django.template import Context
 
 from tardis.tardis_portal.auth import decorators as authz
 from tardis.tardis_portal.models import Dataset
+from tardis.tardis_portal.pagination import get_keyset_page
 from tardis.tardis_portal.shortcuts import get_experiment_referer
 from tardis.tardis_portal.shortcuts import render_response_index
 
@@ -26,23 +26,10 @@ def view_full_dataset(request, dataset_id):
     dataset = Dataset.objects.get(id=dataset_id)
 
     def get_datafiles_page():
-        # pagination was removed by someone in the interface but not here.
-        # need to fix.
-        pgresults = 100
-
-        paginator = Paginator(dataset.dataset_file_set.all(), pgresults)
-
-        try:
-            page = int(request.GET.get('page', '1'))
-        except ValueError:
-            page = 1
-
-        # If page request (9999) is out of range, deliver last page of results.
-
-        try:
-            return paginator.page(page)
-        except (EmptyPage, InvalidPage):
-            return paginator.page(paginator.num_pages)
+        return get_keyset_page(dataset.dataset_file_set.all(),
+                               ('filename', 'id'),
+                               request.GET.get('cursor'),
+                               100)
 
     display_images = dataset.get_images()
     image_count = len(display_images)
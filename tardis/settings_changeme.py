@@ -44,6 +44,10 @@ BROKER_TRANSPORT = 'django'
 #    }
 #}
 
+# The site statistics (see the stats page) are kept in the cache for this
+# many seconds.  They are reconciled with the database hourly.
+SITE_STATS_CACHE_TIMEOUT = 24 * 60 * 60
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -217,6 +221,10 @@ GROUP_PROVIDERS = (
     'tardis.tardis_portal.auth.token_auth.TokenGroupProvider',
 )
 
+# Group memberships from providers that look them up remotely (e.g. LDAP)
+# are cached for this many seconds.  They are refreshed when a user logs in.
+GROUP_MEMBERSHIP_CACHE_TIMEOUT = 300
+
 # AUTH_PROVIDERS entry format:
 # ('name', 'display name', 'backend implementation')
 #   name - used as the key for the entry
@@ -292,13 +300,40 @@ UPLOADIFY_UPLOAD_PATH = '%s/%s' % (MEDIA_URL, 'uploads')
 # Download size limit: zero means no limit
 DOWNLOAD_ARCHIVE_SIZE_LIMIT = 0
 
-# temporary download file location
-from tempfile import gettempdir
-DOWNLOAD_TEMP_DIR = gettempdir()
+# Let the front-end web server send local files instead of a Django worker:
+# 'x-sendfile' for Apache (mod_xsendfile), 'x-accel-redirect' for nginx,
+# or None to stream the files through Django.
+DOWNLOAD_OFFLOAD = None
 
-# Safety margin for temporary space when downloading.  (Estimated archive
-# file size + safety_margin must be less that available disk space ...)
-DOWNLOAD_SPACE_SAFETY_MARGIN = 8388608
+# For 'x-accel-redirect', map file system paths to nginx 'internal' locations
+#DOWNLOAD_OFFLOAD_LOCATIONS = {
+#    FILE_STORE_PATH: '/protected/store/',
+#}
+
+# Rendered IIIF images (thumbnails etc.) are cached in this directory, which
+# is kept below IIIF_CACHE_SIZE_LIMIT bytes.  Set to None to disable.
+IIIF_CACHE_DIR = path.abspath(path.join(path.dirname(__file__),
+    '../var/iiif_cache/')).replace('\\', '/')
+IIIF_CACHE_SIZE_LIMIT = 1024 * 1024 * 1024
+
+# Renders up to this size are also kept in Django's cache (see CACHES)
+IIIF_SHARED_CACHE_MAX_ITEM_SIZE = 0
+
+# IIIF renders (region, size, rotation, quality, format) that are generated
+# in the background when an image is verified.  These are the thumbnail
+# sizes used by the dataset views and the slideshow.
+IIIF_PREGENERATED_RENDERS = [
+    ('full', '100,', '0', 'native', 'jpg'),
+    ('full', ',28', '0', 'native', 'jpg'),
+    ('full', '!170,170', '0', 'native', 'jpg'),
+    ('full', '!320,240', '0', 'native', 'jpg'),
+]
+
+# Images with a side longer than this are also cut into a pyramid of
+# IIIF_TILE_SIZE square tiles, so regions can be served without decoding
+# the whole image.
+IIIF_TILING_THRESHOLD = 4096
+IIIF_TILE_SIZE = 512
 
 # Disable registration (copy to your settings.py first!)
 # INSTALLED_APPS = filter(lambda x: x != 'registration', INSTALLED_APPS)
@@ -314,6 +349,22 @@ if SINGLE_SEARCH_ENABLED:
 else:
     HAYSTACK_ENABLE_REGISTRATIONS = False
 
+# Index saved datafiles in batches, with the update_search_index task, rather
+# than as part of each save.  Batches are queued SEARCH_INDEX_BATCH_SIZE
+# datafiles at a time (or at the end of each request), and are indexed
+# SEARCH_INDEX_DELAY seconds later.  Datafiles not found by then are queued
+# again, up to SEARCH_INDEX_RETRIES times.
+SEARCH_INDEX_QUEUED = False
+SEARCH_INDEX_BATCH_SIZE = 500
+SEARCH_INDEX_DELAY = 5
+SEARCH_INDEX_RETRIES = 3
+# The number of experiments whose search text is kept in memory by each
+# process, for indexing their datafiles
+SEARCH_INDEX_CACHE_SIZE = 1000
+# How often, in seconds, each process checks for parameters that have been
+# made searchable (or stopped being searchable) elsewhere
+SEARCH_FIELDS_REFRESH_INTERVAL = 60
+
 DEFAULT_INSTITUTION = "Monash University"
 
 #Are the datasets ingested via METS xml (web services) to be immutable?
@@ -356,6 +407,19 @@ CELERYBEAT_SCHEDULE = {
         "task": "tardis_portal.verify_files",
         "schedule": timedelta(seconds=30)
       },
+      "refresh-experiment-access": {
+        "task": "tardis_portal.refresh_experiment_access",
+        "schedule": timedelta(hours=1)
+      },
+      "reconcile-site-stats": {
+        "task": "tardis_portal.reconcile_site_stats",
+        "schedule": timedelta(hours=1)
+      },
+      "audit-fixity": {
+        "task": "tardis_portal.audit_fixity",
+        "schedule": timedelta(hours=1),
+        "kwargs": {"hours": 1}
+      },
     }
 
 djcelery.setup_loader()
@@ -378,8 +442,36 @@ INITIAL_LOCATIONS = [{'name': DEFAULT_LOCATION,
                       'type': 'external',
                       'priority': 5}]
 
+# The most files to read from a Location at once when checking checksums,
+# by Location name, e.g. {'archive': 2}.  Other Locations are unlimited.
+VERIFICATION_LOCATION_LIMITS = {}
+
+# The verify_files task queues at most VERIFY_MAX_QUEUED unverified replicas
+# at once.  A queued replica isn't queued again for VERIFY_LEASE seconds, or
+# until its check finishes; one that fails is retried after
+# VERIFY_RETRY_DELAY seconds.
+VERIFY_MAX_QUEUED = 2000
+VERIFY_LEASE = 3600
+VERIFY_RETRY_DELAY = 300
+
+# The fraction of the stored bytes to re-check against their checksums each
+# day, and how to share that between Location types.  Types not listed
+# aren't audited.
+FIXITY_AUDIT_DAILY_FRACTION = 0.01
+FIXITY_AUDIT_LOCATION_WEIGHTS = {'online': 1}
+
 DEFAULT_MIGRATION_DESTINATION = 'unknown'
+# The number of files that migratefiles transfers at once
+MIGRATION_WORKERS = 4
 DEFAULT_ARCHIVE_LOCATION = 'unknown'
+# Datafile accesses are counted in memory and written in batches, once this
+# many Datafiles have been accessed or this many seconds have passed
+ACCESS_LOG_FLUSH_SIZE = 100
+ACCESS_LOG_FLUSH_INTERVAL = 60
+# The number of files the archive command fetches ahead of the one being
+# archived, and the number of threads compressing each archive
+ARCHIVE_FETCH_THREADS = 4
+ARCHIVE_COMPRESSION_THREADS = 4
 DEFAULT_EXPERIMENT_URL_BASE = None
 
 TRANSFER_PROVIDERS = {
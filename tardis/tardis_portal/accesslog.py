@@ -0,0 +1,135 @@
+"""
+Counts accesses to Datafiles, for deciding which files are "hot" and which
+can be moved to slower storage.
+
+Accesses are counted in memory by :py:func:`record_access`, and added to the
+per-day :py:class:`tardis.tardis_portal.models.DatafileAccess` counters in
+batches: once ACCESS_LOG_FLUSH_SIZE distinct Datafiles have been accessed or
+ACCESS_LOG_FLUSH_INTERVAL seconds have passed since the last batch, and when
+the process exits.
+"""
+
+import atexit
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+
+from tardis.tardis_portal.models import Dataset_File, DatafileAccess
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The number of ids in each "IN" clause (SQLite allows at most 999 parameters)
+ID_CHUNK_SIZE = 500
+
+_lock = threading.Lock()
+# Access counts not yet written, by (datafile id, date)
+_pending = defaultdict(int)
+_last_flush = time.time()
+
+
+def record_access(datafile_ids):
+    """
+    Count an access to each of the Datafiles with the given ids.  Errors
+    writing the counts are logged rather than raised, so that they can't
+    get in the way of the access itself.
+    """
+    today = date.today()
+    with _lock:
+        for datafile_id in datafile_ids:
+            _pending[(datafile_id, today)] += 1
+        due = len(_pending) >= getattr(settings, 'ACCESS_LOG_FLUSH_SIZE',
+                                       100) or \
+            time.time() - _last_flush >= \
+            getattr(settings, 'ACCESS_LOG_FLUSH_INTERVAL', 60)
+    if due:
+        try:
+            flush()
+        except Exception:
+            logger.exception('Unable to record datafile accesses')
+
+
+def flush():
+    """ Write the access counts collected so far. """
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending = _pending, defaultdict(int)
+        _last_flush = time.time()
+    if pending:
+        _write_counts(pending)
+
+
+def _write_counts(pending):
+    if not transaction.is_managed():
+        with transaction.commit_on_success():
+            _update_counters(pending)
+        return
+    # Inside a request's transaction the counts are committed with it, and a
+    # failure to write them is rolled back without spoiling the request
+    sid = transaction.savepoint()
+    try:
+        _update_counters(pending)
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+
+
+def _update_counters(pending):
+    # Counts for Datafiles deleted since they were accessed are dropped
+    datafile_ids = list(set(datafile_id for datafile_id, _ in pending))
+    existing = set()
+    for i in range(0, len(datafile_ids), ID_CHUNK_SIZE):
+        existing.update(Dataset_File.objects
+                        .filter(id__in=datafile_ids[i:i + ID_CHUNK_SIZE])
+                        .values_list('id', flat=True))
+    rows = {}
+    for i in range(0, len(datafile_ids), ID_CHUNK_SIZE):
+        for row in DatafileAccess.objects.filter(
+                datafile__in=datafile_ids[i:i + ID_CHUNK_SIZE],
+                date__in=set(day for _, day in pending)) \
+                .values_list('id', 'datafile_id', 'date'):
+            rows[(row[1], row[2])] = row[0]
+
+    # Existing counters are updated with one query per distinct increment
+    increments = defaultdict(list)
+    new = []
+    for key, count in pending.items():
+        if key in rows:
+            increments[count].append(rows[key])
+        elif key[0] in existing:
+            new.append(DatafileAccess(datafile_id=key[0], date=key[1],
+                                      count=count))
+    for count, ids in increments.items():
+        for i in range(0, len(ids), ID_CHUNK_SIZE):
+            DatafileAccess.objects.filter(id__in=ids[i:i + ID_CHUNK_SIZE]) \
+                                  .update(count=F('count') + count)
+
+    sid = transaction.savepoint()
+    try:
+        # (Three parameters per row)
+        for i in range(0, len(new), ID_CHUNK_SIZE / 3):
+            DatafileAccess.objects.bulk_create(
+                new[i:i + ID_CHUNK_SIZE / 3])
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Another process created some of the counters first
+        transaction.savepoint_rollback(sid)
+        for access in new:
+            if not DatafileAccess.objects \
+                    .filter(datafile=access.datafile_id, date=access.date) \
+                    .update(count=F('count') + access.count):
+                access.save()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception('Unable to record datafile accesses')
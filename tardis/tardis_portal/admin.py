@@ -67,8 +67,15 @@ class DatasetAdmin(admin.ModelAdmin):
 class DatafileAdmin(admin.ModelAdmin):
     search_fields = ['filename', 'id']
 
+class FixityCheckInline(admin.TabularInline):
+    model = models.FixityCheck
+    extra = 0
+    readonly_fields = ['time', 'ok', 'error', 'duration', 'md5sum',
+                       'sha512sum']
+
 class ReplicaAdmin(admin.ModelAdmin):
     search_fields = ['url', 'id']
+    inlines = [FixityCheckInline]
 
 class ProviderParameterNameInline(admin.TabularInline):
     model = models.ProviderParameter
@@ -29,7 +29,16 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+from django.contrib.auth.signals import user_logged_in
+from django.dispatch import receiver
+
 from tardis.tardis_portal.auth.authservice import AuthService
 
 # The auth_service ``singleton``
 auth_service = AuthService()
+
+
+@receiver(user_logged_in)
+def invalidate_groups_on_login(sender, user, **kwargs):
+    # Pick up any changes in group membership when the user logs in
+    auth_service.invalidateGroups(user)
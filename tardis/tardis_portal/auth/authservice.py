@@ -37,8 +37,10 @@ models.py
 
 """
 import logging
+import time
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.importlib import import_module
 from django.core.exceptions import ImproperlyConfigured
 from django.contrib import auth
@@ -66,6 +68,9 @@ class AuthService():
         self._authentication_backends = {}
         self._initialised = False
         self.settings = settings
+        # In-process copy of cached group memberships, as
+        # {key: (expiry time, groups)}
+        self._group_cache = {}
 
     def _manual_init(self):
         """Manual init had to be called by all the functions of the AuthService
@@ -249,10 +254,68 @@ class AuthService():
         grouplist = []
         for gp in self._group_providers:
             # logger.debug("group provider: " + gp.name)
-            for group in gp.getGroups(user):
+            for group in self._getProviderGroups(gp, user):
                 grouplist.append((gp.name, group))
         return grouplist
 
+    def _getGroupCacheKey(self, gp, user):
+        return 'tardis_portal.groups.%s.%s' % (gp.name, user.id)
+
+    def _getGroupGenerationKey(self, user):
+        return 'tardis_portal.groups.generation.%s' % user.id
+
+    def _getProviderGroups(self, gp, user):
+        """Return a group provider's groups for a user, which are cached
+        for GROUP_MEMBERSHIP_CACHE_TIMEOUT seconds (both in this process and
+        in Django's cache) if the provider allows it.
+
+        Each cached entry records the user's group 'generation' when it was
+        looked up, and is only used while that is still the generation in
+        Django's cache, so that invalidating the user's groups in one
+        process is seen by all of them.
+        """
+        timeout = getattr(self.settings, 'GROUP_MEMBERSHIP_CACHE_TIMEOUT', 0)
+        if not (timeout and getattr(gp, 'cache_groups', False)
+                and user.is_authenticated()):
+            return gp.getGroups(user)
+        key = self._getGroupCacheKey(gp, user)
+        generation = cache.get(self._getGroupGenerationKey(user), 0)
+        now = time.time()
+        entry = self._group_cache.get(key)
+        if not entry or entry[0] <= now or entry[1] != generation:
+            entry = cache.get(key)
+            if not entry or entry[1] != generation:
+                entry = (now + timeout, generation, list(gp.getGroups(user)))
+                cache.set(key, entry, timeout)
+            if len(self._group_cache) > 10000:
+                # Forget expired memberships
+                for k, v in self._group_cache.items():
+                    if v[0] <= now:
+                        del self._group_cache[k]
+            self._group_cache[key] = entry
+        return entry[2]
+
+    def invalidateGroups(self, user):
+        """Forget the cached group memberships of a user, so that they are
+        looked up afresh (by every process, as the user's group generation
+        is moved on).
+        """
+        if not self._initialised:
+            self._manual_init()
+        key = self._getGroupGenerationKey(user)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Not cached (or evicted).  Start from a value that entries
+            # cached before the generation was lost can't have.
+            cache.set(key, int(time.time() * 1000),
+                      getattr(self.settings, 'GROUP_MEMBERSHIP_CACHE_TIMEOUT',
+                              0) or None)
+        for gp in self._group_providers:
+            key = self._getGroupCacheKey(gp, user)
+            self._group_cache.pop(key, None)
+            cache.delete(key)
+
     def searchEntities(self, filter):
         """Return a list of users and/or groups
 
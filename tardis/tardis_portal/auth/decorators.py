@@ -63,7 +63,7 @@ def get_shared_experiments(request):
 
     #exclude owned experiments
     owned = get_owned_experiments(request)
-    experiments = experiments.exclude(id__in=[o.id for o in owned])
+    experiments = experiments.exclude(id__in=owned.values('id'))
     return experiments
 
 
@@ -77,13 +77,9 @@ def get_accessible_datafiles_for_user(request):
     if experiments.count() == 0:
         return []
 
-    queries = [Q(dataset__experiments__id=e.id) for e in experiments]
-
-    query = queries.pop()
-    for item in queries:
-        query |= item
-
-    return Dataset_File.objects.filter(query)
+    # (A subquery, rather than a clause for each experiment)
+    return Dataset_File.objects.filter(
+        dataset__in=Dataset.objects.filter(experiments__in=experiments))
 
 
 def has_experiment_ownership(request, experiment_id):
@@ -99,15 +95,8 @@ def has_experiment_write(request, experiment_id):
     return has_write_permissions(request, experiment_id)
 
 def has_experiment_download_access(request, experiment_id):
-
-    if Experiment.safe.owned_and_shared(request.user) \
-                      .filter(id=experiment_id) \
-                      .exists():
-
-        return True
-    else:
-        exp = Experiment.objects.get(id=experiment_id)
-        return Experiment.public_access_implies_distribution(exp.public_access)
+    return get_access_resolver(request) \
+        .can_download_experiment(experiment_id)
 
 def has_dataset_ownership(request, dataset_id):
     dataset = Dataset.objects.get(id=dataset_id)
@@ -128,17 +117,98 @@ def has_dataset_write(request, dataset_id):
                for experiment in dataset.experiments.all())
 
 def has_dataset_download_access(request, dataset_id):
-    dataset = Dataset.objects.get(id=dataset_id)
-    return any(has_experiment_download_access(request, experiment.id)
-               for experiment in dataset.experiments.all())
+    return get_access_resolver(request).can_download_dataset(dataset_id)
 
 def has_datafile_access(request, dataset_file_id):
     dataset = Dataset.objects.get(dataset_file=dataset_file_id)
     return has_dataset_access(request, dataset.id)
 
 def has_datafile_download_access(request, dataset_file_id):
-    dataset = Dataset.objects.get(dataset_file=dataset_file_id)
-    return has_dataset_download_access(request, dataset.id)
+    return get_access_resolver(request).can_download_datafile(dataset_file_id)
+
+
+class AccessResolver(object):
+    """
+    Answers download access questions for a user in bulk.  The experiments
+    the user can read through ACLs are looked up once; after that, any
+    number of datasets or datafiles can be checked with a single query for
+    their experiments, and the answers are remembered.
+
+    A resolver is not told about ACL changes, so it should only live as
+    long as a request - see get_access_resolver().
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._shared_experiment_ids = None
+        self._datasets = {}
+
+    @property
+    def shared_experiment_ids(self):
+        """ The ids of experiments owned by or shared with the user. """
+        if self._shared_experiment_ids is None:
+            self._shared_experiment_ids = frozenset(
+                Experiment.safe.owned_and_shared(self.user)
+                .values_list('id', flat=True))
+        return self._shared_experiment_ids
+
+    def _can_download(self, experiment_id, public_access):
+        return experiment_id in self.shared_experiment_ids or \
+            Experiment.public_access_implies_distribution(public_access)
+
+    def can_download_experiment(self, experiment_id):
+        if int(experiment_id) in self.shared_experiment_ids:
+            return True
+        exp = Experiment.objects.get(id=experiment_id)
+        return Experiment.public_access_implies_distribution(exp.public_access)
+
+    def get_downloadable_dataset_ids(self, dataset_ids):
+        """
+        Return the set of the given dataset ids that the user can download.
+        """
+        dataset_ids = set(int(dataset_id) for dataset_id in dataset_ids)
+        unknown = dataset_ids.difference(self._datasets)
+        if unknown:
+            for dataset_id in unknown:
+                self._datasets[dataset_id] = False
+            links = Dataset.experiments.through.objects \
+                .filter(dataset__in=unknown) \
+                .values_list('dataset', 'experiment',
+                             'experiment__public_access')
+            for dataset_id, experiment_id, public_access in links:
+                if self._can_download(experiment_id, public_access):
+                    self._datasets[dataset_id] = True
+        return set(dataset_id for dataset_id in dataset_ids
+                   if self._datasets[dataset_id])
+
+    def can_download_dataset(self, dataset_id):
+        return bool(self.get_downloadable_dataset_ids([dataset_id]))
+
+    def can_download_datafile(self, dataset_file_id):
+        dataset_id = Dataset_File.objects.values_list('dataset', flat=True) \
+                                         .get(id=dataset_file_id)
+        return self.can_download_dataset(dataset_id)
+
+    def filter_downloadable_datafiles(self, datafiles):
+        """
+        Restrict a Dataset_File queryset to the datafiles the user can
+        download.
+        """
+        dataset_ids = set(datafiles.values_list('dataset', flat=True))
+        return datafiles.filter(
+            dataset__in=self.get_downloadable_dataset_ids(dataset_ids))
+
+
+def get_access_resolver(request):
+    """
+    Return the AccessResolver for the request's user, which is shared by
+    all the access checks made while handling the request.
+    """
+    resolver = getattr(request, '_access_resolver', None)
+    if resolver is None or resolver.user is not request.user:
+        resolver = AccessResolver(request.user)
+        request._access_resolver = resolver
+    return resolver
 
 def has_read_or_owner_ACL(request, experiment_id):
     """
@@ -92,6 +92,11 @@ class UserProvider:
 
 class GroupProvider:
 
+    # Whether AuthService may cache the result of getGroups() for a while
+    # (see GROUP_MEMBERSHIP_CACHE_TIMEOUT).  Worthwhile for providers that
+    # query a remote service, but not for ones that depend on the request.
+    cache_groups = False
+
     def getGroups(self, user):
         """
         return an iteration of the available groups.
@@ -38,6 +38,7 @@ LDAP Authentication module.
 
 import ldap
 import logging
+from threading import Lock
 
 from django.conf import settings
 
@@ -53,10 +54,87 @@ auth_key = u'ldap'
 auth_display_name = u'LDAP'
 
 
+class LDAPConnectionPool(object):
+    """A pool of connections to an LDAP server, bound with the same
+    credentials, so that searches don't pay for a connect and bind each.
+    At most 'size' idle connections are kept.
+    """
+
+    def __init__(self, url, bind_user='', bind_pass='', size=4):
+        self._url = url
+        self._bind_user = bind_user
+        self._bind_pass = bind_pass
+        self._size = size
+        self._idle = []
+        self._lock = Lock()
+
+    def _connect(self):
+        l = ldap.initialize(self._url)
+        l.protocol_version = ldap.VERSION3
+        try:
+            if self._bind_user and self._bind_pass:
+                l.simple_bind_s(self._bind_user, self._bind_pass)
+            else:
+                l.simple_bind_s()
+        except ldap.LDAPError:
+            self.discard(l)
+            raise
+        return l
+
+    def acquire(self):
+        """ Return an idle connection, or a new one if there are none.
+        """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, l):
+        """ Return a connection to the pool once it is finished with.
+        """
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(l)
+                return
+        l.unbind_s()
+
+    def discard(self, l):
+        """ Close a connection that may be broken, instead of releasing it.
+        """
+        try:
+            l.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def search(self, base, scope, filterstr, attrlist):
+        """ Run a search on a pooled connection.  A search that fails
+        because the server has dropped the (idle) connection is retried
+        once on a new one.
+        """
+        for attempt in (1, 2):
+            l = self.acquire()
+            try:
+                result = l.search_s(base, scope, filterstr, attrlist)
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR):
+                self.discard(l)
+                if attempt == 2:
+                    raise
+                continue
+            except ldap.LDAPError:
+                self.discard(l)
+                raise
+            self.release(l)
+            return result
+
+
 class LDAPBackend(AuthProvider, UserProvider, GroupProvider):
+
+    # Memberships come from the LDAP server, so are worth caching
+    cache_groups = True
+
     def __init__(self, name, url, base, login_attr, user_base,
                  user_attr_map, group_id_attr, group_base,
-                 group_attr_map, admin_user='', admin_pass=''):
+                 group_attr_map, admin_user='', admin_pass='', pool_size=4):
         self.name = name
 
         # Basic info
@@ -81,39 +159,18 @@ class LDAPBackend(AuthProvider, UserProvider, GroupProvider):
         self._group_attr_map = group_attr_map
         self._group_attr_map[self._group_id] = "id"
 
+        # Connections for searches
+        self._pool = LDAPConnectionPool(url, admin_user, admin_pass,
+                                        pool_size)
+
     def _query(self, base, filterstr, attrlist):
         """Safely query LDAP
         """
-        l = None
-        searchScope = ldap.SCOPE_SUBTREE
-
         try:
-            l = ldap.initialize(self._url)
+            return self._pool.search(base, ldap.SCOPE_SUBTREE,
+                                     filterstr, attrlist)
         except ldap.LDAPError, e:
-            logger.error(e.message['desc'], ": ", self._url)
-            return None
-        l.protocol_version = ldap.VERSION3
-
-        try:
-            if self._admin_user and self._admin_pass:
-                l.simple_bind(self._admin_user, self._admin_pass)
-            else:
-                l.simple_bind()
-        except ldap.LDAPError, e:
-            logger.error(e.args[0]['desc'])
-            if l:
-                l.unbind_s()
-            return None
-
-        try:
-            ldap_result_id = l.search(base, searchScope,
-                                      filterstr, attrlist)
-            result_type, result_data = l.result(ldap_result_id, 1)
-            return result_data
-        except ldap.LDAPError, e:
-            logger.error(e.message['desc'])
-        finally:
-            l and l.unbind_s()
+            logger.error('%s: %s' % (self._url, e))
         return None
 
     #
@@ -194,31 +251,20 @@ class LDAPBackend(AuthProvider, UserProvider, GroupProvider):
             #input is username not email so return username
             return email
 
-        l = None
+        retrieveAttributes = ["uid"]
+        searchFilter = '(|(mail=%s)(mailalternateaddress=%s))' % (email,
+                                                                  email)
+        ldap_result = self._query(self._user_base, searchFilter,
+                                  retrieveAttributes)
+        logger.debug(ldap_result)
         try:
-            retrieveAttributes = ["uid"]
-            l = ldap.initialize(self._url)
-            l.protocol_version = ldap.VERSION3
-            searchFilter = '(|(mail=%s)(mailalternateaddress=%s))' % (email,
-                                                                      email)
-            ldap_result = l.search_s(self._user_base, ldap.SCOPE_SUBTREE,
-                                      searchFilter, retrieveAttributes)
-
-            logger.debug(ldap_result)
             if ldap_result[0][1]['uid'][0]:
                 return ldap_result[0][1]['uid'][0]
             else:
                 return None
-
-        except ldap.LDAPError:
-            logger.exception("ldap error")
-            return None
-        except IndexError:
+        except (IndexError, TypeError):
             logger.exception("index error")
             return None
-        finally:
-            if l:
-                l.unbind_s()
 
     #
     # Group Provider
@@ -362,8 +408,10 @@ def ldap_auth():
     except:
         raise ValueError('LDAP_GROUP_ATTR_MAP must be specified in settings.py')
 
+    pool_size = getattr(settings, 'LDAP_POOL_SIZE', 4)
+
     _ldap_auth = LDAPBackend("ldap", url, base, user_login_attr,
                              user_base, user_attr_map, group_id_attr,
                              group_base, group_attr_map, admin_user,
-                             admin_password)
+                             admin_password, pool_size)
     return _ldap_auth
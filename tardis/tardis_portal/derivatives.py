@@ -0,0 +1,194 @@
+"""
+derivatives.py
+
+A persistent cache for derived renderings of datafiles (e.g. the IIIF
+image renders used for thumbnails and slideshows).  Derivatives are stored
+as files under IIIF_CACHE_DIR, named by a key that is derived from the
+datafile's checksum and the rendering parameters, so an entry never goes
+stale; it simply stops being asked for.  The directory is kept under
+IIIF_CACHE_SIZE_LIMIT bytes by evicting the least recently used entries.
+
+Small derivatives can additionally be held in Django's cache (e.g.
+memcached) so that they can be shared between web servers without
+touching the disk.
+
+"""
+import hashlib
+import json
+import logging
+import os
+from tempfile import mkstemp
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache as shared_cache
+
+logger = logging.getLogger(__name__)
+
+# Once pruning starts, remove entries until the cache is this full
+LOW_WATER_MARK = 0.9
+
+
+def get_derivative_key(datafile, *args):
+    """
+    Return the cache key for a derivative of 'datafile' rendered with the
+    given arguments, or None if the datafile has no checksum to tie the
+    derivative to its content.
+    """
+    checksum = datafile.sha512sum or datafile.md5sum
+    if not checksum:
+        return None
+    signature = checksum + json.dumps([unicode(arg) for arg in args])
+    return hashlib.sha1(signature).hexdigest()
+
+
+class DerivativeCache(object):
+    """
+    A size-bounded LRU store of derivatives, keyed by get_derivative_key().
+    Recency is recorded in each entry's modification time, which is
+    refreshed on every hit; it works across processes, and unlike the
+    access time it isn't affected by 'noatime' mounts.
+    """
+
+    def __init__(self, path, size_limit, shared_max_item_size=0):
+        self.path = path
+        self.size_limit = size_limit
+        self.shared_max_item_size = shared_max_item_size
+        # This process's estimate of the cache size.  It is recomputed by
+        # prune(), which is only run when the estimate exceeds the limit.
+        self._size = None
+        self._lock = Lock()
+
+    def _get_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def _get_shared_key(self, key):
+        return 'tardis_portal.derivative.%s' % key
+
+    def get_path(self, key):
+        """ Return the path of the stored derivative, or None if absent.
+        """
+        filepath = self._get_path(key)
+        try:
+            # Mark as recently used
+            os.utime(filepath, None)
+            return filepath
+        except OSError:
+            return None
+
+    def get(self, key):
+        """ Return the content of the stored derivative, or None if absent.
+        """
+        if self.shared_max_item_size > 0:
+            data = shared_cache.get(self._get_shared_key(key))
+            if data is not None:
+                return data
+        filepath = self.get_path(key)
+        if not filepath:
+            return None
+        try:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+        except IOError:
+            # Evicted in the meantime
+            return None
+        self._put_shared(key, data)
+        return data
+
+    def put(self, key, data):
+        """ Store a derivative.  The file appears atomically, so concurrent
+        readers never see a partial derivative.
+        """
+        self._put_shared(key, data)
+        dirname = os.path.dirname(self._get_path(key))
+        try:
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmpname = mkstemp(dir=dirname, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmpname, self._get_path(key))
+        except (IOError, OSError) as e:
+            # The cache is an optimisation; failing to fill it isn't fatal.
+            logger.warn('Unable to cache derivative %s: %s' % (key, e))
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._get_usage()[0]
+            else:
+                self._size += len(data)
+            needs_pruning = self._size > self.size_limit
+        if needs_pruning:
+            self.prune()
+
+    def delete(self, key):
+        """ Remove a derivative, if present.
+        """
+        if self.shared_max_item_size > 0:
+            shared_cache.delete(self._get_shared_key(key))
+        try:
+            os.unlink(self._get_path(key))
+        except OSError:
+            pass
+
+    def _put_shared(self, key, data):
+        if 0 < len(data) <= self.shared_max_item_size:
+            shared_cache.set(self._get_shared_key(key), data)
+
+    def _get_usage(self):
+        """ Return the total size of the cache and a list of its entries,
+        as (mtime, size, path) tuples.
+        """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, filepath))
+                total += st.st_size
+        return (total, entries)
+
+    def prune(self):
+        """ Remove least recently used entries until the cache is back
+        under its low water mark.  Returns the number of entries removed.
+        """
+        total, entries = self._get_usage()
+        removed = 0
+        if total > self.size_limit:
+            target = self.size_limit * LOW_WATER_MARK
+            entries.sort()
+            for _, size, filepath in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(filepath)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+            logger.info('Pruned %d derivatives from %s' % (removed, self.path))
+        with self._lock:
+            self._size = total
+        return removed
+
+
+_derivative_cache = None
+
+def get_derivative_cache():
+    """ Return the site's DerivativeCache, or None if caching of
+    derivatives is not enabled.
+    """
+    global _derivative_cache
+    path = getattr(settings, 'IIIF_CACHE_DIR', None)
+    if not path:
+        return None
+    if not _derivative_cache or _derivative_cache.path != path:
+        _derivative_cache = DerivativeCache(
+            path,
+            getattr(settings, 'IIIF_CACHE_SIZE_LIMIT', 1024 * 1024 * 1024),
+            getattr(settings, 'IIIF_SHARED_CACHE_MAX_ITEM_SIZE', 0))
+    return _derivative_cache
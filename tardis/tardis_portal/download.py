@@ -8,7 +8,6 @@ download.py
 
 """
 import logging
-import shutil
 import subprocess
 import urllib
 import os, platform, ctypes, stat, time, struct
@@ -20,70 +19,73 @@ except ImportError:
     zlib = None
     crc32 = binascii.crc32
 
-from itertools import chain
-from tempfile import mkstemp, gettempdir, NamedTemporaryFile
-from threading import Thread
+from contextlib import closing
+from tarfile import TarInfo, BLOCKSIZE, RECORDSIZE, GNU_FORMAT, NUL
 from urllib2 import urlopen, URLError
-from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, \
+    ZIP64_LIMIT, structFileHeader, stringFileHeader
 
 from django.core.servers.basehttp import FileWrapper
 from django.http import HttpResponse, HttpResponseRedirect, \
-    HttpResponseNotFound
+    HttpResponseNotFound, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
 from django.conf import settings
 from django.utils.importlib import import_module
 from django.core.exceptions import ImproperlyConfigured
 
 from tardis.tardis_portal.models import *
-from tardis.tardis_portal.util import get_free_space
+from tardis.tardis_portal.accesslog import record_access
 from tardis.tardis_portal.auth.decorators import *
 from tardis.tardis_portal.views import return_response_not_found, \
     return_response_error, render_error_message
 
 logger = logging.getLogger(__name__)
 
-class StreamingFile:
-
-    def __init__(self, writer_callable, asynchronous_file_creation=False):
-        # Caution, only use 'asynchronous_file_creation=True' if the
-        # writer_callable outputs the file strictly sequentially.  If it seeks
-        # backwards to back-fill details (like ZipFile does!), this can cause
-        # a data race and can result in a corrupted download.
-        _, self.name = mkstemp(
-            dir=getattr(settings, 'DOWNLOAD_TEMP_DIR', None))
-        self.asynchronous = asynchronous_file_creation
-        if asynchronous_file_creation:
-            self.runnable = writer_callable
-            self.thread = Thread(target=self)
-            self.thread.start()
-        else:
-            writer_callable(self.name)
-        self.reader = open(self.name, 'rb')
+# Size of the reads used when copying datafile content into a response
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+
+# Selected datafiles are access checked in batches of this many ids (which
+# keeps queries within the database's limit on parameters)
+ACCESS_CHECK_BATCH_SIZE = 500
+
+
+class ArchiveBuffer(object):
+    """
+    A write-only file-like sink for the streaming archive writers.  Bytes
+    written to it are held only until the generator producing the archive
+    collects them with :meth:`drain`, so memory use is bounded by the read
+    chunk size.  A buffer created with ``discard=True`` keeps no data at all;
+    it is used to measure an archive's length without reading any files.
+    """
 
-    def __call__(self):
-        self.runnable(self.name)
+    def __init__(self, discard=False):
+        self.discard = discard
+        self.position = 0
+        self.chunks = []
 
-    def read(self, size=1):
-        def read_file(size):
-            return self.reader.read(size)
+    def write(self, data):
+        self.position += len(data)
+        if not self.discard:
+            self.chunks.append(data)
 
-        remaining_bytes = size
-        buf = ''
-        if self.asynchronous:
-            while self.thread.is_alive() and remaining_bytes > 0:
-                from time import sleep
-                sleep(0.01)
-                read_bytes = read_file(remaining_bytes)
-                buf += read_bytes
-                remaining_bytes -= len(read_bytes)
+    def skip(self, length):
+        """Account for 'length' bytes of content without supplying them.
+        This only makes sense when measuring."""
+        if not self.discard:
+            raise IOError('Cannot skip content in a streamed archive')
+        self.position += length
 
-        if remaining_bytes > 0:
-            buf += read_file(remaining_bytes)
+    def tell(self):
+        return self.position
 
-        return buf
+    def flush(self):
+        pass
 
-    def close(self):
-        self.reader.close()
-        os.unlink(self.name)
+    def drain(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
 
 class StreamableZipFile(ZipFile):
     def __init__(self, file, mode="r", compression=ZIP_STORED, allowZip64=False):
@@ -170,6 +172,297 @@ class StreamableZipFile(ZipFile):
         self.filelist.append(zinfo)
         self.NameToInfo[zinfo.filename] = zinfo
 
+    def begin_entry(self, arcname, file_size, date_time):
+        """Write the local header for a STORED entry whose content (exactly
+        file_size bytes) the caller will then write to self.fp.  Returns the
+        ZipInfo to be passed to end_entry once the content is written."""
+        if not self.fp:
+            raise RuntimeError(
+                  "Attempt to write to ZIP archive that was already closed")
+        zinfo = ZipInfo(arcname, date_time)
+        zinfo.external_attr = 0100644 << 16L    # Regular file, rw-r--r--
+        zinfo.compress_type = ZIP_STORED
+        zinfo.file_size = file_size
+        zinfo.flag_bits = 0x08                  # Use trailing data descriptor for file sizes and CRC
+        zinfo.header_offset = self.fp.tell()    # Start of header bytes
+        self._writecheck(zinfo)
+        self._didModify = True
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        self.fp.write(self._local_header(zinfo, file_size > ZIP64_LIMIT))
+        return zinfo
+
+    def _local_header(self, zinfo, zip64):
+        """Return the local header for an entry with a data descriptor.
+        ZipInfo.FileHeader can't be asked for the Zip64 extra field (which
+        such an entry needs, as its sizes in the header are zero) before
+        Python 2.7.4, so the header is built here."""
+        dt = zinfo.date_time
+        dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        extra = zinfo.extra
+        if zip64:
+            # (The sizes follow the data, so are zero here too)
+            extra += struct.pack('<HHQQ', 1, 16, 0, 0)
+            zinfo.extract_version = max(45, zinfo.extract_version)
+        filename, flag_bits = zinfo.filename, zinfo.flag_bits
+        if isinstance(filename, unicode):
+            try:
+                filename = filename.encode('ascii')
+            except UnicodeEncodeError:
+                filename = filename.encode('utf-8')
+                flag_bits |= 0x800
+        header = struct.pack(structFileHeader, stringFileHeader,
+                             zinfo.extract_version, zinfo.reserved,
+                             flag_bits, zinfo.compress_type, dostime,
+                             dosdate, 0, 0, 0, len(filename),
+                             len(extra))
+        return header + filename + extra
+
+    def end_entry(self, zinfo, CRC):
+        """Write the data descriptor for an entry started with begin_entry,
+        and add it to the central directory."""
+        zinfo.CRC = CRC
+        zinfo.compress_size = zinfo.file_size
+        if zinfo.file_size > ZIP64_LIMIT:
+            descriptor = struct.pack("<LQQ", zinfo.CRC, zinfo.compress_size,
+                                     zinfo.file_size)
+        else:
+            descriptor = struct.pack("<LLL", zinfo.CRC, zinfo.compress_size,
+                                     zinfo.file_size)
+        self.fp.write(descriptor)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+def _parse_range_header(header, size):
+    """
+    Parse an HTTP "Range" header for a file of 'size' bytes into a sorted
+    list of (first, last) byte offsets, with overlapping or adjacent ranges
+    coalesced.  Returns None if the header is absent or malformed (in which
+    case it must be ignored), and an empty list if none of the ranges can
+    be satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first:
+                first = int(first)
+                if last:
+                    last = int(last)
+                    if last < first:
+                        return None
+                else:
+                    last = size - 1
+            else:
+                # Suffix range, i.e. the last N bytes
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                first, last = max(size - suffix, 0), size - 1
+        except ValueError:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    ranges.sort()
+    coalesced = []
+    for first, last in ranges:
+        if coalesced and first <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(last, coalesced[-1][1]))
+        else:
+            coalesced.append((first, last))
+    return coalesced
+
+def _read_ranges(file_obj, ranges, seekable, part_headers=None,
+                 trailer=''):
+    """
+    Yield the content of the (ascending) byte 'ranges' of 'file_obj',
+    optionally preceded by the matching multipart 'part_headers' and
+    followed by a 'trailer'.  Local files are positioned with seek();
+    for anything else we have to read and discard the skipped bytes.
+    """
+    with closing(file_obj) as f:
+        position = 0
+        for i, (first, last) in enumerate(ranges):
+            if part_headers:
+                yield part_headers[i]
+            if seekable:
+                f.seek(first)
+            else:
+                skip = first - position
+                while skip > 0:
+                    buf = f.read(min(DOWNLOAD_CHUNK_SIZE, skip))
+                    if not buf:
+                        break
+                    skip -= len(buf)
+            remaining = last - first + 1
+            while remaining > 0:
+                buf = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not buf:
+                    break
+                remaining -= len(buf)
+                yield buf
+            position = last + 1
+            if part_headers:
+                yield '\r\n'
+        if trailer:
+            yield trailer
+
+def _get_datafile_etag(datafile):
+    checksum = datafile.sha512sum or datafile.md5sum
+    if checksum:
+        return '"%s"' % checksum
+    return None
+
+def _get_datafile_last_modified(datafile):
+    if datafile.modification_time:
+        return int(time.mktime(datafile.modification_time.timetuple()))
+    return None
+
+def _not_modified(request, etag, last_modified):
+    """ Check the request's conditional GET headers against the datafile's
+    ETag and modification time.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = [e.strip() for e in if_none_match.split(',')]
+        return etag is not None and ('*' in etags or etag in etags)
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return last_modified is not None and if_modified_since is not None \
+        and last_modified <= if_modified_since
+
+def _range_allowed(request, etag, last_modified):
+    """ Honour "If-Range": only send a partial response if the client's
+    copy is still current.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return etag is not None and if_range == etag
+    return last_modified is not None and \
+        parse_http_date_safe(if_range) == last_modified
+
+def _create_file_response(request, datafile, disposition):
+    """
+    Build the response for a single datafile, supporting conditional GETs
+    (keyed on the datafile's checksum) and single or multiple byte ranges.
+    The file is only opened if content actually has to be sent.
+    """
+    mimetype = datafile.get_mimetype()
+    etag = _get_datafile_etag(datafile)
+    last_modified = _get_datafile_last_modified(datafile)
+    try:
+        size = long(datafile.get_size())
+    except ValueError:
+        size = None
+
+    if _not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        file_obj = datafile.get_file()
+        if not file_obj:
+            # If file path doesn't resolve, return not found
+            return return_response_not_found(request)
+        record_access([datafile.id])
+        ranges = None
+        if size is not None and _range_allowed(request, etag, last_modified):
+            ranges = _parse_range_header(request.META.get('HTTP_RANGE'),
+                                         size)
+        if ranges is None:
+            response = HttpResponse(FileWrapper(file_obj), mimetype=mimetype)
+            if size is not None:
+                response['Content-Length'] = str(size)
+        elif len(ranges) == 0:
+            file_obj.close()
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+        else:
+            seekable = datafile.is_local()
+            if len(ranges) == 1:
+                first, last = ranges[0]
+                response = HttpResponse(
+                    _read_ranges(file_obj, ranges, seekable),
+                    mimetype=mimetype, status=206)
+                response['Content-Range'] = \
+                    'bytes %d-%d/%d' % (first, last, size)
+                response['Content-Length'] = str(last - first + 1)
+            else:
+                import uuid
+                boundary = uuid.uuid4().hex
+                part_headers = ['--%s\r\nContent-Type: %s\r\n'
+                                'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                                (boundary, mimetype, first, last, size)
+                                for first, last in ranges]
+                trailer = '--%s--\r\n' % boundary
+                length = len(trailer) + \
+                    sum(len(header) + (last - first + 1) + 2
+                        for header, (first, last) in zip(part_headers,
+                                                         ranges))
+                response = HttpResponse(
+                    _read_ranges(file_obj, ranges, seekable,
+                                 part_headers, trailer),
+                    mimetype='multipart/byteranges; boundary=%s' % boundary,
+                    status=206)
+                response['Content-Length'] = str(length)
+        response['Content-Disposition'] = \
+            '%s; filename="%s"' % (disposition, datafile.filename)
+    if size is not None:
+        response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # Caches may keep a copy, but must revalidate it (cheaply) with us
+    if datafile.is_public():
+        patch_cache_control(response, public=True, max_age=0,
+                            must_revalidate=True)
+    else:
+        patch_cache_control(response, private=True, max_age=0,
+                            must_revalidate=True)
+    return response
+
+def get_offload_response(filepath, mimetype):
+    """
+    Return an empty response that tells the front-end web server to send
+    the local file 'filepath' itself, so that no Django worker is tied up
+    for the transfer.  The DOWNLOAD_OFFLOAD setting selects the mechanism:
+    'x-sendfile' (Apache mod_xsendfile, lighttpd) or 'x-accel-redirect'
+    (nginx).  For nginx, DOWNLOAD_OFFLOAD_LOCATIONS maps file system path
+    prefixes to the corresponding 'internal' locations.  Returns None if
+    offloading is disabled or the file isn't covered by the configuration.
+    The web server takes care of ranges and conditional requests.
+    """
+    mode = getattr(settings, 'DOWNLOAD_OFFLOAD', None)
+    if not mode or not filepath:
+        return None
+    if isinstance(filepath, unicode):
+        filepath = filepath.encode('utf-8')
+    if mode == 'x-sendfile':
+        header, value = 'X-Sendfile', urllib.quote(filepath)
+    elif mode == 'x-accel-redirect':
+        header, value = 'X-Accel-Redirect', None
+        locations = getattr(settings, 'DOWNLOAD_OFFLOAD_LOCATIONS', {})
+        for prefix, location in locations.items():
+            prefix = os.path.join(prefix, '')
+            if filepath.startswith(prefix):
+                value = location.rstrip('/') + '/' + \
+                    urllib.quote(filepath[len(prefix):])
+                break
+        if not value:
+            logger.debug('No offload location for %s' % filepath)
+            return None
+    else:
+        raise ImproperlyConfigured('Unknown DOWNLOAD_OFFLOAD mode: %s' % mode)
+    response = HttpResponse(mimetype=mimetype)
+    response[header] = value
+    return response
+
 def _create_download_response(request, datafile_id, disposition='attachment'):
     #import ipdb; ipdb.set_trace()
     # Get datafile (and return 404 if absent)
@@ -192,17 +485,16 @@ def _create_download_response(request, datafile_id, disposition='attachment'):
         return download_image(*args, format='png')
     # Send local file
     try:
-        # Get file object for datafile
-        file_obj = datafile.get_file()
-        if not file_obj:
-            # If file path doesn't resolve, return not found
-            return return_response_not_found(request)
-        wrapper = FileWrapper(file_obj)
-        response = HttpResponse(wrapper,
-                                mimetype=datafile.get_mimetype())
-        response['Content-Disposition'] = \
-            '%s; filename="%s"' % (disposition, datafile.filename)
-        return response
+        replica = datafile.get_preferred_replica()
+        if replica and replica.verified and replica.is_local():
+            response = get_offload_response(replica.get_absolute_filepath(),
+                                            datafile.get_mimetype())
+            if response:
+                response['Content-Disposition'] = \
+                    '%s; filename="%s"' % (disposition, datafile.filename)
+                record_access([datafile.id])
+                return response
+        return _create_file_response(request, datafile, disposition)
     except IOError:
         # If we can't read the file, return not found
         return return_response_not_found(request)
@@ -289,142 +581,169 @@ def classic_mapper(rootdir):
 
 def _get_datafile_details_for_archive(mapper, datafiles):
     # It would be simplest to do this lazily.  But if we do that, we implicitly
-    # passing the database context to the thread that will write the archive,
-    # and that is a bit dodgy.  (It breaks in unit tests!)  Instead, we
-    # populate the list eagerly, but with a file getter rather than the file
-    # itself.  If we populate with actual File objects, we risk running out
-    # of file descriptors.
+    # passing the database context to the generator that will write the
+    # archive, and that is a bit dodgy.  Instead, we populate the list
+    # eagerly, but with a file getter rather than the file itself.  If we
+    # populate with actual File objects, we risk running out of file
+    # descriptors.  The recorded size is needed up front because the tar and
+    # zip headers are written before the content is streamed.
     res = []
     for df in datafiles:
         mapped_pathname = mapper(df)
-        if mapped_pathname:
-            res.append((df.get_file_getter(), mapper(df)))
-    return res
-
-def _write_files_to_archive(write_func, files):
-    for fileGetter, name in files:
-        if not fileGetter:
-            logger.debug('Skipping %s - no verified file is available.' % name)
+        if not mapped_pathname:
             continue
-        fileObj = fileGetter()
-        if not fileObj:
-            logger.debug('Skipping %s - file open failed.' % name)
+        replica = df.get_preferred_replica(verified=True)
+        if not replica:
+            logger.debug('Skipping %s - no verified file is available.' %
+                         mapped_pathname)
             continue
-        with NamedTemporaryFile(
-                prefix='mytardis_tmp_dl_',
-                dir=getattr(settings, 'DOWNLOAD_TEMP_DIR', None)) as fdst:
-            try:
-                # Copy url to destination file
-                shutil.copyfileobj(fileObj, fdst)
-                # Flush the file so we can read from it properly
-                fdst.flush()
-                # Write file
-                write_func(fdst.name, name)
-            except URLError:
-                logger.warn("Unable to fetch %s for archive download." % name)
-            finally:
-                fileObj.close()
-
-def _write_tar_func(mapper, datafiles):
-    logger.debug('Getting files to write to archive')
-    # Resolve url and name for the files
-    files = _get_datafile_details_for_archive(mapper, datafiles)
-    # Define the function
-    def write_tar(filename):
-        from tarfile import TarFile
         try:
-            tf = TarFile(filename, 'w')
-            logger.debug('Writing tar archive to %s' % filename)
-            _write_files_to_archive(tf.add, files)
-            tf.close()
-            logger.debug('Completed tar archive size is %i' % os.stat(filename).st_size)
-        except IOError as ex:
-            logger.warn("I/O error({0}) while writing tar archive: {1}".format(e.errno, e.strerror))
-            os.unlink(filename)
-        finally:
-            tf.close()
-    # Returns the function to do the actual writing
-    return write_tar
-
-def _write_zip_func(mapper, datafiles):
-    logger.debug('Getting files to write to archive')
-    # Resolve url and name for the files
-    files = _get_datafile_details_for_archive(mapper, datafiles)
-    # Define the function
-    def write_zip(filename):
-        try:
-            zf = StreamableZipFile(filename, 'w', allowZip64=True)
-            logger.debug('Writing zip archive to %s' % filename)
-            _write_files_to_archive(zf.write, files)
-            zf.close()
-            logger.debug('Completed zip archive size is %i' % os.stat(filename).st_size)
-        except IOError as ex:
-            logger.warn("I/O error({0}) while writing zip archive: {1}".format(e.errno, e.strerror))
-            os.unlink(filename)
-        finally:
-            zf.close()
-    # Returns the function to do the actual writing
-    return write_zip
-
-def _estimate_archive_size(mapper, datafiles, comptype):
+            size = long(df.get_size())
+        except ValueError:
+            logger.debug('Skipping %s - file size is unknown.' %
+                         mapped_pathname)
+            continue
+        mtime = df.modification_time or df.created_time
+        if mtime:
+            mtime = time.mktime(mtime.timetuple())
+        else:
+            mtime = time.time()
+        res.append((replica.get_file_getter(), mapped_pathname, size, mtime))
+    return res
+
+def _read_archive_entry(fileGetter, name, size):
     """
-    produces an estimate of the size of the uncompressed file archive.
-    This is made based on the information we have to hand (i.e. the names
-    and the notional file sizes from the database.  We don't try to access
-    the files themselves, as this potentially increases temporary disc
-    space usage which is the resource we are primarily trying to protect
-    at this point.
+    Yield the content of a datafile in DOWNLOAD_CHUNK_SIZE pieces.  The
+    archive headers have already promised 'size' bytes, so a file that
+    can't be opened or has the wrong length aborts the download rather than
+    silently producing a corrupt archive.
     """
-    # TODO - include the implied entries for directories in the estimates.
-    estimate = 0
-    count = 0
-    for df in datafiles:
-        file_name = mapper(df)
-        if not file_name:
-            continue
-        count += 1
-        if comptype == "tar":
-            # File header + file size with padding to 512
-            estimate += 512 + ((int(df.get_size()) + 511) / 512) * 512
-        elif comptype == "zip":
-            name_length = len(file_name)
-            # local header + content + DD + file header
-            estimate += (20 + name_length) + int(df.get_size()) + \
-                8 + (46 + name_length)
-    if comptype == "tar":
-         # Two records of zeros at the end.
-         estimate += 1024
-    elif comptype == "zip":
-        # Central directory overheads
-        estimate += 100
-    return (count, estimate)
-
-
-def _get_free_temp_space():
-    """ Return free space on the file system holding the temporary
-    directory (in bytes)
+    fileObj = fileGetter()
+    if not fileObj:
+        logger.error('Unable to open %s for archive download.' % name)
+        raise IOError('Unable to open %s' % name)
+    with closing(fileObj) as f:
+        remaining = size
+        while remaining > 0:
+            buf = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not buf:
+                break
+            remaining -= len(buf)
+            yield buf
+        if remaining > 0 or f.read(1):
+            logger.error('Size of %s does not match the recorded size %d.' %
+                         (name, size))
+            raise IOError('Size of %s does not match its recorded size' %
+                          name)
+
+def _write_tar(out, files, measure=False):
     """
-    return get_free_space(getattr(settings, 'DOWNLOAD_TEMP_DIR', gettempdir()))
-
+    Generator that writes a (GNU format) tar archive of 'files' to the
+    ArchiveBuffer 'out', yielding the archive bytes as they become
+    available.  With 'measure' the content is skipped rather than read,
+    which leaves the exact archive length in out.tell().
+    """
+    for fileGetter, name, size, mtime in files:
+        tarinfo = TarInfo(name)
+        tarinfo.size = size
+        tarinfo.mtime = int(mtime)
+        tarinfo.mode = 0644
+        out.write(tarinfo.tobuf(GNU_FORMAT, 'utf-8', 'strict'))
+        if measure:
+            out.skip(size)
+        else:
+            for buf in _read_archive_entry(fileGetter, name, size):
+                out.write(buf)
+                yield out.drain()
+        remainder = size % BLOCKSIZE
+        if remainder > 0:
+            out.write(NUL * (BLOCKSIZE - remainder))
+    # Two records of zeros at the end, padded to a whole tar record
+    # (just like TarFile.close does).
+    out.write(NUL * (BLOCKSIZE * 2))
+    remainder = out.tell() % RECORDSIZE
+    if remainder > 0:
+        out.write(NUL * (RECORDSIZE - remainder))
+    yield out.drain()
+
+def _write_zip(out, files, measure=False):
+    """
+    Generator that writes a STORED zip archive of 'files' to the
+    ArchiveBuffer 'out', yielding the archive bytes as they become
+    available.  Entries use trailing data descriptors so no seeking is
+    needed.  With 'measure' the content is skipped rather than read,
+    which leaves the exact archive length in out.tell().
+    """
+    zf = StreamableZipFile(out, 'w', allowZip64=True)
+    for fileGetter, name, size, mtime in files:
+        # Zip can't represent times before 1980
+        date_time = time.localtime(max(mtime, 315532800))[0:6]
+        zinfo = zf.begin_entry(name, size, date_time)
+        CRC = 0
+        if measure:
+            out.skip(size)
+        else:
+            for buf in _read_archive_entry(fileGetter, name, size):
+                CRC = crc32(buf, CRC) & 0xffffffff
+                out.write(buf)
+                yield out.drain()
+        zf.end_entry(zinfo, CRC)
+    # Writes the central directory
+    zf.close()
+    yield out.drain()
+
+ARCHIVE_WRITERS = {
+    'tar': (_write_tar, 'application/x-tar'),
+    'zip': (_write_zip, 'application/zip'),
+}
+
+def _get_archive_length(writer, files):
+    """ Return the exact length in bytes of the archive that 'writer'
+    would produce for 'files', without reading any of them.
+    """
+    out = ArchiveBuffer(discard=True)
+    for _ in writer(out, files, measure=True):
+        pass
+    return out.tell()
 
-def _check_download_limits(mapper, datafiles, comptype):
-    (count, estimate) = _estimate_archive_size(mapper, datafiles, comptype)
-    available = _get_free_temp_space()
-    logger.debug('File count %i, estimated archive size: %i, '
-                 'available space %i' % (count, estimate, available))
+def _check_download_limits(files, length):
+    logger.debug('File count %i, archive size: %i' % (len(files), length))
     if settings.DOWNLOAD_ARCHIVE_SIZE_LIMIT > 0 and \
-            estimate > settings.DOWNLOAD_ARCHIVE_SIZE_LIMIT:
+            length > settings.DOWNLOAD_ARCHIVE_SIZE_LIMIT:
         return 'Download archive size exceeds the allowed limit: ' \
             'try a smaller download'
-    elif estimate > available + settings.DOWNLOAD_SPACE_SAFETY_MARGIN:
-        return 'Insufficient temp file space available to create' \
-            ' the archive: try a smaller download, or try again later'
-    elif count == 0:
+    elif len(files) == 0:
         return 'None of the requested files are currently available' \
             ' for download'
     else:
         return None
 
+def _create_archive_response(request, mapper, datafiles, comptype, name):
+    """
+    Build a response that streams an archive of 'datafiles' straight from
+    their replicas to the client.  Nothing is written to temporary files,
+    and because the archive length is computed in advance the response has
+    an exact Content-Length.
+    """
+    if comptype not in ARCHIVE_WRITERS:
+        return render_error_message(
+            request, 'Unsupported download format: %s' % comptype, status=404)
+    writer, mimetype = ARCHIVE_WRITERS[comptype]
+    logger.debug('Getting files to write to archive')
+    files = _get_datafile_details_for_archive(mapper, datafiles)
+    length = _get_archive_length(writer, files)
+    msg = _check_download_limits(files, length)
+    if msg:
+        return render_error_message(
+            request, 'Cannot download: %s' % msg, status=400)
+    record_access(df.id for df in datafiles)
+    response = HttpResponse(writer(ArchiveBuffer(), files),
+                            mimetype=mimetype)
+    response['Content-Length'] = str(length)
+    response['Content-Disposition'] = \
+        'attachment; filename="%s.%s"' % (name, comptype)
+    return response
+
 @experiment_download_required
 def download_experiment(request, experiment_id, comptype,
                         organization='classic'):
@@ -432,7 +751,6 @@ def download_experiment(request, experiment_id, comptype,
     takes string parameter "comptype" for compression method.
     Currently implemented: "zip" and "tar"
     """
-    # TODO: intelligent selection of temp file versus in-memory buffering.
     datafiles = Dataset_File.objects\
         .filter(dataset__experiments__id=experiment_id)
 
@@ -442,31 +760,8 @@ def download_experiment(request, experiment_id, comptype,
         return render_error_message(
             request, 'Unknown download organization: %s' % organization,
             status=400)
-    msg = _check_download_limits(mapper, datafiles, comptype)
-    if msg:
-        return render_error_message(
-            request, 'Cannot download: %s' % msg, status=400)
-
-    if comptype == "tar":
-        reader = StreamingFile(_write_tar_func(mapper, datafiles),
-                               asynchronous_file_creation=True)
-
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/x-tar')
-        response['Content-Disposition'] = 'attachment; filename="experiment' \
-            + rootdir + '-complete.tar"'
-    elif comptype == "zip":
-        reader = StreamingFile(_write_zip_func(mapper, datafiles),
-                               asynchronous_file_creation=True)
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/zip')
-
-        response['Content-Disposition'] = 'attachment; filename="experiment' \
-            + rootdir + '-complete.zip"'
-    else:
-        response = render_error_message(
-            request, 'Unsupported download format: %s' % comptype, status=404)
-    return response
+    return _create_archive_response(request, mapper, datafiles, comptype,
+                                    'experiment%s-complete' % rootdir)
 
 
 def download_datafiles(request):
@@ -480,7 +775,6 @@ def download_datafiles(request):
     """
     # Create the HttpResponse object with the appropriate headers.
     # TODO: handle no datafile, invalid filename, all http links
-    # TODO: intelligent selection of temp file versus in-memory buffering.
 
     logger.error('In download_datafiles !!')
     comptype = "zip"
@@ -497,25 +791,17 @@ def download_datafiles(request):
             datasets = request.POST.getlist('dataset')
             datafiles = request.POST.getlist('datafile')
 
-            # Generator to produce datafiles from dataset id
-            def get_dataset_datafiles(dsid):
-                for datafile in Dataset_File.objects.filter(dataset=dsid):
-                    if has_datafile_download_access(request=request,
-                                                    dataset_file_id=datafile.id):
-                        yield datafile
-
-            # Generator to produce datafile from datafile id
-            def get_datafile(dfid):
-                datafile = Dataset_File.objects.get(pk=dfid)
-                if has_datafile_download_access(request=request,
-                                                dataset_file_id=datafile.id):
-                    yield datafile
-
-            # Take chained generators and turn them into a set of datafiles
-            df_set = set(chain(chain.from_iterable(map(get_dataset_datafiles,
-                                                       datasets)),
-                               chain.from_iterable(map(get_datafile,
-                                                       datafiles))))
+            # Check access for the selection a batch at a time, rather than
+            # file by file
+            resolver = get_access_resolver(request)
+            df_set = set()
+            for ids, field in ((datasets, 'dataset__in'),
+                               (datafiles, 'pk__in')):
+                for i in range(0, len(ids), ACCESS_CHECK_BATCH_SIZE):
+                    batch = Dataset_File.objects.filter(
+                        **{field: ids[i:i + ACCESS_CHECK_BATCH_SIZE]})
+                    df_set.update(
+                        resolver.filter_downloadable_datafiles(batch))
         else:
             return render_error_message(
                 request,
@@ -558,10 +844,6 @@ def download_datafiles(request):
         return render_error_message(
             request, 'Unknown download organization: %s' % organization,
             status=400)
-    msg = _check_download_limits(mapper, df_set, comptype)
-    if msg:
-        return render_error_message(
-            request, 'Cannot download: %s' % msg, status=400)
 
     # Handle missing experiment ID - only need it for naming
     try:
@@ -569,21 +851,5 @@ def download_datafiles(request):
     except KeyError:
         expid = iter(df_set).next().dataset.get_first_experiment().id
 
-    if comptype == "tar":
-        reader = StreamingFile(_write_tar_func(mapper, df_set),
-                               asynchronous_file_creation=True)
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/x-tar')
-        response['Content-Disposition'] = \
-                'attachment; filename="experiment%s-selection.tar"' % expid
-    elif comptype == "zip":
-        reader = StreamingFile(_write_zip_func(mapper, df_set),
-                               asynchronous_file_creation=True)
-        response = HttpResponse(FileWrapper(reader),
-                                mimetype='application/zip')
-        response['Content-Disposition'] = \
-                'attachment; filename="experiment%s-selection.zip"' % expid
-    else:
-        response = render_error_message(
-            request, 'Unsupported download format: %s' % comptype, status=404)
-    return response
+    return _create_archive_response(request, mapper, df_set, comptype,
+                                    'experiment%s-selection' % expid)
@@ -341,6 +341,7 @@ class RegisterExperimentForm(forms.Form):
     experiment_owner = forms.CharField(max_length=400, required=False)
     originid = forms.CharField(max_length=400, required=False)
     from_url = forms.CharField(max_length=400, required=False)
+    bulk = forms.BooleanField(required=False)
 
 class DatasetForm(forms.ModelForm):
 
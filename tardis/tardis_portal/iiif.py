@@ -11,11 +11,17 @@ from django.views.decorators.http import etag
 from django.utils.cache import patch_cache_control
 
 from tardis.tardis_portal.models import Experiment, Dataset_File
+from tardis.tardis_portal.accesslog import record_access
 from tardis.tardis_portal.auth.decorators import has_datafile_download_access
+from tardis.tardis_portal.derivatives import get_derivative_cache, \
+    get_derivative_key
 
 from wand.exceptions import MissingDelegateError
 from wand.image import Image
 
+import logging
+logger = logging.getLogger(__name__)
+
 MAX_AGE = getattr(settings, 'DATAFILE_CACHE_MAX_AGE', 60*60*24*7)
 
 NSMAP = { None: 'http://library.stanford.edu/iiif/image-api/ns/' }
@@ -51,46 +57,46 @@ def _invalid_media_response():
     return HttpResponse(xml, status=415, mimetype='application/xml')
 
 
-def _do_resize(img, size):
-    def pct_resize(pct):
-        w, h = [int(round(n*pct)) for n in (img.width, img.height)]
-        return img.resize(w, h)
+def _get_target_size(width, height, size):
+    """
+    Return the (width, height) that the IIIF 'size' argument gives for an
+    image (or region) of the given dimensions, or None if 'size' is invalid.
+    """
+    def pct_size(pct):
+        return tuple(int(round(n*pct)) for n in (width, height))
 
     # Width (aspect ratio preserved)
     if size.endswith(','):
-        width = float(size[:-1])
-        pct_resize(width/img.width)
-        return True
+        return pct_size(float(size[:-1])/width)
     # Height (aspect ratio preserved)
     if size.startswith(','):
-        height = float(size[1:])
-        pct_resize(height/img.height)
-        return True
+        return pct_size(float(size[1:])/height)
     # Percent size (aspect ratio preserved)
     if size.startswith('pct:'):
-        pct = float(size[4:])/100
-        pct_resize(pct)
-        return True
+        return pct_size(float(size[4:])/100)
     # Width & height specified
     if ',' in size:
         if size.startswith('!'):
-            size = size[1:]
-            width, height = map(float, size.split(','))
-            image_ratio = float(img.width) / img.height
+            w, h = map(float, size[1:].split(','))
+            image_ratio = float(width) / height
             # Maximum dimensions (aspect ratio preserved)
-            if image_ratio * height > width:
+            if image_ratio * h > w:
                 # Width determines resize
-                pct_resize(width/img.width)
+                return pct_size(w/width)
             else:
                 # Height determines resize
-                pct_resize(height/img.height)
-            return True
+                return pct_size(h/height)
         else:
             # Exact dimensions *without* aspect ratio preserved
-            w, h = [int(round(float(n))) for n in size.split(',')[:2]]
-            img.resize(w, h)
-            return True
-    return False
+            return tuple(int(round(float(n))) for n in size.split(',')[:2])
+    return None
+
+def _do_resize(img, size):
+    target = _get_target_size(img.width, img.height, size)
+    if not target:
+        return False
+    img.resize(*target)
+    return True
 
 def compute_etag(request, datafile_id, *args, **kwargs):
     try:
@@ -105,6 +111,250 @@ def compute_etag(request, datafile_id, *args, **kwargs):
     import hashlib
     return hashlib.sha1(signature).hexdigest()
 
+def _transform_image(img, region, size, rotation, format):
+    """
+    Apply the IIIF region, size, rotation and format arguments to a decoded
+    image.  Returns the encoded image data, or an error response if the
+    arguments can't be applied.
+    """
+    buf = StringIO()
+    # Handle region
+    if region != 'full':
+        x, y, w, h = map(lambda x: int(x), region.split(','))
+        img.crop(x, y, width=w, height=h)
+    # Handle size
+    if size != 'full':
+        # Check the image isn't empty
+        if 0 in (img.height, img.width):
+            return _bad_request('size', 'Cannot resize empty image')
+        # Attempt resize
+        if not _do_resize(img, size):
+            return _bad_request('size',
+                                'Invalid size argument: %s' % size)
+    # Handle rotation
+    if rotation:
+        img.rotate(float(rotation))
+    # Handle format
+    if format:
+        img.format = format
+    img.save(file=buf)
+    return buf.getvalue()
+
+def _render_image(datafile, region, size, rotation, format):
+    file_obj = datafile.get_image_data()
+    if file_obj is None:
+        return HttpResponseNotFound()
+    from contextlib import closing
+    with closing(file_obj) as f:
+        with Image(file=f) as img:
+            if _needs_pyramid(img):
+                _request_pyramid(datafile)
+            return _transform_image(img, region, size, rotation, format)
+
+def _needs_pyramid(img):
+    """ Images with a side longer than IIIF_TILING_THRESHOLD pixels get a
+    tile pyramid, so that region requests don't decode the whole image.
+    """
+    return max(img.width, img.height) > \
+        getattr(settings, 'IIIF_TILING_THRESHOLD', 4096)
+
+def _get_manifest_key(datafile):
+    return get_derivative_key(datafile, 'pyramid')
+
+def _get_tile_key(datafile, scale, col, row):
+    return get_derivative_key(datafile, 'tile', scale, col, row)
+
+def get_image_manifest(datafile):
+    """
+    Return the stored description of a datafile's image: a dict with its
+    'width', 'height' and 'format', and (for large images) the 'tile_size'
+    and 'scale_factors' of its tile pyramid.  Returns None if the image
+    hasn't been described yet.
+    """
+    cache = get_derivative_cache()
+    key = _get_manifest_key(datafile)
+    if not (cache and key):
+        return None
+    data = cache.get(key)
+    if data is None:
+        return None
+    return json.loads(data)
+
+def _build_pyramid(cache, datafile, img):
+    """
+    Describe the decoded image 'img' in the derivative cache and, if it is
+    large, cut it into a tile pyramid.  Each level halves the resolution
+    of the one before, down to a level that fits in a single tile.  Tiles
+    are PNG so that no detail is lost before the final render.
+    """
+    tile_size = getattr(settings, 'IIIF_TILE_SIZE', 512)
+    manifest = {'width': img.width,
+                'height': img.height,
+                'format': img.format,
+                'tile_size': tile_size,
+                'scale_factors': []}
+    if _needs_pyramid(img):
+        level = img
+        scale = 1
+        while True:
+            for row in range((level.height + tile_size - 1) // tile_size):
+                for col in range((level.width + tile_size - 1) // tile_size):
+                    # (Clones share their pixels until modified)
+                    with level.clone() as tile:
+                        left, top = col * tile_size, row * tile_size
+                        tile.crop(left, top,
+                                  width=min(tile_size, level.width - left),
+                                  height=min(tile_size, level.height - top))
+                        tile.format = 'png'
+                        buf = StringIO()
+                        tile.save(file=buf)
+                    cache.put(_get_tile_key(datafile, scale, col, row),
+                              buf.getvalue())
+            manifest['scale_factors'].append(scale)
+            if max(level.width, level.height) <= tile_size:
+                break
+            next_level = level.clone()
+            next_level.resize((level.width + 1) // 2,
+                              (level.height + 1) // 2)
+            if level is not img:
+                level.destroy()
+            level = next_level
+            scale *= 2
+        if level is not img:
+            level.destroy()
+    # The manifest goes last, so it is only seen once the tiles exist
+    cache.put(_get_manifest_key(datafile), json.dumps(manifest))
+    return manifest
+
+def _request_pyramid(datafile):
+    """ Ask for a datafile's pyramid to be built in the background, unless
+    that has been done or asked for already.
+    """
+    cache = get_derivative_cache()
+    key = _get_manifest_key(datafile)
+    if not (cache and key) or cache.get_path(key):
+        return
+    from django.core.cache import cache as shared_cache
+    if shared_cache.add('tardis_portal.pyramid_requested.%s' % key, True,
+                        60*60):
+        from tardis.tardis_portal.tasks import generate_derivatives
+        generate_derivatives.delay(datafile.id)
+
+def _render_from_pyramid(cache, datafile, manifest, region, size, rotation,
+                         format):
+    """
+    Render a region of a large image using only the tiles that intersect
+    it, taken from the coarsest pyramid level that still has the
+    resolution needed for the requested size.  Returns the encoded image
+    data, an error response, or None if a tile has gone missing.
+    """
+    width, height = manifest['width'], manifest['height']
+    tile_size = manifest['tile_size']
+    if region == 'full':
+        x, y, w, h = 0, 0, width, height
+    else:
+        x, y, w, h = map(int, region.split(','))
+        # Clip the region to the image, as cropping would
+        w, h = min(x + w, width) - x, min(y + h, height) - y
+        if w <= 0 or h <= 0:
+            return HttpResponseNotFound()
+    if size == 'full':
+        target = (w, h)
+    else:
+        target = _get_target_size(w, h, size)
+        if not target:
+            return _bad_request('size', 'Invalid size argument: %s' % size)
+    scale = max([s for s in manifest['scale_factors']
+                 if float(w) / s >= target[0] and float(h) / s >= target[1]]
+                or [1])
+    # The region in the chosen level's coordinates, and the tiles it covers
+    left, top = x // scale, y // scale
+    right, bottom = -(-(x + w) // scale), -(-(y + h) // scale)
+    cols = range(left // tile_size, (right - 1) // tile_size + 1)
+    rows = range(top // tile_size, (bottom - 1) // tile_size + 1)
+    with Image(width=len(cols) * tile_size,
+               height=len(rows) * tile_size) as img:
+        for row in rows:
+            for col in cols:
+                data = cache.get(_get_tile_key(datafile, scale, col, row))
+                if data is None:
+                    return None
+                with Image(blob=data) as tile:
+                    img.composite(tile, (col - cols[0]) * tile_size,
+                                  (row - rows[0]) * tile_size)
+        img.crop(left - cols[0] * tile_size, top - rows[0] * tile_size,
+                 width=right - left, height=bottom - top)
+        if (img.width, img.height) != target:
+            img.resize(*target)
+        # Handle rotation
+        if rotation:
+            img.rotate(float(rotation))
+        img.format = format or manifest['format']
+        buf = StringIO()
+        img.save(file=buf)
+        return buf.getvalue()
+
+def pregenerate_images(datafile, renders=None):
+    """
+    Render an image datafile with each of the given (region, size,
+    rotation, quality, format) arguments - by default, those listed in the
+    IIIF_PREGENERATED_RENDERS setting - and store the results in the
+    derivative cache, so that page views don't have to render them.  The
+    image's manifest (and tile pyramid, if it is large) is built at the
+    same time.  The source image is only decoded once.  Returns the number
+    of new renders.
+    """
+    if renders is None:
+        renders = getattr(settings, 'IIIF_PREGENERATED_RENDERS', [])
+    cache = get_derivative_cache()
+    if not cache:
+        return 0
+    # Skip renders we already have
+    keys = [(get_derivative_key(datafile, *render), render)
+            for render in renders]
+    keys = [(key, render) for key, render in keys
+            if key and not cache.get_path(key)]
+    manifest_key = _get_manifest_key(datafile)
+    needs_manifest = manifest_key and not cache.get_path(manifest_key)
+    if not (keys or needs_manifest):
+        return 0
+    file_obj = datafile.get_image_data()
+    if file_obj is None:
+        return 0
+    count = 0
+    from contextlib import closing
+    with closing(file_obj) as f:
+        with Image(file=f) as img:
+            if needs_manifest:
+                _build_pyramid(cache, datafile, img)
+            for key, (region, size, rotation, _, format) in keys:
+                with img.clone() as copy:
+                    try:
+                        data = _transform_image(copy, region, size,
+                                                rotation, format)
+                    except (MissingDelegateError, ValueError) as e:
+                        logger.warn('Cannot render %s for datafile %s: %s' %
+                                    (size, datafile.id, e))
+                        continue
+                if isinstance(data, HttpResponse):
+                    continue
+                cache.put(key, data)
+                count += 1
+    return count
+
+def _get_cached_image_response(cache, key, mimetype):
+    # Let the web server send the cached copy if we can
+    filepath = cache.get_path(key)
+    if filepath:
+        from tardis.tardis_portal.download import get_offload_response
+        response = get_offload_response(filepath, mimetype)
+        if response:
+            return response
+    data = cache.get(key)
+    if data is None:
+        return None
+    return HttpResponse(data, mimetype=mimetype)
+
 @etag(compute_etag)
 @compliance_header
 def download_image(request, datafile_id, region, size, rotation,
@@ -122,61 +372,61 @@ def download_image(request, datafile_id, region, size, rotation,
                                             dataset_file_id=datafile.id):
             return HttpResponseNotFound()
 
-    buf = StringIO()
-    try:
-        file_obj = datafile.get_image_data()
-        if file_obj is None:
-            return HttpResponseNotFound()
-        from contextlib import closing
-        with closing(file_obj) as f:
-            with Image(file=f) as img:
-                # Handle region
-                if region != 'full':
-                    x, y, w, h = map(lambda x: int(x), region.split(','))
-                    img.crop(x, y, width=w, height=h)
-                # Handle size
-                if size != 'full':
-                    # Check the image isn't empty
-                    if 0 in (img.height, img.width):
-                        return _bad_request('size', 'Cannot resize empty image')
-                    # Attempt resize
-                    if not _do_resize(img, size):
-                        return _bad_request('size',
-                                            'Invalid size argument: %s' % size)
-                # Handle rotation
-                if rotation:
-                    img.rotate(float(rotation))
-                # Handle quality (mostly by rejecting it)
-                if not quality in ['native', 'color']:
-                    return _get_iiif_error('quality',
-                    'This server does not support greyscale or bitonal quality.')
-                # Handle format
-                if format:
-                    mimetype = mimetypes.types_map['.%s' % format.lower()]
-                    img.format = format
-                    if not mimetype in ALLOWED_MIMETYPES:
-                        return _invalid_media_response()
-                else:
-                    mimetype = datafile.get_mimetype()
-                    # If the native format is not allowed, pretend it doesn't exist.
-                    if not mimetype in ALLOWED_MIMETYPES:
-                        return HttpResponseNotFound()
-                img.save(file=buf)
-                response = HttpResponse(buf.getvalue(), mimetype=mimetype)
-                response['Content-Disposition'] = \
-                    'inline; filename="%s.%s"' % (datafile.filename, format)
-                # Set Cache
-                if is_public:
-                    patch_cache_control(response, public=True, max_age=MAX_AGE)
-                else:
-                    patch_cache_control(response, private=True, max_age=MAX_AGE)
-                return response
-    except MissingDelegateError:
-        if format:
+    # Handle quality (mostly by rejecting it)
+    if not quality in ['native', 'color']:
+        return _get_iiif_error('quality',
+        'This server does not support greyscale or bitonal quality.')
+    # Handle format
+    if format:
+        mimetype = mimetypes.types_map['.%s' % format.lower()]
+        if not mimetype in ALLOWED_MIMETYPES:
             return _invalid_media_response()
-        return HttpResponseNotFound()
-    except ValueError:
-        return HttpResponseNotFound()
+    else:
+        mimetype = datafile.get_mimetype()
+        # If the native format is not allowed, pretend it doesn't exist.
+        if not mimetype in ALLOWED_MIMETYPES:
+            return HttpResponseNotFound()
+
+    # Renders are only ever decoded once per cache lifetime
+    cache = get_derivative_cache()
+    key = get_derivative_key(datafile, region, size, rotation, quality,
+                             format)
+    response = None
+    if cache and key:
+        response = _get_cached_image_response(cache, key, mimetype)
+    if not response:
+        try:
+            data = None
+            manifest = get_image_manifest(datafile)
+            if manifest and manifest['scale_factors']:
+                data = _render_from_pyramid(cache, datafile, manifest, region,
+                                            size, rotation, format)
+                if data is None:
+                    # Tiles have been evicted; the pyramid must be rebuilt
+                    cache.delete(_get_manifest_key(datafile))
+            if data is None:
+                data = _render_image(datafile, region, size, rotation,
+                                     format)
+        except MissingDelegateError:
+            if format:
+                return _invalid_media_response()
+            return HttpResponseNotFound()
+        except ValueError:
+            return HttpResponseNotFound()
+        if isinstance(data, HttpResponse):
+            return data
+        if cache and key:
+            cache.put(key, data)
+        response = HttpResponse(data, mimetype=mimetype)
+    record_access([datafile.id])
+    response['Content-Disposition'] = \
+        'inline; filename="%s.%s"' % (datafile.filename, format)
+    # Set Cache
+    if is_public:
+        patch_cache_control(response, public=True, max_age=MAX_AGE)
+    else:
+        patch_cache_control(response, private=True, max_age=MAX_AGE)
+    return response
 
 
 @etag(compute_etag)
@@ -192,15 +442,25 @@ def download_info(request, datafile_id, format): #@ReservedAssignment
                                         dataset_file_id=datafile.id):
         return HttpResponseNotFound()
 
-    file_obj = datafile.get_file()
-    if file_obj == None:
-        return HttpResponseNotFound()
-    from contextlib import closing
-    with closing(file_obj) as f:
-        with Image(file=f) as img:
-            data = {'identifier': datafile.id,
-                    'height': img.height,
-                    'width':  img.width }
+    manifest = get_image_manifest(datafile)
+    if manifest:
+        data = {'identifier': datafile.id,
+                'height': manifest['height'],
+                'width': manifest['width']}
+        if manifest['scale_factors']:
+            data['tile_width'] = manifest['tile_size']
+            data['tile_height'] = manifest['tile_size']
+            data['scale_factors'] = manifest['scale_factors']
+    else:
+        file_obj = datafile.get_file()
+        if file_obj == None:
+            return HttpResponseNotFound()
+        from contextlib import closing
+        with closing(file_obj) as f:
+            with Image(file=f) as img:
+                data = {'identifier': datafile.id,
+                        'height': img.height,
+                        'width':  img.width }
 
     if format == 'xml':
         info = Element('info', nsmap=NSMAP)
@@ -210,6 +470,14 @@ def download_info(request, datafile_id, format): #@ReservedAssignment
         height.text = str(data['height'])
         width = SubElement(info, 'width')
         width.text = str(data['width'])
+        if 'scale_factors' in data:
+            tile_width = SubElement(info, 'tile_width')
+            tile_width.text = str(data['tile_width'])
+            tile_height = SubElement(info, 'tile_height')
+            tile_height.text = str(data['tile_height'])
+            scale_factors = SubElement(info, 'scale_factors')
+            for scale in data['scale_factors']:
+                SubElement(scale_factors, 'scale_factor').text = str(scale)
         return HttpResponse(etree.tostring(info, method='xml'),
                             mimetype="application/xml")
     if format == 'json':
@@ -0,0 +1,87 @@
+"""
+Management command to measure how fast files can be checksummed
+"""
+
+import hashlib
+import os
+import time
+from optparse import make_option
+from tempfile import NamedTemporaryFile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tardis.tardis_portal.util import generate_file_checksums
+
+
+def _serial_checksums(sourceFile, tempFile):
+    """ Checksum a file the way generate_file_checksums used to: in small
+    chunks, on one thread. """
+    with sourceFile as f:
+        md5 = hashlib.new('md5')
+        sha512 = hashlib.new('sha512')
+        size = 0
+        mimetype_buffer = ''
+        for chunk in iter(lambda: f.read(32 * sha512.block_size), ''):
+            size += len(chunk)
+            if len(mimetype_buffer) < 8096:
+                mimetype_buffer += chunk
+            md5.update(chunk)
+            sha512.update(chunk)
+    return (md5.hexdigest(), sha512.hexdigest(), size, mimetype_buffer)
+
+
+METHODS = (
+    ('serial', _serial_checksums),
+    ('pipelined', generate_file_checksums),
+    ('pipelined+mmap',
+     lambda f, t: generate_file_checksums(f, t, use_mmap=True)),
+)
+
+
+class Command(BaseCommand):
+    args = '[<file> ...]'
+    help = """Checksum the given files (or a temporary file of random data)
+with the old serial method and the current pipelined one, and report the
+throughput of each.  Each file is read once before timing, so the results
+show hashing speed on cached data; use files larger than memory to include
+the disk."""
+    option_list = BaseCommand.option_list + (
+        make_option('--size',
+                    type='int',
+                    dest='size',
+                    default=2048,
+                    help="The size in MiB of the temporary file " \
+                        "(default 2048)"),
+        )
+
+    def handle(self, *args, **options):
+        if args:
+            for filename in args:
+                if not os.path.isfile(filename):
+                    raise CommandError('%s is not a file' % filename)
+                self._benchmark(filename)
+            return
+        with NamedTemporaryFile() as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in xrange(options['size']):
+                f.write(chunk)
+            f.flush()
+            self._benchmark(f.name)
+
+    def _benchmark(self, filename):
+        size = os.path.getsize(filename)
+        self.stdout.write('%s (%.0f MiB)\n' % (filename,
+                                                size / (1024.0 * 1024)))
+        # Warm the page cache, so the first method isn't penalised
+        _serial_checksums(open(filename, 'rb'), None)
+        expected = None
+        for name, method in METHODS:
+            start = time.time()
+            result = method(open(filename, 'rb'), None)
+            elapsed = max(time.time() - start, 0.001)
+            if expected is None:
+                expected = result
+            elif result != expected:
+                raise CommandError('%s gave different checksums' % name)
+            self.stdout.write('  %-16s %8.1f MB/s\n' % (
+                name, size / elapsed / (1024 * 1024)))
@@ -0,0 +1,130 @@
+"""
+Management command to compare the parameter search with the chained joins it
+replaced
+"""
+
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Min, Max
+
+from tardis.tardis_portal.models import Experiment, Dataset_File, Schema, \
+    ParameterName, DatafileParameter, DatasetParameter, ExperimentParameter
+from tardis.tardis_portal.parameter_search import filter_by_parameters
+
+
+# For each schema type: the model searched, the parameter model, the owner
+# field of its parameter sets, the path from the searched model to the
+# parameters, and the lookup relating the searched model to the owners
+TARGETS = {
+    Schema.DATAFILE: (Dataset_File, DatafileParameter, 'dataset_file',
+                      'datafileparameterset__datafileparameter', 'pk__in'),
+    Schema.DATASET: (Dataset_File, DatasetParameter, 'dataset',
+                     'dataset__datasetparameterset__datasetparameter',
+                     'dataset__in'),
+    Schema.EXPERIMENT: (Experiment, ExperimentParameter, 'experiment',
+                        'experimentparameterset__experimentparameter',
+                        'pk__in'),
+}
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ANALYZE ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+def _chained(queryset, paramType, constraints):
+    """ Filter the way the search views used to: with another join to the
+    parameters for each constraint. """
+    for name_id, lookup, value in constraints:
+        queryset = queryset.filter(**{paramType + '__name__id': name_id,
+                                      paramType + '__' + lookup: value})
+    return queryset
+
+
+class Command(BaseCommand):
+    args = '<schema-namespace>'
+    help = """Search by every numeric parameter of the schema with the given
+namespace, with each constrained to the range of its values, both with the
+chained joins the search views used to use and with the current parameter
+search.  Report how long each takes and check that they agree.  With
+--explain, also show the database's query plans."""
+    option_list = BaseCommand.option_list + (
+        make_option('--explain',
+                    action='store_true',
+                    dest='explain',
+                    default=False,
+                    help="Show the query plans"),
+        make_option('--repeat',
+                    type='int',
+                    dest='repeat',
+                    default=3,
+                    help="Run each query this many times, and report the " \
+                        "fastest (default 3)"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected a schema namespace')
+        try:
+            schema = Schema.objects.get(namespace=args[0])
+        except Schema.DoesNotExist:
+            raise CommandError('No schema with namespace %s' % args[0])
+        if schema.type not in TARGETS:
+            raise CommandError('Only experiment, dataset and datafile '
+                               'schemas can be searched')
+        model, parameter_model, owner, paramType, lookup = \
+            TARGETS[schema.type]
+
+        constraints = []
+        for name in ParameterName.objects.filter(
+                schema=schema, data_type=ParameterName.NUMERIC):
+            bounds = parameter_model.objects.filter(name=name) \
+                .aggregate(low=Min('numerical_value'),
+                           high=Max('numerical_value'))
+            if bounds['low'] is not None:
+                constraints.append((name.id, 'numerical_value__range',
+                                    (bounds['low'], bounds['high'])))
+        if not constraints:
+            raise CommandError('The schema has no numeric parameter values')
+        self.stdout.write('%d constraints\n' % len(constraints))
+
+        queries = (
+            ('chained', _chained(model.objects.all(), paramType,
+                                 constraints)),
+            ('pushed-down', filter_by_parameters(model.objects.all(),
+                                                 parameter_model, owner,
+                                                 constraints, lookup)),
+        )
+        expected = None
+        for name, queryset in queries:
+            ids = queryset.values_list('id', flat=True)
+            elapsed = None
+            for _ in range(max(options['repeat'], 1)):
+                start = time.time()
+                result = set(ids.all())
+                duration = time.time() - start
+                if elapsed is None or duration < elapsed:
+                    elapsed = duration
+            if expected is None:
+                expected = result
+            elif result != expected:
+                raise CommandError('%s found different results' % name)
+            self.stdout.write('  %-12s %8.3f s  %d results\n' %
+                              (name, elapsed, len(result)))
+            if options['explain']:
+                self._explain(ids)
+
+    def _explain(self, queryset):
+        prefix = EXPLAIN.get(connection.vendor)
+        if prefix is None:
+            raise CommandError("Can't show query plans for %s" %
+                               connection.vendor)
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute(prefix + sql, params)
+        for row in cursor.fetchall():
+            self.stdout.write('    %s\n' % ' | '.join(map(unicode, row)))
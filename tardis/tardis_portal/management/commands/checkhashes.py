@@ -1,73 +1,94 @@
 """
-Management utility to create a token user
+Management command to check stored files against their checksums
 """
 
-import hashlib
-from contextlib import closing
-from urllib2 import urlopen
+from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
-from tardis.tardis_portal.models import Dataset_File
 
-CHUNK_SIZE = 32*1024
+from tardis.tardis_portal.models import Replica, FixityCheck
+from tardis.tardis_portal.verification import VerificationEngine
 
-class AlgorithmNotSupported(Exception):
-    pass
-
-class NoHashAvailable(Exception):
-    pass
-
-class ValidationFailed(Exception):
-    pass
 
 class Command(BaseCommand):
-
-    help = 'Used to check file hashes against actual files.'
+    args = '[<dataset-id> ...]'
+    help = """Check the replicas of the datafiles in the given datasets (or in
+all datasets) against the datafiles' checksums and sizes, and list those that
+fail.  With --checkpoint, an interrupted run can be resumed by running the
+command again with the same checkpoint file; delete the file to start
+afresh."""
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', '-p',
+                    type='int',
+                    dest='processes',
+                    default=4,
+                    help="The number of files to read in parallel " \
+                        "(default 4)"),
+        make_option('--location-limit',
+                    action='append',
+                    dest='location_limits',
+                    default=[],
+                    metavar='LOCATION=N',
+                    help="Read at most N files from the named location " \
+                        "at once (may be repeated)"),
+        make_option('--checkpoint',
+                    dest='checkpoint',
+                    default=None,
+                    metavar='FILE',
+                    help="Keep a checkpoint in FILE, and resume from it"),
+        make_option('--update',
+                    action='store_true',
+                    dest='update',
+                    default=False,
+                    help="Mark the replicas that pass as verified, fill " \
+                        "in missing checksums and sizes, and record the " \
+                        "results in the fixity ledger"),
+        )
 
     def handle(self, *args, **options):
         verbosity = int(options.get('verbosity', 1))
-
-        for df in Dataset_File.objects.all():
-            for algorithm in ('sha512', 'md5'):
-                try:
-                    validate_digest(algorithm, df)
-                    # Success, so don't try another
-                    break
-                except AlgorithmNotSupported:
-                    continue
-                except NoHashAvailable:
-                    continue
-                except ValidationFailed:
-                    self.stdout.write("%d/%s: FAILED\n" % (df.dataset.id, df))
-                if verbosity > 1:
-                    self.stdout.write("%d/%s: OK\n" % (df.dataset.id, df))
-
-
-
-def validate_digest(algorithm, datafile):
-    try:
-        expected = getattr(datafile, "%ssum" % algorithm)
-    except AttributeError:
-        raise AlgorithmNotSupported()
-
-    if not expected:
-        raise NoHashAvailable()
-
-    url = datafile.get_actual_url()
-    if not url:
-        raise ValidationFailed()
-
-    digest = getattr(hashlib, algorithm)()
-    with closing(urlopen(url)) as f:
-        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
-            digest.update(chunk)
-
-    if expected != digest.hexdigest():
-        raise ValidationFailed
-
-
-
-
-
-
-
+        processes = options['processes']
+        if processes < 1:
+            raise CommandError('--processes must be at least 1')
+        location_limits = {}
+        for limit in options['location_limits']:
+            try:
+                name, value = limit.rsplit('=', 1)
+                location_limits[name] = int(value)
+            except ValueError:
+                raise CommandError('--location-limit must be LOCATION=N')
+        replicas = Replica.objects.all()
+        if args:
+            try:
+                replicas = replicas.filter(
+                    datafile__dataset__id__in=[int(arg) for arg in args])
+            except ValueError:
+                raise CommandError('Dataset ids must be integers')
+
+        def report(progress):
+            if verbosity > 0:
+                self.stdout.write('%s\n' % progress)
+
+        def show_result(result):
+            if options['update']:
+                FixityCheck.record(result)
+            if result.ok and verbosity < 2:
+                return
+            try:
+                replica = Replica.objects.select_related('datafile') \
+                                         .get(id=result.replica_id)
+                name = '%d/%s (%s)' % (replica.datafile.dataset_id,
+                                       replica.datafile, replica.url)
+            except Replica.DoesNotExist:
+                name = 'replica %d' % result.replica_id
+            if result.ok:
+                self.stdout.write('%s: OK\n' % name)
+            else:
+                self.stdout.write('%s: FAILED (%s)\n' % (name, result.error))
+
+        engine = VerificationEngine(processes=processes,
+                                    location_limits=location_limits or None,
+                                    checkpoint=options['checkpoint'],
+                                    update=options['update'],
+                                    report=report)
+        engine.run(replicas, callback=show_result)
@@ -0,0 +1,70 @@
+"""
+Management command to render the IIIF_PREGENERATED_RENDERS for existing
+image datafiles, so that their thumbnails are ready before anyone looks.
+"""
+
+import logging
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tardis.tardis_portal.models import Dataset_File
+from tardis.tardis_portal.models.datafile import IMAGE_FILTER
+
+logger = logging.getLogger(__name__)
+
+
+def _pregenerate(datafile_id):
+    from tardis.tardis_portal.iiif import pregenerate_images
+    try:
+        return pregenerate_images(Dataset_File.objects.get(id=datafile_id))
+    except Exception:
+        # One bad image shouldn't stop the rest of the run
+        logger.exception('Unable to render datafile %s' % datafile_id)
+        return 0
+
+
+class Command(BaseCommand):
+    args = '[<dataset-id> ...]'
+    help = """Render the IIIF_PREGENERATED_RENDERS into the image cache for
+the image datafiles in the given datasets (or in all datasets).  Renders
+that are already cached are skipped, so the command can be re-run."""
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', '-p',
+                    type='int',
+                    dest='processes',
+                    default=4,
+                    help="The number of images to render in parallel " \
+                        "(default 4)"),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        processes = options['processes']
+        if processes < 1:
+            raise CommandError('--processes must be at least 1')
+        datafiles = Dataset_File.objects.filter(IMAGE_FILTER)
+        if args:
+            try:
+                datafiles = datafiles.filter(
+                    dataset__id__in=[int(arg) for arg in args])
+            except ValueError:
+                raise CommandError('Dataset ids must be integers')
+        ids = list(datafiles.distinct().values_list('id', flat=True))
+        if verbosity > 0:
+            self.stdout.write('Rendering %d image datafiles\n' % len(ids))
+        if processes == 1:
+            results = map(_pregenerate, ids)
+        else:
+            # The workers must not share the parent's database connection
+            connection.close()
+            pool = Pool(processes)
+            try:
+                results = pool.map(_pregenerate, ids, chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+        if verbosity > 0:
+            self.stdout.write('Created %d new renders\n' % sum(results))
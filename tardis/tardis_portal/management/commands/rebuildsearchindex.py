@@ -0,0 +1,109 @@
+"""
+Management command to rebuild the search index using several processes
+"""
+
+from multiprocessing import Pool, cpu_count
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tardis.tardis_portal.models import Dataset_File
+
+
+def _index_batch(datafile_ids):
+    from tardis.tardis_portal.search_indexes import index_datafiles
+    index_datafiles(datafile_ids, commit=False)
+    return len(datafile_ids)
+
+
+class Command(BaseCommand):
+    args = '[<dataset-id> ...]'
+    help = """Index the datafiles in the given datasets (or all datafiles),
+in batches spread over several processes, and commit the index once at the
+end.  Without dataset ids the index is cleared first, as with haystack's
+rebuild_index.  With --parameter-name, only the datafiles with parameters
+of the given names (in the datafiles themselves or their datasets or
+experiments) are indexed, e.g. after making the names searchable."""
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', '-p',
+                    type='int',
+                    dest='processes',
+                    default=cpu_count(),
+                    help="The number of batches to index at once " \
+                        "(default: the number of CPUs)"),
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=500,
+                    help="The number of datafiles in each batch " \
+                        "(default 500)"),
+        make_option('--parameter-name',
+                    action='append',
+                    type='int',
+                    dest='parameter_names',
+                    default=[],
+                    metavar='ID',
+                    help="Only index the datafiles with parameters of the " \
+                        "ParameterName with this id (may be repeated)"),
+        make_option('--noinput',
+                    action='store_false',
+                    dest='interactive',
+                    default=True,
+                    help="Don't ask for confirmation before clearing " \
+                        "the index"),
+        )
+
+    def handle(self, *args, **options):
+        from haystack import site
+        verbosity = int(options.get('verbosity', 1))
+        processes = options['processes']
+        batch_size = options['batch_size']
+        if processes < 1 or batch_size < 1:
+            raise CommandError('--processes and --batch-size must be at '
+                               'least 1')
+        datafiles = Dataset_File.objects.all()
+        if args:
+            try:
+                datafiles = datafiles.filter(
+                    dataset__id__in=[int(arg) for arg in args])
+            except ValueError:
+                raise CommandError('Dataset ids must be integers')
+        ids = list(datafiles.order_by('id').values_list('id', flat=True))
+        partial = bool(args or options['parameter_names'])
+        if options['parameter_names']:
+            from tardis.tardis_portal.search_indexes import \
+                get_datafiles_with_parameters
+            ids = sorted(set(ids) & set(get_datafiles_with_parameters(
+                options['parameter_names'])))
+        batches = [ids[i:i + batch_size]
+                   for i in range(0, len(ids), batch_size)]
+
+        index = site.get_index(Dataset_File)
+        if not partial:
+            if options['interactive'] and \
+                    raw_input('This will remove every datafile from the '
+                              'search index.  Continue? [y/N] ') \
+                    .lower() not in ('y', 'yes'):
+                return
+            index.backend.clear(models=[Dataset_File])
+
+        done = 0
+        if processes == 1:
+            results = (_index_batch(batch) for batch in batches)
+        else:
+            # The workers must not share this process's database connection
+            connection.close()
+            pool = Pool(processes)
+            results = pool.imap_unordered(_index_batch, batches)
+        for count in results:
+            done += count
+            if verbosity > 1:
+                self.stdout.write('Indexed %d of %d datafiles\n' %
+                                  (done, len(ids)))
+        if processes > 1:
+            pool.close()
+            pool.join()
+        index.backend.conn.commit()
+        if verbosity > 0:
+            self.stdout.write('Indexed %d datafiles\n' % done)
@@ -12,7 +12,7 @@ from django.db.models import Q
 from django.core.exceptions import PermissionDenied
 from django.contrib.auth.models import User, Group
 
-from tardis.tardis_portal.models import ObjectACL
+from tardis.tardis_portal.models import ObjectACL, ExperimentAccess
 from tardis.tardis_portal.auth.localdb_auth import django_user
 
 
@@ -58,46 +58,45 @@ class ExperimentManager(OracleSafeManager):
         :type request: :py:class:`django.http.HttpRequest`
         """
 
-        query = self._query_all_public() |\
-            self._query_owned_and_shared(user)
-
         return super(ExperimentManager, self).get_query_set().filter(
-            query).distinct()
+            self._query_accessible(user, include_public=True))
 
     def owned_and_shared(self, user):
         return super(ExperimentManager, self).get_query_set().filter(
-            self._query_owned_and_shared(user)).distinct()
+            self._query_owned_and_shared(user))
 
-    def _query_owned_and_shared(self, user):
-        # if the user is not authenticated, nothing should be returned
+    def _get_entity_keys(self, user):
+        """
+        Return the ExperimentAccess keys of the user and the groups they
+        belong to.
+        """
+        # if the user is not authenticated, they are no one in particular
         if not user.is_authenticated():
+            return []
+        keys = [ExperimentAccess.get_entity_key(django_user, user.id)]
+        keys += [ExperimentAccess.get_entity_key(name, group)
+                 for name, group in user.get_profile().ext_groups]
+        return keys
+
+    def _query_accessible(self, user, include_public=False):
+        keys = self._get_entity_keys(user)
+        if include_public:
+            keys.append(ExperimentAccess.get_entity_key(
+                *ExperimentAccess.PUBLIC_ENTITY))
+        if not keys:
             return Q(id=None)
+        # (The subquery can't match an experiment twice, so unlike a join
+        # it doesn't need a 'distinct')
+        return Q(id__in=ExperimentAccess.objects.filter(entity__in=keys)
+                                                .values('experiment'))
 
-        # for which experiments does the user have read access
-        # based on USER permissions?
-        query = Q(objectacls__pluginId=django_user,
-                  objectacls__entityId=str(user.id),
-                  objectacls__canRead=True) &\
-            (Q(objectacls__effectiveDate__lte=datetime.today())
-             | Q(objectacls__effectiveDate__isnull=True)) &\
-            (Q(objectacls__expiryDate__gte=datetime.today())
-             | Q(objectacls__expiryDate__isnull=True))
-
-        # for which does experiments does the user have read access
-        # based on GROUP permissions
-        for name, group in user.get_profile().ext_groups:
-            query |= Q(objectacls__pluginId=name,
-                       objectacls__entityId=str(group),
-                       objectacls__canRead=True) &\
-                (Q(objectacls__effectiveDate__lte=datetime.today())
-                 | Q(objectacls__effectiveDate__isnull=True)) &\
-                (Q(objectacls__expiryDate__gte=datetime.today())
-                 | Q(objectacls__expiryDate__isnull=True))
-        return query
-
-    def _query_all_public(self):
-        from tardis.tardis_portal.models import Experiment
-        return ~Q(public_access=Experiment.PUBLIC_ACCESS_NONE)
+    def _query_owned_and_shared(self, user):
+        """
+        Query for the experiments which the user can read, based on USER
+        and GROUP permissions.  Effective and expiry dates are taken into
+        account by the ExperimentAccess index.
+        """
+        return self._query_accessible(user)
 
     def get(self, user, experiment_id):
         """
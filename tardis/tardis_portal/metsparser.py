@@ -83,6 +83,8 @@ recommends.
 import hashlib
 import logging
 import re
+import time
+from contextlib import contextmanager
 
 from xml.sax import SAXParseException, ContentHandler
 from xml.sax.handler import feature_namespaces
@@ -90,15 +92,187 @@ from xml.sax import make_parser
 
 from tardis.tardis_portal import metsstruct
 from tardis.tardis_portal import models
+from tardis.tardis_portal.models.datafile import parse_size
+from tardis.tardis_portal.stats import add_to_site_stats
 from tardis.tardis_portal.metshandler import store_metadata_value
 from tardis.tardis_portal.staging import \
     get_sync_root, get_sync_location, get_sync_url_and_protocol
 
 from django.conf import settings
+from django.db.models import Max
+from django.db.models.signals import pre_save
 
 
 logger = logging.getLogger(__name__)
 
+# The number of rows per INSERT statement in a bulk ingest (which keeps
+# statements within SQLite's limit on parameters)
+BULK_INSERT_BATCH_SIZE = 100
+
+
+class BulkIngest(object):
+    '''Collects the datafiles, replicas and parameters created by a METS
+    ingest, so that they can be written with batched inserts at the end of
+    the parse rather than saved one at a time.
+
+    Batched inserts don't send post_save signals, so the work those signals
+    would have done - indexing the new datafiles for search and publishing
+    the experiment's RIF-CS - is done once, by finish(), after the ingest's
+    transaction has committed.  (Datafile filters only run on verified
+    replicas, so they run later anyway.)  The size rollups of the datasets
+    and experiment are updated by flush(), within the transaction, and the
+    cached site statistics by finish().
+
+    The time taken by each phase of the ingest is recorded in 'timings'.
+
+    '''
+
+    def __init__(self):
+        self.experiment = None
+        self.timings = []
+        # {dataset id: [(datafile, replica)]}
+        self._datafiles = {}
+        # {(dataset id, filename, size): datafile}
+        self._datafile_lookup = {}
+        self._parametersets = []
+        self._parameters = []
+        self._datafile_ids = []
+        self._datafile_size = 0
+        self._has_experiment_parameters = False
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings.append((name, time.time() - start))
+
+    def report(self):
+        return ', '.join('%s: %.2fs' % timing for timing in self.timings)
+
+    def get_datafile(self, dataset, filename, size):
+        '''Return the pending datafile with the given name and size, or None.
+        '''
+        return self._datafile_lookup.get((dataset.id, filename, size))
+
+    def add_datafile(self, datafile, replica):
+        datafile.size_bytes = parse_size(datafile.size)
+        self._datafiles.setdefault(datafile.dataset.id, []) \
+                       .append((datafile, replica))
+        key = (datafile.dataset.id, datafile.filename, datafile.size)
+        self._datafile_lookup[key] = datafile
+
+    def add_parameterset(self, parameterset):
+        self._parametersets.append(parameterset)
+
+    def add_parameter(self, parameter):
+        # Parameters may need preparing, e.g. to store images
+        pre_save.send(sender=parameter.__class__, instance=parameter,
+                      raw=False, using=None)
+        self._parameters.append(parameter)
+
+    def _insert(self, model, objs, key=(), **scope):
+        '''Insert the objects in batches.  If key fields are given, the ids
+        of the new rows are read back and set on the objects: the rows in
+        the scope added since the insert began are matched to the objects by
+        those fields (objects with the same key taking the ids in the order
+        they were inserted).
+        '''
+        if key and objs:
+            before = model.objects.filter(**scope) \
+                                  .aggregate(last=Max('id'))['last'] or 0
+        for i in range(0, len(objs), BULK_INSERT_BATCH_SIZE):
+            model.objects.bulk_create(objs[i:i + BULK_INSERT_BATCH_SIZE])
+        if not (key and objs):
+            return
+        attnames = [model._meta.get_field(name).attname for name in key]
+        pending = {}
+        for obj in objs:
+            obj_key = tuple(unicode(getattr(obj, attname))
+                            for attname in attnames)
+            pending.setdefault(obj_key, []).append(obj)
+        rows = model.objects.filter(id__gt=before, **scope).order_by('id') \
+                            .values_list('id', *key)
+        for row in rows.iterator():
+            waiting = pending.get(tuple(unicode(value) for value in row[1:]))
+            if waiting:
+                waiting.pop(0).id = row[0]
+        if any(pending.values()):
+            raise Exception("Can't find the new %s rows" % model.__name__)
+
+    def flush(self):
+        '''Write everything collected so far.
+        '''
+        with self.phase('datafiles'):
+            for dataset_id, pending in self._datafiles.items():
+                datafiles = [datafile for datafile, _ in pending]
+                self._insert(models.Dataset_File, datafiles,
+                             key=('filename', 'size'), dataset=dataset_id)
+                self._datafile_ids += [datafile.id for datafile in datafiles]
+                for datafile, replica in pending:
+                    replica.datafile_id = datafile.id
+                self._insert(models.Replica,
+                             [replica for _, replica in pending])
+            self._datafile_size += sum(datafile.size_bytes or 0
+                                       for pending in self._datafiles.values()
+                                       for datafile, _ in pending)
+            dataset_ids = self._datafiles.keys()
+            models.DatasetRollup.update_for(dataset_ids)
+            models.ExperimentRollup.update_for(
+                models.Experiment.objects.filter(datasets__in=dataset_ids)
+                                         .values_list('id', flat=True))
+        with self.phase('parameters'):
+            by_dataset = {}
+            for parameterset in self._parametersets:
+                parameterset.dataset_file_id = parameterset.dataset_file.id
+                by_dataset.setdefault(parameterset.dataset_file.dataset_id,
+                                      []).append(parameterset)
+            for dataset_id, parametersets in by_dataset.items():
+                self._insert(models.DatafileParameterSet, parametersets,
+                             key=('dataset_file', 'schema'),
+                             dataset_file__dataset=dataset_id)
+            by_class = {}
+            for parameter in self._parameters:
+                parameter.parameterset_id = parameter.parameterset.id
+                by_class.setdefault(parameter.__class__, []) \
+                        .append(parameter)
+            for model, parameters in by_class.items():
+                self._insert(model, parameters)
+        if models.ExperimentParameter in by_class:
+            self._has_experiment_parameters = True
+        self._datafiles = {}
+        self._datafile_lookup = {}
+        self._parametersets = []
+        self._parameters = []
+
+    def finish(self):
+        '''Do the work deferred from the (committed) ingest.
+        '''
+        with self.phase('post-commit'):
+            if self._has_experiment_parameters:
+                from tardis.tardis_portal.models.hooks import \
+                    publish_public_expt_rifcs
+                publish_public_expt_rifcs(self.experiment)
+            add_to_site_stats(datafile_count=len(self._datafile_ids),
+                              datafile_size=self._datafile_size)
+            self._update_search_index()
+        logger.info('METS bulk ingest of experiment %s: %s' %
+                    (self.experiment and self.experiment.id, self.report()))
+
+    def _update_search_index(self):
+        if 'haystack' not in settings.INSTALLED_APPS:
+            return
+        from haystack import site
+        from haystack.exceptions import NotRegistered
+        try:
+            index = site.get_index(models.Dataset_File)
+        except NotRegistered:
+            return
+        for i in range(0, len(self._datafile_ids), BULK_INSERT_BATCH_SIZE):
+            index.backend.update(index, models.Dataset_File.objects.filter(
+                id__in=self._datafile_ids[i:i + BULK_INSERT_BATCH_SIZE]))
+
 
 class MetsDataHolder():
     '''An instance of this class is used by MetsExperimentStructCreator and
@@ -315,8 +489,10 @@ class MetsMetadataInfoHandler(ContentHandler):
     '''
 
     def __init__(self, holder, tardisExpId, createdBy,
-                 syncRootDir, syncLocation):
+                 syncRootDir, syncLocation, bulk=None):
         self.holder = holder
+        # if given, the BulkIngest to collect datafiles and parameters in
+        self.bulk = bulk
         self.tardisExpId = tardisExpId
         self.createdBy = createdBy
         self.syncRootDir = syncRootDir
@@ -503,6 +679,8 @@ class MetsMetadataInfoHandler(ContentHandler):
                 self.modelExperiment.save()
 
                 self.holder.experimentDatabaseId = self.modelExperiment.id
+                if self.bulk:
+                    self.bulk.experiment = self.modelExperiment
 
                 x = 0
                 for author in self.metsObject.authors:
@@ -618,15 +796,18 @@ class MetsMetadataInfoHandler(ContentHandler):
                             sha512sum=checksum(df,
                                            'SHA-512'))
 
-                        logger.info('=== saving datafile: %s' % df.name)
-                        self.modelDatafile.save() 
-
                         replica = models.Replica(
-                            datafile=self.modelDatafile,
                             url=sync_url,
                             protocol=proto,
                             location=self.syncLocation)
-                        replica.save()
+                        if self.bulk:
+                            self.bulk.add_datafile(self.modelDatafile,
+                                                   replica)
+                        else:
+                            logger.info('=== saving datafile: %s' % df.name)
+                            self.modelDatafile.save()
+                            replica.datafile = self.modelDatafile
+                            replica.save()
 
 
         elif elName == 'techMD' and self.inAmdSec:
@@ -735,11 +916,17 @@ class MetsMetadataInfoHandler(ContentHandler):
                                 self.metsObject.dataset.id]
 
                             # also check if the file already exists
+                            # (including files still pending in a bulk
+                            # ingest)
+                            pending = self.bulk and self.bulk.get_datafile(
+                                thisFilesDataset, self.metsObject.name,
+                                self.metsObject.size or 0)
                             datafile = thisFilesDataset.dataset_file_set.filter(
                                 filename=self.metsObject.name, size=self.metsObject.size)
 
-
-                            if datafile.count() == 0:
+                            if pending:
+                                self.modelDatafile = pending
+                            elif not datafile.exists():
                                 size = self.metsObject.size
 
                                 if not self.metsObject.size:
@@ -779,15 +966,20 @@ class MetsMetadataInfoHandler(ContentHandler):
                                     sha512sum=checksum(self.metsObject,
                                                        'SHA-512'))
 
-                                logger.info('=== saving datafile: %s' % self.metsObject.name)
-                                self.modelDatafile.save()
                                 replica = models.Replica(
-                                    datafile=self.modelDatafile,
                                     url=sync_url,
                                     protocol=proto,
                                     location=self.syncLocation)
-                                replica.save()
-                                
+                                if self.bulk:
+                                    self.bulk.add_datafile(self.modelDatafile,
+                                                           replica)
+                                else:
+                                    logger.info('=== saving datafile: %s' %
+                                                self.metsObject.name)
+                                    self.modelDatafile.save()
+                                    replica.datafile = self.modelDatafile
+                                    replica.save()
+
                             else:
                                 self.modelDatafile = thisFilesDataset.dataset_file_set.get(
                                     filename=self.metsObject.name, size=self.metsObject.size)
@@ -804,7 +996,11 @@ class MetsMetadataInfoHandler(ContentHandler):
                                 datafileParameterSet = \
                                     models.DatafileParameterSet(schema=schema,
                                     dataset_file=self.modelDatafile)
-                                datafileParameterSet.save()
+                                if self.bulk:
+                                    self.bulk.add_parameterset(
+                                        datafileParameterSet)
+                                else:
+                                    datafileParameterSet.save()
 
                                 # now let's process the datafile parameters
                                 for parameterName in parameterNames:
@@ -861,7 +1057,10 @@ class MetsMetadataInfoHandler(ContentHandler):
                     name=parameterName,
                     string_value=parameterValue,
                     numerical_value=None)
-            parameter.save()
+            if self.bulk:
+                self.bulk.add_parameter(parameter)
+            else:
+                parameter.save()
 
     def characters(self, chars):
         if self.processExperimentStruct:
@@ -916,7 +1115,7 @@ def _getAttrValueByQName(attrs, attrName):
         return None
 
 
-def parseMets(filename, createdBy, expId=None):
+def parseMets(filename, createdBy, expId=None, bulk=None):
     '''Parse the METS document using the SAX Parser classes provided in the
     metsparser module.
 
@@ -924,6 +1123,8 @@ def parseMets(filename, createdBy, expId=None):
     filename -- path of the document to parse (METS or notMETS)
     created_by -- a User instance
     expid -- the experiment ID to use
+    bulk -- a BulkIngest, to write datafiles and parameters in batches
+            (the caller must call its finish() method once committed)
 
     Returns:
     The experiment ID
@@ -939,10 +1140,13 @@ def parseMets(filename, createdBy, expId=None):
     parser.setFeature(feature_namespaces, 1)
     dataHolder = MetsDataHolder()
 
+    ingest = bulk or BulkIngest()
+
     # on the first pass, we'll parse the document just so we can
     # create the experiment's structure
-    parser.setContentHandler(MetsExperimentStructCreator(dataHolder))
-    parser.parse(filename)
+    with ingest.phase('structure'):
+        parser.setContentHandler(MetsExperimentStructCreator(dataHolder))
+        parser.parse(filename)
 
     # Get the destination directory
     if expId:
@@ -952,10 +1156,13 @@ def parseMets(filename, createdBy, expId=None):
 
     # on the second pass, we'll parse the document so that we can tie
     # the metadata info with the experiment/dataset/datafile objects
-    parser.setContentHandler(
-        MetsMetadataInfoHandler(dataHolder, expId, createdBy, 
-                                sync_root, get_sync_location()))
-    parser.parse(filename)
+    with ingest.phase('metadata'):
+        parser.setContentHandler(
+            MetsMetadataInfoHandler(dataHolder, expId, createdBy,
+                                    sync_root, get_sync_location(), bulk))
+        parser.parse(filename)
+    if bulk:
+        bulk.flush()
 
     endParseTime = time.time()
 
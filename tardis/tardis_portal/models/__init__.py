@@ -43,11 +43,14 @@ models/__init__.py
 from django.contrib.auth.models import User, Group
 
 from .access_control import UserAuthentication, UserProfile, GroupAdmin
-from .access_control import ObjectACL
+from .access_control import ObjectACL, ExperimentAccess
 from .experiment import Experiment, Author_Experiment
 from .dataset import Dataset
 from .datafile import Dataset_File
 from .replica import Replica
+from .fixity import FixityCheck
+from .access_counts import DatafileAccess
+from .rollup import DatasetRollup, ExperimentRollup
 from .location import Location, ProviderParameter
 from .license import License
 from .hooks import staging_hook
@@ -1,4 +1,5 @@
 from datetime import datetime
+import hashlib
 
 from django.conf import settings
 from django.contrib.auth.models import User, Group
@@ -203,3 +204,83 @@ class ObjectACL(models.Model):
             (Q(expiryDate__gte=datetime.today()) |
              Q(expiryDate__isnull=True))
         return acl_effective_query
+
+
+class ExperimentAccess(models.Model):
+    """A denormalised index of who can read each experiment, so that the
+    experiments a user can see are found with one indexed lookup rather
+    than by joining and OR-ing their ObjectACLs.
+
+    Each row grants read access to one auth entity.  Rows are kept up to
+    date by the hooks in :py:mod:`tardis.tardis_portal.models.hooks` as
+    experiments and ACLs change, and by the periodic
+    'tardis_portal.refresh_experiment_access' task as dated ACLs come into
+    and go out of effect.  Group memberships are resolved when querying,
+    so they don't affect the index.
+
+    :attribute experiment: the experiment that can be read
+    :attribute entity: a key for the entity's pluginId and entityId (see
+       :py:meth:`get_entity_key`), or for the public if the experiment is
+       public
+    """
+
+    # Stands for everyone, for experiments that aren't hidden
+    PUBLIC_ENTITY = ('public', '')
+
+    experiment = models.ForeignKey('Experiment',
+                                   related_name='access_entries')
+    entity = models.CharField(max_length=40, db_index=True)
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%s | %i' % (self.entity, self.experiment_id)
+
+    @staticmethod
+    def get_entity_key(pluginId, entityId):
+        """
+        Return the key for an auth entity.  It is a hash, so that it has a
+        fixed (and indexable) length whatever the length of the entityId.
+        """
+        entity = u'%s:%s' % (pluginId, entityId)
+        return hashlib.sha1(entity.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def update_for_experiments(cls, experiment_ids):
+        """
+        Bring the index entries for the given experiments up to date.
+        Only the entries that have changed are written.
+        """
+        from .experiment import Experiment
+        experiment_ids = set(int(id_) for id_ in experiment_ids)
+        if not experiment_ids:
+            return
+        experiments = Experiment.objects.filter(id__in=experiment_ids) \
+                                        .values_list('id', 'public_access')
+        existing = set(id_ for id_, _ in experiments)
+        wanted = set((id_, cls.get_entity_key(*cls.PUBLIC_ENTITY))
+                     for id_, public_access in experiments
+                     if public_access != Experiment.PUBLIC_ACCESS_NONE)
+        acls = ObjectACL.objects \
+            .filter(content_type=ContentType.objects.get_for_model(Experiment),
+                    object_id__in=existing,
+                    canRead=True) \
+            .filter(ObjectACL.get_effective_query()) \
+            .values_list('object_id', 'pluginId', 'entityId')
+        wanted.update((object_id, cls.get_entity_key(pluginId, entityId))
+                      for object_id, pluginId, entityId in acls)
+
+        current = {}
+        for pk, id_, entity in cls.objects \
+                .filter(experiment__in=experiment_ids) \
+                .values_list('pk', 'experiment', 'entity'):
+            current.setdefault((id_, entity), []).append(pk)
+        stale = [pk for entry, pks in current.items()
+                 for pk in (pks if entry not in wanted else pks[1:])]
+        if stale:
+            cls.objects.filter(pk__in=stale).delete()
+        missing = wanted.difference(current)
+        if missing:
+            cls.objects.bulk_create([cls(experiment_id=id_, entity=entity)
+                                     for id_, entity in missing])
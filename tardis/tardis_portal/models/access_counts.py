@@ -0,0 +1,26 @@
+from django.db import models
+
+from .datafile import Dataset_File
+
+
+class DatafileAccess(models.Model):
+    '''The number of times a Datafile's content was used on a day: downloaded,
+    rendered as an image or included in an archive.  The counts are written
+    in batches by :py:mod:`tardis.tardis_portal.accesslog`.
+
+    :attribute datafile: the Datafile accessed
+    :attribute date: the day of the accesses
+    :attribute count: the number of accesses that day
+    '''
+
+    datafile = models.ForeignKey(Dataset_File, related_name='accesses')
+    date = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        app_label = 'tardis_portal'
+        unique_together = ('datafile', 'date')
+        get_latest_by = 'date'
+
+    def __unicode__(self):
+        return '%s | %s | %s' % (self.datafile_id, self.date, self.count)
@@ -2,7 +2,7 @@ from os import path
 
 from django.conf import settings
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, Sum
 from django.core.urlresolvers import reverse
 
 from .dataset import Dataset
@@ -15,6 +15,17 @@ IMAGE_FILTER = (Q(mimetype__startswith='image/') & \
               ~Q(mimetype='image/x-icon')) | \
                (Q(datafileparameterset__datafileparameter__name__units__startswith="image"))
 
+
+def parse_size(size):
+    """
+    Return a file size string as a number of bytes, or None if it isn't
+    a number.
+    """
+    try:
+        return long(size)
+    except (TypeError, ValueError):
+        return None
+
 class Dataset_File(models.Model):
     """Class to store meta-data about a file.  The physical copies of a
     file are described by distinct Replica instances. 
@@ -23,6 +34,8 @@ class Dataset_File(models.Model):
        :class:`tardis.tardis_portal.models.Dataset` the file belongs to.
     :attribute filename: the name of the file, excluding the path.
     :attribute size: the size of the file.
+    :attribute size_bytes: the size of the file as a number (for
+       aggregating in the database), kept in step with ``size``
     :attribute created_time: time the file was added to tardis
     :attribute modification_time: last modification time of the file
     :attribute mimetype: for example 'application/pdf'
@@ -33,6 +46,7 @@ class Dataset_File(models.Model):
     dataset = models.ForeignKey(Dataset)
     filename = models.CharField(max_length=400)
     size = models.CharField(blank=True, max_length=400)
+    size_bytes = models.BigIntegerField(null=True, blank=True)
     created_time = models.DateTimeField(null=True, blank=True)
     modification_time = models.DateTimeField(null=True, blank=True)
     mimetype = models.CharField(blank=True, max_length=80)
@@ -48,16 +62,8 @@ class Dataset_File(models.Model):
         """
         Takes a query set of datafiles and returns their total size.
         """
-        def sum_str(*args):
-            def coerce_to_long(x):
-                try:
-                    return long(x)
-                except ValueError:
-                    return 0
-            return sum(map(coerce_to_long, args))
-        # Filter empty sizes, get array of sizes, then reduce
-        return reduce(sum_str, datafiles.exclude(size='')
-                                        .values_list('size', flat=True), 0)
+        total = datafiles.aggregate(total=Sum('size_bytes'))['total']
+        return long(total or 0)
 
     def save(self, *args, **kwargs):
         if settings.REQUIRE_DATAFILE_CHECKSUMS and \
@@ -67,6 +73,7 @@ class Dataset_File(models.Model):
                 not self.size:
             raise Exception('Every Datafile requires a file size')
         else:
+            self.size_bytes = parse_size(self.size)
             super(Dataset_File, self).save(*args, **kwargs)
         
     def get_size(self):
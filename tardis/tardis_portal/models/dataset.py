@@ -76,5 +76,9 @@ class Dataset(models.Model):
     image = property(_get_image)
 
     def get_size(self):
-        from .datafile import Dataset_File
-        return Dataset_File.sum_sizes(self.dataset_file_set)
+        from .rollup import DatasetRollup
+        return DatasetRollup.get_for(self).size
+
+    def get_file_count(self):
+        from .rollup import DatasetRollup
+        return DatasetRollup.get_for(self).file_count
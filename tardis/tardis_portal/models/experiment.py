@@ -171,8 +171,12 @@ class Experiment(models.Model):
                                    .filter(IMAGE_FILTER)
 
     def get_size(self):
-        from .datafile import Dataset_File
-        return Dataset_File.sum_sizes(self.get_datafiles())
+        from .rollup import ExperimentRollup
+        return ExperimentRollup.get_for(self).size
+
+    def get_file_count(self):
+        from .rollup import ExperimentRollup
+        return ExperimentRollup.get_for(self).file_count
 
     @classmethod
     def public_access_implies_distribution(cls, public_access_level):
@@ -0,0 +1,62 @@
+from datetime import datetime
+
+from django.db import models
+
+from .replica import Replica
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class FixityCheck(models.Model):
+    '''A record of a replica's data being checked against its Datafile's
+    checksums and size.
+
+    :attribute replica: the replica checked
+    :attribute time: when the check finished
+    :attribute md5sum: the MD5 sum of the data read (blank if it couldn't
+        be read)
+    :attribute sha512sum: the SHA-512 sum of the data read (blank if it
+        couldn't be read)
+    :attribute ok: whether the data matched
+    :attribute error: why the check failed
+    :attribute duration: the time taken to read the data, in seconds
+    '''
+
+    replica = models.ForeignKey(Replica, related_name='fixity_checks')
+    time = models.DateTimeField()
+    md5sum = models.CharField(max_length=32, blank=True)
+    sha512sum = models.CharField(max_length=128, blank=True)
+    ok = models.BooleanField(default=False)
+    error = models.CharField(max_length=100, blank=True)
+    duration = models.FloatField(default=0)
+
+    class Meta:
+        app_label = 'tardis_portal'
+        get_latest_by = 'time'
+
+    def __unicode__(self):
+        return '%s | %s | %s' % (self.replica_id, self.time,
+                                 'OK' if self.ok else self.error)
+
+    @classmethod
+    def record(cls, result):
+        '''Record a :py:class:`tardis.tardis_portal.verification.VerificationResult`,
+        and when the replica was last checked.
+        '''
+        if result.error == 'deleted':
+            return None
+        if not result.ok:
+            logger.error('Replica %s failed fixity check: %s',
+                         result.replica_id, result.error)
+        check = cls.objects.create(replica_id=result.replica_id,
+                                   time=datetime.now(),
+                                   md5sum=result.md5sum or '',
+                                   sha512sum=result.sha512sum or '',
+                                   ok=result.ok,
+                                   error=(result.error or '')[:100],
+                                   duration=result.duration)
+        # Updated directly, as it's not a change to the replica itself
+        Replica.objects.filter(id=result.replica_id) \
+                       .update(last_fixity_check=check.time)
+        return check
@@ -1,11 +1,17 @@
 from django.conf import settings
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, \
+    pre_save, pre_delete, m2m_changed
 from django.dispatch import receiver
 
 from tardis.tardis_portal.staging import StagingHook
+from tardis.tardis_portal.stats import add_to_site_stats
 
+from .access_control import ObjectACL, ExperimentAccess
 from .experiment import Experiment, Author_Experiment
+from .dataset import Dataset
+from .datafile import Dataset_File
 from .replica import Replica
+from .rollup import DatasetRollup, ExperimentRollup
 from .parameters import ExperimentParameter, ExperimentParameterSet
 
 import logging
@@ -16,6 +22,125 @@ logger = logging.getLogger(__name__)
 staging_hook = StagingHook()
 post_save.connect(staging_hook, sender=Replica)
 
+### Image pre-rendering hook ###
+
+@receiver(post_save, sender=Replica)
+def pregenerate_images_for_replica(sender, **kwargs):
+    """ Render the commonly used IIIF sizes for an image in the background
+    once a replica of it has been verified.
+    """
+    replica = kwargs['instance']
+    newly_verified = kwargs['created'] or \
+        getattr(replica, '_newly_verified', False)
+    replica._newly_verified = False
+    if kwargs.get('raw') or not (replica.verified and newly_verified):
+        return
+    if not (getattr(settings, 'IIIF_CACHE_DIR', None) and
+            getattr(settings, 'IIIF_PREGENERATED_RENDERS', None)):
+        return
+    if replica.datafile.has_image():
+        from tardis.tardis_portal.tasks import generate_derivatives
+        generate_derivatives.delay(replica.datafile.id)
+
+### Experiment access index hooks ###
+
+@receiver(post_save, sender=Experiment)
+def update_experiment_access(sender, **kwargs):
+    # Public access may have changed
+    ExperimentAccess.update_for_experiments([kwargs['instance'].id])
+
+@receiver(post_save, sender=ObjectACL)
+@receiver(post_delete, sender=ObjectACL)
+def update_experiment_access_for_acl(sender, **kwargs):
+    acl = kwargs['instance']
+    if acl.content_type.model_class() == Experiment:
+        ExperimentAccess.update_for_experiments([acl.object_id])
+
+### Size rollup hooks ###
+
+def _add_to_rollups(dataset_id, file_count, size):
+    DatasetRollup.add([dataset_id], file_count, size)
+    experiment_ids = Dataset.experiments.through.objects \
+        .filter(dataset=dataset_id).values_list('experiment', flat=True)
+    ExperimentRollup.add(list(experiment_ids), file_count, size)
+
+@receiver(pre_save, sender=Dataset_File)
+def remember_datafile_size(sender, **kwargs):
+    datafile = kwargs['instance']
+    datafile._rollup_previous = None
+    if datafile.pk and not kwargs.get('raw'):
+        previous = Dataset_File.objects.filter(pk=datafile.pk) \
+                                       .values_list('dataset', 'size_bytes')
+        if previous:
+            datafile._rollup_previous = previous[0]
+
+@receiver(post_save, sender=Dataset_File)
+def update_rollups_for_datafile(sender, **kwargs):
+    datafile = kwargs['instance']
+    if kwargs.get('raw'):
+        return
+    current = (datafile.dataset_id, datafile.size_bytes)
+    previous = getattr(datafile, '_rollup_previous', None)
+    if current == previous:
+        return
+    if previous:
+        _add_to_rollups(previous[0], -1, -(previous[1] or 0))
+    _add_to_rollups(current[0], 1, current[1] or 0)
+    add_to_site_stats(datafile_count=0 if previous else 1,
+                      datafile_size=(current[1] or 0) -
+                                    (previous and previous[1] or 0))
+
+@receiver(post_delete, sender=Dataset_File)
+def update_rollups_for_deleted_datafile(sender, **kwargs):
+    datafile = kwargs['instance']
+    _add_to_rollups(datafile.dataset_id, -1, -(datafile.size_bytes or 0))
+    add_to_site_stats(datafile_count=-1,
+                      datafile_size=-(datafile.size_bytes or 0))
+
+@receiver(pre_delete, sender=Dataset)
+def remember_dataset_experiments(sender, **kwargs):
+    dataset = kwargs['instance']
+    dataset._rollup_experiments = list(
+        dataset.experiments.values_list('id', flat=True))
+
+@receiver(post_delete, sender=Dataset)
+def update_rollups_for_deleted_dataset(sender, **kwargs):
+    # The dataset's links to its experiments may have been deleted before
+    # its files were, so recount the experiments
+    dataset = kwargs['instance']
+    ExperimentRollup.update_for(getattr(dataset, '_rollup_experiments', []))
+
+@receiver(m2m_changed, sender=Dataset.experiments.through)
+def update_rollups_for_dataset_experiments(sender, **kwargs):
+    action = kwargs['action']
+    instance = kwargs['instance']
+    if kwargs['reverse']:
+        # instance is an experiment
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            ExperimentRollup.update_for([instance.id])
+    elif action == 'pre_clear':
+        instance._rollup_experiments = list(
+            instance.experiments.values_list('id', flat=True))
+    elif action == 'post_clear':
+        ExperimentRollup.update_for(getattr(instance, '_rollup_experiments',
+                                            []))
+    elif action in ('post_add', 'post_remove'):
+        ExperimentRollup.update_for(kwargs['pk_set'])
+
+### Site statistics hooks ###
+# (The file statistics are maintained with the size rollups.)
+
+@receiver(post_save, sender=Experiment)
+@receiver(post_save, sender=Dataset)
+def count_new_object(sender, **kwargs):
+    if kwargs['created'] and not kwargs.get('raw'):
+        add_to_site_stats(**{'%s_count' % sender.__name__.lower(): 1})
+
+@receiver(post_delete, sender=Experiment)
+@receiver(post_delete, sender=Dataset)
+def count_deleted_object(sender, **kwargs):
+    add_to_site_stats(**{'%s_count' % sender.__name__.lower(): -1})
+
 ### RIF-CS hooks ###
 
 def publish_public_expt_rifcs(experiment):
@@ -34,6 +34,13 @@ class Replica(models.Model):
        Location denoted the container for the archive not the archive itself.
     :attribute stay_remote: is used (temporarily) to indicate to the ingestion
        task that a file should not be copied into the mytardis
+    :attribute last_fixity_check: when the replica's content was last
+       checked against the Dataset_File (see
+       :class:`tardis.tardis_portal.models.FixityCheck`), or for a remote
+       replica, when it last failed to be copied
+    :attribute verification_lease: while this is in the future, the replica
+       has been queued for verification, copying or a fixity audit, and
+       isn't queued again
 
     """
 
@@ -43,6 +50,10 @@ class Replica(models.Model):
     verified = models.BooleanField(default=False)
     stay_remote = models.BooleanField(default=False)
     location = models.ForeignKey(Location)
+    last_fixity_check = models.DateTimeField(null=True, blank=True,
+                                             db_index=True)
+    verification_lease = models.DateTimeField(null=True, blank=True,
+                                              db_index=True)
 
     class Meta:
         app_label = 'tardis_portal'
@@ -160,7 +171,22 @@ class Replica(models.Model):
         logger.info("Downloading %s for verification", self.url)
         md5sum, sha512sum, size, mimetype_buffer = \
             generate_file_checksums(sourcefile, tempfile)
+        if not self.check_digests(md5sum, sha512sum, size, mimetype_buffer):
+            return False
+        self.verified = True
+        # Tells the post_save hooks that verification has just happened
+        self._newly_verified = True
+        return True
 
+    def check_digests(self, md5sum, sha512sum, size, mimetype_buffer,
+                      fill_in=True):
+        '''
+        Checks the checksums and size of this replica's data (as returned by
+        generate_file_checksums) against the Datafile.  If 'fill_in' is True,
+        any of the Datafile's checksums, size and mimetype that are missing
+        are filled in (and the Datafile saved).
+        '''
+        df = self.datafile
         if not (df.size and size == int(df.size)):
             if (df.sha512sum or df.md5sum) and not df.size: 
                 # If the size is missing but we have a checksum to check
@@ -181,19 +207,19 @@ class Replica(models.Model):
                          self.url, md5sum, df.md5sum)
             return False
 
-        if df.mimetype:
-            mimetype = df.mimetype
-        elif len(mimetype_buffer) > 0:
-            mimetype = Magic(mime=True).from_buffer(mimetype_buffer)
-        else:
-            mimetype = ''
-        if not (df.size and df.md5sum and df.sha512sum and df.mimetype):
+        if fill_in and \
+                not (df.size and df.md5sum and df.sha512sum and df.mimetype):
+            if df.mimetype:
+                mimetype = df.mimetype
+            elif len(mimetype_buffer) > 0:
+                mimetype = Magic(mime=True).from_buffer(mimetype_buffer)
+            else:
+                mimetype = ''
             df.md5sum = md5sum.lower()
             df.sha512sum = sha512sum.lower()
             df.size = str(size)
             df.mimetype = mimetype
             df.save()
-        self.verified = True
         return True
     
     def deleteCompletely(self):
@@ -0,0 +1,145 @@
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, Sum
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Rollup(models.Model):
+    """The number and total size of the files in a dataset or experiment,
+    maintained as files are added and removed so that they needn't be
+    counted when displayed.
+
+    Rollups are kept up to date by the hooks in
+    :py:mod:`tardis.tardis_portal.models.hooks`.  A missing rollup is
+    computed when it is first asked for.
+
+    :attribute file_count: the number of files
+    :attribute size: the total size of the files, in bytes
+    """
+
+    file_count = models.BigIntegerField(default=0)
+    size = models.BigIntegerField(default=0)
+
+    # The name of the field that refers to the rolled-up object
+    target = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def _get_totals(cls, ids):
+        """ Return {id: (file_count, size)} for the given objects """
+        raise NotImplementedError
+
+    @classmethod
+    def get_for(cls, obj):
+        try:
+            return cls.objects.get(**{cls.target: obj})
+        except cls.DoesNotExist:
+            rollups = cls.update_for([obj.id])
+            return rollups[0] if rollups else cls()
+
+    @classmethod
+    def update_for(cls, ids):
+        """
+        Recompute the rollups of the objects with the given ids, and return
+        them.  This is part of the caller's transaction if there is one
+        (such as a request's, or an ingest's), or else commits on its own.
+        """
+        if transaction.is_managed():
+            return cls._update_for(ids)
+        with transaction.commit_on_success():
+            return cls._update_for(ids)
+
+    @classmethod
+    def _update_for(cls, ids):
+        model = cls._meta.get_field(cls.target).rel.to
+        ids = set(model.objects.filter(id__in=set(ids))
+                               .values_list('id', flat=True))
+        if not ids:
+            return []
+        totals = cls._get_totals(ids)
+        cls.objects.filter(**{cls.target + '__in': ids}).delete()
+        rollups = [cls(file_count=file_count, size=size or 0,
+                       **{cls.target + '_id': id_})
+                   for id_, (file_count, size) in
+                   ((id_, totals.get(id_, (0, 0))) for id_ in ids)]
+        sid = transaction.savepoint()
+        try:
+            cls.objects.bulk_create(rollups)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Another process created some of the rollups first
+            transaction.savepoint_rollback(sid)
+            for rollup in rollups:
+                if not cls.objects \
+                        .filter(**{cls.target: getattr(rollup,
+                                                       cls.target + '_id')}) \
+                        .update(file_count=rollup.file_count,
+                                size=rollup.size):
+                    rollup.save()
+        return rollups
+
+    @classmethod
+    def add(cls, ids, file_count, size):
+        """ Adjust the rollups of the objects with the given ids """
+        if ids and (file_count or size):
+            cls.objects.filter(**{cls.target + '__in': ids}) \
+                       .update(file_count=F('file_count') + file_count,
+                               size=F('size') + size)
+
+
+class DatasetRollup(Rollup):
+    """The number and total size of the files in a dataset.
+    """
+
+    dataset = models.OneToOneField('Dataset', related_name='rollup')
+
+    target = 'dataset'
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%i | %i files, %i bytes' % (self.dataset_id, self.file_count,
+                                            self.size)
+
+    @classmethod
+    def _get_totals(cls, ids):
+        from .datafile import Dataset_File
+        return dict((row['dataset'], (row['file_count'], row['size']))
+                    for row in Dataset_File.objects
+                        .filter(dataset__in=ids)
+                        .order_by()
+                        .values('dataset')
+                        .annotate(file_count=Count('id'),
+                                  size=Sum('size_bytes')))
+
+
+class ExperimentRollup(Rollup):
+    """The number and total size of the files in an experiment.
+    """
+
+    experiment = models.OneToOneField('Experiment', related_name='rollup')
+
+    target = 'experiment'
+
+    class Meta:
+        app_label = 'tardis_portal'
+
+    def __unicode__(self):
+        return '%i | %i files, %i bytes' % (self.experiment_id,
+                                            self.file_count, self.size)
+
+    @classmethod
+    def _get_totals(cls, ids):
+        from .datafile import Dataset_File
+        return dict((row['dataset__experiments'],
+                     (row['file_count'], row['size']))
+                    for row in Dataset_File.objects
+                        .filter(dataset__experiments__in=ids)
+                        .order_by()
+                        .values('dataset__experiments')
+                        .annotate(file_count=Count('id'),
+                                  size=Sum('size_bytes')))
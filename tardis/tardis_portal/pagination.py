@@ -0,0 +1,102 @@
+"""
+pagination.py
+
+Keyset (or "cursor") pagination of query sets.  Rather than counting the
+results and skipping to an offset, as Django's Paginator does, each page
+after the first is found by filtering on the ordering key of the last item
+on the page before it.  With an index on the ordering, a deep page costs
+the same as the first one.
+
+Pages are only followed forwards, which suits "load more" and infinite
+scrolling listings (see activateInfiniteScroll in js/main.js).
+
+"""
+import json
+import operator
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class KeysetPage(object):
+    """
+    A page of results, and the cursor for the page after it (None if this
+    is the last page).
+    """
+
+    def __init__(self, object_list, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def _get_key_fields(model, ordering):
+    """ Return the model fields in the ordering, and whether each is
+    descending.
+    """
+    return [(model._meta.get_field(name.lstrip('-')), name.startswith('-'))
+            for name in ordering]
+
+
+def _encode_cursor(values):
+    return urlsafe_b64encode(json.dumps([unicode(value)
+                                         for value in values]))
+
+
+def _decode_cursor(fields, cursor):
+    """ Return the key values in the cursor, or None if it isn't valid. """
+    try:
+        values = json.loads(urlsafe_b64decode(str(cursor)))
+        if len(values) != len(fields):
+            return None
+        return [field.to_python(value)
+                for (field, _), value in zip(fields, values)]
+    except (TypeError, ValueError, ValidationError):
+        return None
+
+
+def _get_after_query(fields, values):
+    """ Return a query for the rows that come after the given key. """
+    # (a, b) after (x, y) is: a > x, or a = x and b > y
+    terms = []
+    for i, (field, descending) in enumerate(fields):
+        lookup = '%s__%s' % (field.name, 'lt' if descending else 'gt')
+        term = Q(**{lookup: values[i]})
+        for (previous, _), value in zip(fields[:i], values):
+            term &= Q(**{previous.name: value})
+        terms.append(term)
+    return reduce(operator.or_, terms)
+
+
+def get_keyset_page(queryset, ordering, cursor=None, per_page=100):
+    """
+    Return a :py:class:`KeysetPage` of the query set.
+
+    :param ordering: field names to order by, which must identify each
+        row uniquely (so should end with the primary key), e.g.
+        ``('-update_time', '-id')``
+    :param cursor: the ``next_cursor`` of the previous page, or None for
+        the first page.  Invalid cursors are treated as None.
+    """
+    fields = _get_key_fields(queryset.model, ordering)
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        values = _decode_cursor(fields, cursor)
+        if values is not None:
+            queryset = queryset.filter(_get_after_query(fields, values))
+    objects = list(queryset[:per_page + 1])
+    if len(objects) <= per_page:
+        return KeysetPage(objects, None)
+    objects = objects[:per_page]
+    last = objects[-1]
+    return KeysetPage(objects, _encode_cursor(
+        [getattr(last, field.attname) for field, _ in fields]))
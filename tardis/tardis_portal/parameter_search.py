@@ -0,0 +1,130 @@
+"""
+Finds the experiments, datasets and datafiles whose parameters meet the
+constraints given in the search forms.
+
+All the constraints on one kind of parameter are compiled into a single
+query over the parameter table, which matches parameter rows on
+(name, value) (see the indexes added by migration 0032) and groups them by
+owner, keeping the owners that meet every constraint.  The result is used
+as a subquery, so the searches for different kinds of parameter are
+intersected by the database rather than by joining the parameter tables
+once per constraint.
+"""
+
+import operator
+
+from django.db.models import Count, Q
+
+from tardis.tardis_portal import constants
+from tardis.tardis_portal.models import ParameterName
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get_parameter_constraints(parameters, searchFilterData):
+    """
+    Return the constraints that the search form data puts on the given
+    parameters, as (ParameterName id, lookup, value) tuples, where 'lookup'
+    is a field lookup on the parameter such as 'numerical_value__range'.
+    Parameters without a value in the form are left unconstrained.
+
+    :param parameters: the ParameterNames that can be searched on
+    :param searchFilterData: the cleaned up search form data
+    """
+    constraints = []
+    for parameter in parameters:
+        fieldName = parameter.getUniqueShortName()
+        try:
+            constraint = _get_constraint(parameter, fieldName,
+                                         searchFilterData)
+        except KeyError:
+            # Not in this form
+            continue
+        if constraint:
+            constraints.append((parameter.id,) + constraint)
+    return constraints
+
+
+def _get_constraint(parameter, fieldName, searchFilterData):
+    if not parameter.data_type == ParameterName.NUMERIC:
+        value = searchFilterData[fieldName]
+        if value == '':
+            return None
+        # let's check if this is a field that's specified to be displayed
+        # as a dropdown menu in the form
+        if parameter.choices != '':
+            if value == '-':
+                return None
+            return ('string_value__iexact', value)
+        if parameter.comparison_type == ParameterName.EXACT_VALUE_COMPARISON:
+            return ('string_value__iexact', value)
+        # Contains comparisons, and comparisons that only apply to numbers,
+        # use 'icontains'
+        return ('string_value__icontains', value)
+
+    if parameter.comparison_type == ParameterName.RANGE_COMPARISON:
+        fromParam = searchFilterData[fieldName + 'From']
+        toParam = searchFilterData[fieldName + 'To']
+        if fromParam is None and toParam is None:
+            return None
+        return ('numerical_value__range',
+                (fromParam is None and constants.FORM_RANGE_LOWEST_NUM or
+                 fromParam,
+                 toParam is not None and toParam or
+                 constants.FORM_RANGE_HIGHEST_NUM))
+
+    value = searchFilterData[fieldName]
+    if value is None:
+        return None
+    lookup = {
+        ParameterName.GREATER_THAN_COMPARISON: 'numerical_value__gt',
+        ParameterName.GREATER_THAN_EQUAL_COMPARISON: 'numerical_value__gte',
+        ParameterName.LESS_THAN_COMPARISON: 'numerical_value__lt',
+        ParameterName.LESS_THAN_EQUAL_COMPARISON: 'numerical_value__lte',
+    }.get(parameter.comparison_type,
+          # Exact comparisons, and comparisons that only apply to strings,
+          # use 'exact'
+          'numerical_value__exact')
+    return (lookup, value)
+
+
+def get_matching_ids(parameter_model, owner, constraints):
+    """
+    Return a query for the ids of the objects with parameters meeting all
+    of the constraints.
+
+    :param parameter_model: the parameter model, e.g.
+       :py:class:`tardis.tardis_portal.models.DatafileParameter`
+    :param owner: the field of the model's parameter sets that refers to
+       the objects, e.g. 'dataset_file'
+    :param constraints: constraints from :py:func:`get_parameter_constraints`
+    """
+    owner_field = 'parameterset__' + owner
+    matches = reduce(operator.or_,
+                     [Q(name=name_id, **{lookup: value})
+                      for name_id, lookup, value in constraints])
+    # (Cleared ordering, as the ordering fields would be grouped by too)
+    return parameter_model.objects.filter(matches) \
+                                  .order_by() \
+                                  .values(owner_field) \
+                                  .annotate(matched=Count('name',
+                                                          distinct=True)) \
+                                  .filter(matched=len(constraints)) \
+                                  .values_list(owner_field, flat=True)
+
+
+def filter_by_parameters(queryset, parameter_model, owner, constraints,
+                         lookup='pk__in'):
+    """
+    Narrow the queryset to the objects whose parameters meet all of the
+    constraints (see :py:func:`get_matching_ids`).  'lookup' relates the
+    queryset to the objects, e.g. 'dataset__in' to narrow datafiles by
+    their datasets' parameters.
+    """
+    if not constraints:
+        return queryset
+    logger.debug('%s constraints: %s' % (parameter_model.__name__,
+                                         constraints))
+    return queryset.filter(**{lookup: get_matching_ids(parameter_model,
+                                                       owner, constraints)})
@@ -36,18 +36,29 @@ search indexes for single search
 .. moduleauthor:: Shaun O'Keefe  <shaun.okeefe@versi.edu.au>
 
 '''
+import heapq
+import itertools
+from collections import defaultdict
 from haystack.indexes import *
 from haystack import site
-from models import Dataset_File, \
+from models import Dataset_File, Dataset, Experiment, Author_Experiment, \
     DatafileParameter, DatasetParameter, ExperimentParameter, \
-    ParameterName, Schema
+    ParameterName, Schema, FreeTextSearchField
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import post_save, post_delete
 from django.db.utils import DatabaseError
+import search_queue
 import logging
 from django.template.defaultfilters import slugify
 import re
+import time
 
 logger = logging.getLogger(__name__)
 
+# The number of Datafiles indexed at a time by index_datafiles
+INDEX_BATCH_SIZE = 500
+
 
 #
 # Removes anything unwholesome before text is added to a text field for
@@ -140,6 +151,77 @@ def _getParamValue(param):
     else:
         return param.string_value
 
+def _getCreatorText(exp):
+    return ' '.join([exp.created_by.first_name, exp.created_by.last_name,
+                     exp.created_by.username, exp.created_by.email])
+
+def _getFieldValues(params):
+    values = {}
+    for par in params:
+        fn = search_fields.get_field(par)
+        # (Skipping any made searchable since search_fields was loaded)
+        if fn:
+            values[fn] = _getParamValue(par)
+    return values
+
+def _groupParams(params, key):
+    grouped = defaultdict(list)
+    for par in params.select_related('name', 'parameterset'):
+        grouped[key(par)].append(par)
+    return grouped
+
+class LRUCache(object):
+    """
+    A mapping that holds at most 'size' entries, dropping the least
+    recently used to make room for new ones.
+
+    Each entry records when it was last used, and a heap of (time used,
+    key) pairs finds the oldest.  Using an entry pushes a new pair rather
+    than updating its old one, so pairs that are out of date are skipped
+    when found, and the heap is rebuilt when they start to pile up.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # {key: (time used, value)}
+        self._entries = {}
+        self._heap = []
+        self._clock = itertools.count()
+
+    def _use(self, key, value):
+        used = self._clock.next()
+        self._entries[key] = (used, value)
+        heapq.heappush(self._heap, (used, key))
+        if len(self._heap) > 2 * self.size + 100:
+            self._heap = [(used, key) for key, (used, _)
+                          in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def get(self, key, default=None):
+        try:
+            _, value = self._entries[key]
+        except KeyError:
+            return default
+        self._use(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._use(key, value)
+        while len(self._entries) > self.size:
+            used, oldest = heapq.heappop(self._heap)
+            if self._entries.get(oldest, (None,))[0] == used:
+                del self._entries[oldest]
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._heap = []
+
+    def __len__(self):
+        return len(self._entries)
+
 #
 # Overrides the index_queryset function of the basic
 # SearchIndex. index_queryset fetches a QuerySet for
@@ -166,122 +248,367 @@ class OracleSafeIndex(RealTimeSearchIndex):
     def index_queryset(self):
         return self.model._default_manager.all().defer(None)
 
-class GetDatasetFileParameters(SearchIndex.__metaclass__):
-    def __new__(cls, name, bases, attrs):
+class SearchFieldRegistry(object):
+    """
+    The search field of each searchable ParameterName, by ParameterName id.
+
+    The map is loaded from the database when it is first used, and checked
+    against it again at most every SEARCH_FIELDS_REFRESH_INTERVAL seconds
+    (or on demand, with refresh(force=True)), so that parameters made
+    searchable are picked up without restarting.  'version' counts the
+    changes seen.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.names = {}
+        self.parameter_names = {}
+        self._checked = None
 
-        # dynamically add all the searchable parameter fields
+    def refresh(self, force=False):
+        """
+        Reload the map if it is due to be checked.  Return the ids of the
+        ParameterNames that have become searchable or stopped being
+        searchable (or have been renamed or changed type), if any.
+        """
+        if not force and self._checked is not None and \
+                time.time() - self._checked < \
+                getattr(settings, 'SEARCH_FIELDS_REFRESH_INTERVAL', 60):
+            return set()
+        names, parameter_names = {}, {}
         try:
-            pns = ParameterName.objects.filter(is_searchable=True)
-            for pn in pns:
-                fn = prepareFieldName(pn)
-                attrs[fn] = _getDataType(pn)
+            for pn in ParameterName.objects.filter(is_searchable=True) \
+                                           .select_related('schema'):
+                names[pn.id] = prepareFieldName(pn)
+                parameter_names[pn.id] = pn
         except DatabaseError:
-            pass
-        
-        return super(GetDatasetFileParameters, cls).__new__(cls, name, bases, attrs)
+            # The tables don't exist yet
+            return set()
+        self._checked = time.time()
+        def describe(pn):
+            return pn and (prepareFieldName(pn), pn.data_type)
+        changed = set(name_id for name_id in set(names) | set(self.names)
+                      if describe(parameter_names.get(name_id)) !=
+                      describe(self.parameter_names.get(name_id)))
+        if changed:
+            self.names, self.parameter_names = names, parameter_names
+            self.version += 1
+        return changed
+
+    def get_field(self, param):
+        """ Return the search field name for the parameter, or None if its
+        name isn't searchable. """
+        return self.names.get(param.name_id)
+
+search_fields = SearchFieldRegistry()
+
+def get_datafiles_with_parameters(name_ids):
+    """
+    Return the ids of the Datafiles whose search documents include
+    parameters with the given ParameterName ids (their own, or their
+    datasets' or experiments').
+    """
+    name_ids = list(name_ids)
+    datafile_ids = set()
+    for lookup in ('datafileparameterset__datafileparameter__name__in',
+                   'dataset__datasetparameterset__datasetparameter__name__in',
+                   'dataset__experiments__experimentparameterset__'
+                   'experimentparameter__name__in'):
+        datafile_ids.update(Dataset_File.objects
+                            .filter(**{lookup: name_ids})
+                            .values_list('id', flat=True))
+    return sorted(datafile_ids)
 
 class DatasetFileIndex(RealTimeSearchIndex):
     
-    __metaclass__ = GetDatasetFileParameters
-    
     text=CharField(document=True)
     datafile_filename  = CharField(model_attr='filename')
     
     dataset_id_stored = IntegerField(model_attr='dataset__pk', indexed=True) #changed
     dataset_description = CharField(model_attr='dataset__description')
 
-    experiment_id_stored = IntegerField(model_attr='dataset__experiment__pk', indexed=True) # changed
-    experiment_description = CharField(model_attr='dataset__experiment__description')
-    experiment_title = CharField(model_attr='dataset__experiment__title')
-    experiment_created_time = DateTimeField(model_attr='dataset__experiment__created_time')
-    experiment_start_time = DateTimeField(model_attr='dataset__experiment__start_time', default=None)
-    experiment_end_time = DateTimeField(model_attr='dataset__experiment__end_time', default=None)
-    experiment_update_time = DateTimeField(model_attr='dataset__experiment__update_time', default=None)
-    experiment_institution_name = CharField(model_attr='dataset__experiment__institution_name', default=None)
-    experiment_creator=CharField(model_attr='dataset__experiment__created_by__username')
-    experiment_institution_name=CharField(model_attr='dataset__experiment__institution_name')
+    # The experiment fields are filled in by prepare(), from the dataset's
+    # first experiment (see _get_experiment)
+    experiment_id_stored = IntegerField(indexed=True) # changed
+    experiment_description = CharField()
+    experiment_title = CharField()
+    experiment_created_time = DateTimeField()
+    experiment_start_time = DateTimeField(default=None)
+    experiment_end_time = DateTimeField(default=None)
+    experiment_update_time = DateTimeField(default=None)
+    experiment_creator=CharField()
+    experiment_institution_name=CharField()
     experiment_authors = MultiValueField()
    
-    exp_cache = {}
-    ds_cache = {}
-    exp_param_cache = {}
-    ds_param_cache = {}
-   
-    def get_experiment_text(self, obj, exp):
-        
-        if not exp in self.exp_cache:
+    def __init__(self, *args, **kwargs):
+        super(DatasetFileIndex, self).__init__(*args, **kwargs)
+        # The free text and search fields of recently indexed experiments,
+        # keyed on ('experiment', pk).  Each entry also holds the
+        # experiment's update_time, and is only used while that is
+        # unchanged, as the experiment may be changed by other processes.
+        # (Datasets have nothing like update_time, so their text is only
+        # kept for the batch being indexed; see update_objects.)
+        self._cache = LRUCache(getattr(settings, 'SEARCH_INDEX_CACHE_SIZE',
+                                       1000))
+        for model in (Experiment, Author_Experiment, ExperimentParameter,
+                      FreeTextSearchField):
+            post_save.connect(self._invalidate, sender=model)
+            post_delete.connect(self._invalidate, sender=model)
+        post_save.connect(self._search_fields_changed, sender=ParameterName)
+        post_delete.connect(self._search_fields_changed,
+                            sender=ParameterName)
+        # The fields added for searchable parameters, by field name
+        self._param_fields = {}
+        self.refresh_fields(force=True)
+
+    def refresh_fields(self, force=False):
+        """
+        Bring the search fields for searchable parameters up to date with
+        the database (see SearchFieldRegistry), and return the ids of the
+        ParameterNames whose fields have changed.
+        """
+        changed = search_fields.refresh(force)
+        if changed or search_fields.version != self._fields_version:
+            wanted = {}
+            for name_id, fn in search_fields.names.items():
+                field = _getDataType(search_fields.parameter_names[name_id])
+                if type(self._param_fields.get(fn)) is type(field):
+                    field = self._param_fields[fn]
+                wanted[fn] = field
+            for fn in set(self._param_fields) - set(wanted):
+                self.fields.pop(fn, None)
+            for fn, field in wanted.items():
+                if self.fields.get(fn) is not field:
+                    field.set_instance_name(fn)
+                    self.fields[fn] = field
+            self._param_fields = wanted
+            self._fields_version = search_fields.version
+            # Cached field values may use the old names
+            self._cache.clear()
+        return changed
+
+    def _search_fields_changed(self, sender, instance, **kwargs):
+        changed = self.refresh_fields(force=True)
+        if changed and not kwargs.get('raw', False):
+            # Only this process saw the change happen, so only it queues
+            # the documents that have gained or lost fields.  They are
+            # looked up by the task, outside of this transaction.
+            search_queue.queue_fields(
+                [(name_id, search_fields.names.get(name_id))
+                 for name_id in sorted(changed)])
+
+    def _invalidate(self, sender, instance, **kwargs):
+        try:
+            if sender is Experiment:
+                self._cache.discard(('experiment', instance.pk))
+            elif sender is Author_Experiment:
+                self._cache.discard(('experiment', instance.experiment_id))
+            elif sender is ExperimentParameter:
+                self._cache.discard(
+                    ('experiment', instance.parameterset.experiment_id))
+            else:
+                # Which parameters are indexed for free text may have changed
+                self._cache.clear()
+        except ObjectDoesNotExist:
+            # The parameter set has gone too
+            self._cache.clear()
+
+    def _get_text_name_ids(self):
+        """ Return the ids of the ParameterNames indexed for free text
+        search. """
+        name_ids = self._cache.get(('free_text_names',))
+        if name_ids is None:
+            name_ids = frozenset(FreeTextSearchField.objects
+                                 .values_list('parameter_name', flat=True))
+            self._cache[('free_text_names',)] = name_ids
+        return name_ids
+
+    def _get_experiment_entry(self, exp, params=None, authors=None):
+        entry = self._cache.get(('experiment', exp.pk))
+        if entry is None or entry[0] != exp.update_time:
+            if params is None:
+                params = ExperimentParameter.objects.filter(
+                    parameterset__experiment__pk=exp.pk,
+                    name__is_searchable=True).select_related('name')
+            if authors is None:
+                authors = [a.author for a in
+                           exp.author_experiment_set.order_by('order')]
+            text_name_ids = self._get_text_name_ids()
             text_list = [exp.title, exp.description, exp.institution_name]
-            params = ExperimentParameter.objects.filter(
-                    parameterset__experiment__id=exp.id,
-                    name__is_searchable=True,
-                    name__freetextsearchfield__isnull=False)
-            
-            text_list.extend(map(toIntIfNumeric, params))
-            
+            text_list.extend(toIntIfNumeric(par) for par in params
+                             if par.name_id in text_name_ids)
             # add all authors to the free text search
-            text_list.extend(self.prepare_experiment_authors(obj))
-            text_list.extend(self.prepare_experiment_creator(obj))
-            self.exp_cache[exp] = ' '.join(map(cleanText,text_list))
-        
-        return self.exp_cache[exp]
+            text_list.extend(authors)
+            text_list.append(_getCreatorText(exp))
+            entry = (exp.update_time, ' '.join(map(cleanText, text_list)),
+                     _getFieldValues(params), authors)
+            self._cache[('experiment', exp.pk)] = entry
+        return entry[1:]
 
-    def get_dataset_text(self, obj, ds):
-        ds = obj.dataset
-        
-        if not ds in self.ds_cache:
-            text_list = [ds.description]
+    def _get_dataset_entry(self, ds, params=None):
+        if self._datasets is not None and ds.pk in self._datasets:
+            return self._datasets[ds.pk]
+        if params is None:
             params = DatasetParameter.objects.filter(
-                    parameterset__dataset__id=ds.id,
-                    name__is_searchable=True,
-                    name__freetextsearchfield__isnull=False)
-            
-            text_list.extend(map(toIntIfNumeric, params))
-            
-            # Always convert to strings as this is a text index
-            self.ds_cache[ds] = ' '.join(map(cleanText,text_list))
-        return self.ds_cache[ds]
+                parameterset__dataset__pk=ds.pk,
+                name__is_searchable=True).select_related('name')
+        text_name_ids = self._get_text_name_ids()
+        text_list = [ds.description]
+        text_list.extend(toIntIfNumeric(par) for par in params
+                         if par.name_id in text_name_ids)
+        # Always convert to strings as this is a text index
+        return (' '.join(map(cleanText, text_list)), _getFieldValues(params))
+
+    def get_experiment_text(self, obj, exp):
+        return self._get_experiment_entry(exp)[0]
+
+    def get_dataset_text(self, obj, ds):
+        return self._get_dataset_entry(ds)[0]
 
     def get_experiment_params(self, exp):
-        if exp not in self.exp_param_cache:
-            param_dict = {}
-            for par in ExperimentParameter.objects.filter(
-                    parameterset__experiment__pk=exp.id, 
-                    name__is_searchable=True):
-                fn = prepareFieldName(par.name)
-                param_dict[fn] = _getParamValue(par)
-   
-            self.exp_param_cache[exp] = param_dict
+        return self._get_experiment_entry(exp)[1]
 
-        return self.exp_param_cache[exp]
+    def get_experiment_authors(self, exp):
+        return self._get_experiment_entry(exp)[2]
 
     def get_dataset_params(self, ds):
-        if ds not in self.ds_param_cache:
-            param_dict = {}
-            for par in DatasetParameter.objects.filter(
-                    parameterset__dataset__pk=ds.id, 
-                    name__is_searchable=True):
-                fn = prepareFieldName(par.name)
-                param_dict[fn] = _getParamValue(par)
-            self.ds_param_cache[ds] = param_dict
-
-        return self.ds_param_cache[ds]
-
-    def prepare_experiment_authors(self, obj):
-        return [a.author for a in obj.dataset.experiment.author_experiment_set.all()]
-    
-    def prepare_experiment_creator(self, obj):
-        exp = obj.dataset.experiment 
-        return ' '.join([exp.created_by.first_name, exp.created_by.last_name,\
-                exp.created_by.username, exp.created_by.email]) 
-    
+        return self._get_dataset_entry(ds)[1]
+
+    def _get_experiment(self, obj):
+        """ Return the experiment a Datafile is indexed under (its dataset's
+        first), or None if its dataset isn't in an experiment. """
+        if self._experiments is not None:
+            return self._experiments.get(obj.dataset_id)
+        try:
+            return obj.dataset.get_first_experiment()
+        except Experiment.DoesNotExist:
+            return None
+
+    def _prepare_experiment_fields(self, exp):
+        return {
+            'experiment_id_stored': exp.pk,
+            'experiment_description': exp.description,
+            'experiment_title': exp.title,
+            'experiment_created_time': exp.created_time,
+            'experiment_start_time': exp.start_time,
+            'experiment_end_time': exp.end_time,
+            'experiment_update_time': exp.update_time,
+            'experiment_creator': _getCreatorText(exp),
+            'experiment_institution_name': exp.institution_name,
+            'experiment_authors': self.get_experiment_authors(exp),
+        }
+
+    # Searchable parameters of the Datafiles being indexed by
+    # update_objects, by Datafile id
+    _datafile_params = None
+    # The experiments of the Datafiles' datasets, by dataset id, while
+    # update_objects is indexing them
+    _experiments = None
+    # The free text and search fields of those datasets, by dataset id
+    _datasets = None
+    # The search_fields version that self.fields matches
+    _fields_version = None
+
+    def update_object(self, instance, **kwargs):
+        if not getattr(settings, 'SEARCH_INDEX_QUEUED', False):
+            return super(DatasetFileIndex, self).update_object(instance,
+                                                               **kwargs)
+        if self.should_update(instance, **kwargs):
+            search_queue.enqueue_update(instance.pk)
+
+    def remove_object(self, instance, **kwargs):
+        if not getattr(settings, 'SEARCH_INDEX_QUEUED', False):
+            return super(DatasetFileIndex, self).remove_object(instance,
+                                                               **kwargs)
+        search_queue.enqueue_removal(instance.pk)
+
+    def update_objects(self, datafiles, commit=True):
+        """
+        Index many Datafiles at once.  The parameters of the Datafiles and of
+        their datasets and experiments are fetched with a query or two for
+        the lot, rather than several for each Datafile, and the documents
+        are sent to Solr together.  The datasets and experiments are always
+        fetched afresh, as they may have been changed by another process.
+        """
+        datafiles = list(datafiles)
+        self.refresh_fields(force=True)
+        self._cache.discard(('free_text_names',))
+        self._datafile_params = _groupParams(
+            DatafileParameter.objects.filter(
+                parameterset__dataset_file__in=[df.id for df in datafiles],
+                name__is_searchable=True),
+            lambda par: par.parameterset.dataset_file_id)
+        datasets = dict((df.dataset_id, df.dataset) for df in datafiles)
+        self._prefetch_datasets(datasets.values())
+        self._prefetch_experiments(datafiles)
+        try:
+            self.backend.update(self, datafiles, commit=commit)
+        finally:
+            self._datafile_params = None
+            self._experiments = None
+            self._datasets = None
+
+    def _prefetch_datasets(self, datasets):
+        params = _groupParams(
+            DatasetParameter.objects.filter(
+                parameterset__dataset__in=[ds.pk for ds in datasets],
+                name__is_searchable=True),
+            lambda par: par.parameterset.dataset_id)
+        self._datasets = {}
+        for ds in datasets:
+            self._datasets[ds.pk] = self._get_dataset_entry(
+                ds, params.get(ds.pk, []))
+
+    def _prefetch_experiments(self, datafiles):
+        # Each dataset's first experiment, as in Dataset.get_first_experiment
+        first = {}
+        for dataset_id, exp_id in Dataset.experiments.through.objects \
+                .filter(dataset__in=set(df.dataset_id for df in datafiles)) \
+                .order_by('experiment__created_time', 'experiment') \
+                .values_list('dataset', 'experiment'):
+            first.setdefault(dataset_id, exp_id)
+        experiments = Experiment.objects.select_related('created_by') \
+                                        .in_bulk(set(first.values()))
+        self._experiments = dict((dataset_id, experiments.get(exp_id))
+                                 for dataset_id, exp_id in first.items())
+        params = _groupParams(
+            ExperimentParameter.objects.filter(
+                parameterset__experiment__in=experiments.keys(),
+                name__is_searchable=True),
+            lambda par: par.parameterset.experiment_id)
+        authors = defaultdict(list)
+        for exp_id, author in Author_Experiment.objects \
+                .filter(experiment__in=experiments.keys()) \
+                .order_by('order') \
+                .values_list('experiment', 'author'):
+            authors[exp_id].append(author)
+        for exp_id, exp in experiments.items():
+            self._cache.discard(('experiment', exp_id))
+            self._get_experiment_entry(exp, params.get(exp_id, []),
+                                       authors[exp_id])
+
+    def get_datafile_params(self, obj):
+        """ Return the Datafile's searchable parameters, and those of them
+        that are also indexed for free text search. """
+        if self._datafile_params is None:
+            params = list(DatafileParameter.objects.filter(
+                parameterset__dataset_file__pk=obj.pk,
+                name__is_searchable=True).select_related('name'))
+        else:
+            params = self._datafile_params.get(obj.id, [])
+        text_name_ids = self._get_text_name_ids()
+        return params, [p for p in params if p.name_id in text_name_ids]
+
     def prepare(self, obj):
+        if self._datafile_params is None:
+            self.refresh_fields()
         self.prepared_data = super(DatasetFileIndex, self).prepare(obj)
         
         # 
         # prepare the free text field and also add all searchable
         # soft parameters as field-searchable fields
         #
-        exp = obj.dataset.experiment
+        exp = self._get_experiment(obj)
         ds = obj.dataset
         text_list = [obj.filename]
         
@@ -294,14 +621,11 @@ class DatasetFileIndex(RealTimeSearchIndex):
         # searchable will be silently ignored even if they
         # have an associated FreeTextSearchField
 
-        params = DatafileParameter.objects.filter(
-                parameterset__dataset_file__id=obj.id,
-                name__is_searchable=True,
-                name__freetextsearchfield__isnull=False)
+        params, text_params = self.get_datafile_params(obj)
         
-        text_list.extend(map(toIntIfNumeric, params))
+        text_list.extend(map(toIntIfNumeric, text_params))
         
-        exp_text = self.get_experiment_text(obj, exp) 
+        exp_text = exp and self.get_experiment_text(obj, exp) or ''
         ds_text = self.get_dataset_text(obj, ds)
        
         # Always convert to strings as this is a text index
@@ -310,21 +634,79 @@ class DatasetFileIndex(RealTimeSearchIndex):
         self.prepared_data['text'] = ' '.join([exp_text, ds_text, df_text])
 
         # add all soft parameters listed as searchable as in field search
-        for par in DatafileParameter.objects.filter(
-                parameterset__dataset_file__pk=obj.pk, 
-                name__is_searchable=True):
-            fn = prepareFieldName(par.name)
-            self.prepared_data[fn] = _getParamValue(par) 
+        self.prepared_data.update(_getFieldValues(params))
         
-        self.prepared_data.update(self.get_experiment_params(exp))
+        if exp is not None:
+            self.prepared_data.update(self._prepare_experiment_fields(exp))
+            self.prepared_data.update(self.get_experiment_params(exp))
         self.prepared_data.update(self.get_dataset_params(ds))
         
-        for par in DatasetParameter.objects.filter(
-                parameterset__dataset__pk=ds.id, 
-                name__is_searchable=True):
-            fn = prepareFieldName(par.name)
-            self.prepared_data[fn] = _getParamValue(par)
-        
         return self.prepared_data
 
 site.register(Dataset_File, DatasetFileIndex)
+
+
+def reindex_datafiles(datafile_ids, fields=None):
+    """ Queue the Datafiles with the given ids to be reindexed by the
+    update_search_index task, INDEX_BATCH_SIZE at a time (see
+    :py:func:`index_datafiles` for 'fields'). """
+    from tardis.tardis_portal.search_queue import queue
+    for i in range(0, len(datafile_ids), INDEX_BATCH_SIZE):
+        queue(datafile_ids[i:i + INDEX_BATCH_SIZE], (), fields=fields)
+
+
+def _fields_match(fields):
+    return all(search_fields.names.get(name_id) == field
+               for name_id, field in fields)
+
+
+def reindex_fields(fields):
+    """
+    Queue the Datafiles whose documents include parameters with the
+    ParameterNames in 'fields' (see :py:func:`index_datafiles`) to be
+    reindexed with those fields.  Returns False, having queued nothing, if
+    the search fields don't match 'fields' yet.
+    """
+    site.get_index(Dataset_File).refresh_fields(force=True)
+    if not _fields_match(fields):
+        return False
+    reindex_datafiles(get_datafiles_with_parameters(
+        name_id for name_id, _ in fields), fields)
+    return True
+
+
+def index_datafiles(datafile_ids, removed_ids=(), commit=True, fields=None):
+    """
+    Index the Datafiles with the given ids, and remove those with the
+    removed ids from the index.  The changes are sent to Solr in batches of
+    INDEX_BATCH_SIZE and committed once, at the end (unless 'commit' is
+    False).  Returns the ids of the Datafiles that couldn't be found, or
+    couldn't be indexed yet.
+
+    'fields' lists the search field name (or None) that the Datafiles
+    should be indexed with for each of some ParameterName ids, as
+    (ParameterName id, field name) pairs.  The search fields are reloaded
+    before each batch, and a batch is left unindexed while they differ, as
+    the change to the ParameterNames may not have been committed yet.
+    """
+    index = site.get_index(Dataset_File)
+    datafile_ids = sorted(set(datafile_ids))
+    missing = set(datafile_ids)
+    for i in range(0, len(datafile_ids), INDEX_BATCH_SIZE):
+        if fields:
+            index.refresh_fields(force=True)
+            if not _fields_match(fields):
+                continue
+        datafiles = list(index.index_queryset()
+                         .filter(pk__in=datafile_ids[i:i + INDEX_BATCH_SIZE])
+                         .select_related('dataset'))
+        missing.difference_update(datafile.pk for datafile in datafiles)
+        index.update_objects(datafiles, commit=False)
+    for datafile_id in set(removed_ids):
+        index.backend.remove('%s.%s.%s' % (Dataset_File._meta.app_label,
+                                           Dataset_File._meta.module_name,
+                                           datafile_id),
+                             commit=False)
+    if commit and (datafile_ids or removed_ids):
+        index.backend.conn.commit()
+    return sorted(missing)
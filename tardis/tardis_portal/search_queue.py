@@ -0,0 +1,124 @@
+"""
+Queues changes to Datafiles for the search index, when SEARCH_INDEX_QUEUED
+is set, rather than indexing each Datafile as it is saved.
+
+The ids of saved and deleted Datafiles are collected in memory by
+:py:func:`enqueue_update` and :py:func:`enqueue_removal`, and handed to the
+``tardis_portal.update_search_index`` task in batches: at the end of each
+request or celery task, when the process exits, and once
+SEARCH_INDEX_BATCH_SIZE Datafiles have changed - but only outside of a
+managed transaction, as the changes might not have been committed yet.
+Each batch is run SEARCH_INDEX_DELAY seconds after it is queued, and any
+Datafiles that can't be found then are queued again, up to
+SEARCH_INDEX_RETRIES times, in case the transaction that saved them was
+still running.
+"""
+
+import atexit
+import threading
+
+from celery.signals import task_postrun
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import transaction
+
+import logging
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# Ids of Datafiles to (re)index, and to remove from the index
+_updates = set()
+_removals = set()
+
+
+def enqueue_update(datafile_id):
+    """ Queue a Datafile to be (re)indexed. """
+    with _lock:
+        _removals.discard(datafile_id)
+        _updates.add(datafile_id)
+        due = len(_updates) + len(_removals) >= \
+            getattr(settings, 'SEARCH_INDEX_BATCH_SIZE', 500)
+    if due and not transaction.is_managed():
+        flush()
+
+
+def enqueue_removal(datafile_id):
+    """ Queue a deleted Datafile to be removed from the index. """
+    with _lock:
+        _updates.discard(datafile_id)
+        _removals.add(datafile_id)
+        due = len(_updates) + len(_removals) >= \
+            getattr(settings, 'SEARCH_INDEX_BATCH_SIZE', 500)
+    if due and not transaction.is_managed():
+        flush()
+
+
+def flush(**kwargs):
+    """ Queue the changes collected so far for indexing. """
+    global _updates, _removals
+    with _lock:
+        updates, _updates = _updates, set()
+        removals, _removals = _removals, set()
+    queue(updates, removals)
+
+
+def queue(updates, removals, attempt=0, fields=None):
+    """ Queue a batch of changes for indexing (see
+    :py:func:`tardis.tardis_portal.search_indexes.index_datafiles` for
+    'fields'). """
+    if not (updates or removals):
+        return
+    from tardis.tardis_portal.tasks import update_search_index
+    args = [sorted(updates), sorted(removals), attempt]
+    if fields:
+        args.append(fields)
+    try:
+        update_search_index.apply_async(
+            args=args, countdown=getattr(settings, 'SEARCH_INDEX_DELAY', 5))
+    except Exception:
+        logger.exception('Unable to queue %d datafiles for indexing' %
+                         (len(updates) + len(removals)))
+
+
+def requeue(missing, attempt, fields=None):
+    """
+    Queue Datafiles that couldn't be indexed by the given attempt to index
+    them again, unless SEARCH_INDEX_RETRIES attempts have been made.
+    """
+    if attempt < getattr(settings, 'SEARCH_INDEX_RETRIES', 3):
+        queue(missing, (), attempt + 1, fields)
+    else:
+        logger.warning("Couldn't index %d datafiles" % len(missing))
+
+def queue_fields(fields, attempt=0):
+    """ Queue the Datafiles affected by a change to the search fields to be
+    reindexed (see
+    :py:func:`tardis.tardis_portal.search_indexes.reindex_fields`). """
+    from tardis.tardis_portal.tasks import reindex_search_fields
+    try:
+        reindex_search_fields.apply_async(
+            args=[fields, attempt],
+            countdown=getattr(settings, 'SEARCH_INDEX_DELAY', 5))
+    except Exception:
+        logger.exception('Unable to queue reindexing for %d search fields' %
+                         len(fields))
+
+
+def requeue_fields(fields, attempt):
+    """
+    Queue a change to the search fields that the given attempt couldn't see
+    yet to be looked at again, unless SEARCH_INDEX_RETRIES attempts have
+    been made.
+    """
+    if attempt < getattr(settings, 'SEARCH_INDEX_RETRIES', 3):
+        queue_fields(fields, attempt + 1)
+    else:
+        logger.warning("Couldn't reindex for %d search fields" % len(fields))
+
+request_finished.connect(flush)
+task_postrun.connect(flush)
+
+
+@atexit.register
+def _flush_at_exit():
+    flush()
@@ -63,6 +63,37 @@ var userAutocompleteHandler = function(term, users, authMethod) {
   return matches;
 };
 
+var activateInfiniteScroll = function() {
+  // A "load more" link (in an element of class load-more-container) is
+  // replaced by the next page of the listing...
+  $('a.load-more').live('click', function(evt) {
+    evt.preventDefault();
+    var $link = $(this);
+    if ($link.hasClass('loading')) {
+      return;
+    }
+    $link.addClass('loading').text('Loading...');
+    $.ajax({
+      'url': $link.attr('href'),
+      'success': function(data) {
+        $link.closest('.load-more-container').replaceWith(data);
+      },
+      'error': function() {
+        $link.removeClass('loading').text('Load more');
+      }
+    });
+  });
+  // ...which is loaded when it is scrolled into view
+  $(window).scroll(_.throttle(function() {
+    var bottom = $(window).scrollTop() + $(window).height();
+    $('a.load-more:visible').not('.loading').each(function() {
+      if ($(this).offset().top < bottom + 200) {
+        $(this).click();
+      }
+    });
+  }, 250));
+};
+
 var isLoggedIn = function() {
   return $('#user-menu').size() > 0;
 }
@@ -72,4 +103,5 @@ $(document).ready(function(){
     activateSearchAutocomplete();
   }
   activateHoverDetection();
+  activateInfiniteScroll();
 });
@@ -0,0 +1,125 @@
+"""
+stats.py
+
+Site-wide and per-experiment statistics, kept so that pages showing them
+needn't count every object.
+
+The site totals live in Django's cache.  They are adjusted as objects are
+created and deleted (by the hooks in
+:py:mod:`tardis.tardis_portal.models.hooks`), recomputed when missing, and
+reconciled with the database periodically by the
+'tardis_portal.reconcile_site_stats' task, which corrects any drift from
+concurrent updates or from changes that bypass signals.
+
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Sum
+
+import logging
+logger = logging.getLogger(__name__)
+
+SITE_STATS = ('experiment_count', 'dataset_count', 'datafile_count',
+              'datafile_size')
+
+
+def _get_key(name):
+    return 'tardis_portal.site_stats.%s' % name
+
+
+def _get_timeout():
+    return getattr(settings, 'SITE_STATS_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+def _compute_site_stats():
+    from tardis.tardis_portal.models import Experiment, Dataset, \
+        Dataset_File
+    return {
+        'experiment_count': Experiment.objects.count(),
+        'dataset_count': Dataset.objects.count(),
+        'datafile_count': Dataset_File.objects.count(),
+        'datafile_size': long(Dataset_File.objects.aggregate(
+            size=Sum('size_bytes'))['size'] or 0),
+    }
+
+
+def get_site_stats():
+    """
+    Return the numbers of experiments, datasets and files stored, and the
+    total size of the files, as a dict.
+    """
+    keys = dict((_get_key(name), name) for name in SITE_STATS)
+    stats = dict((keys[key], value)
+                 for key, value in cache.get_many(keys.keys()).items())
+    if len(stats) < len(SITE_STATS):
+        stats = reconcile_site_stats()
+    return stats
+
+
+def reconcile_site_stats():
+    """
+    Recompute the site statistics from the database, and return them.
+    """
+    stats = _compute_site_stats()
+    cache.set_many(dict((_get_key(name), value)
+                        for name, value in stats.items()), _get_timeout())
+    return stats
+
+
+def add_to_site_stats(**deltas):
+    """
+    Adjust the cached site statistics, e.g.
+    add_to_site_stats(datafile_count=1, datafile_size=1024).  Statistics
+    that aren't cached are left to be computed when next needed.
+    """
+    for name, delta in deltas.items():
+        if not delta:
+            continue
+        try:
+            cache.incr(_get_key(name), delta)
+        except ValueError:
+            # Not cached (or evicted)
+            pass
+
+
+def get_experiment_file_counts(experiment_ids):
+    """
+    Return {experiment id: number of files} for the given experiments,
+    from their rollups.
+    """
+    from tardis.tardis_portal.models import ExperimentRollup
+    experiment_ids = set(int(id_) for id_ in experiment_ids)
+    counts = dict(ExperimentRollup.objects
+                  .filter(experiment__in=experiment_ids)
+                  .values_list('experiment', 'file_count'))
+    missing = experiment_ids.difference(counts)
+    if missing:
+        counts.update((rollup.experiment_id, rollup.file_count)
+                      for rollup in ExperimentRollup.update_for(missing))
+    return counts
+
+
+def with_experiment_counts(experiments):
+    """
+    Add the number of datasets and files in each experiment to a query set
+    of experiments, as 'dataset_count' and 'file_count' attributes, so that
+    a listing gets them with the experiments rather than by a query per
+    experiment.  The file count is None for an experiment whose rollup
+    hasn't been computed yet.
+    """
+    from tardis.tardis_portal.models import Dataset, ExperimentRollup
+    qn = connection.ops.quote_name
+    experiment_table = experiments.model._meta.db_table
+    dataset_link = Dataset.experiments.through._meta
+    rollup = ExperimentRollup._meta
+    return experiments.extra(select={
+        'dataset_count': 'SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s' % (
+            qn(dataset_link.db_table), qn(dataset_link.db_table),
+            qn(dataset_link.get_field('experiment').column),
+            qn(experiment_table), qn('id')),
+        'file_count': 'SELECT %s FROM %s WHERE %s.%s = %s.%s' % (
+            qn(rollup.get_field('file_count').column), qn(rollup.db_table),
+            qn(rollup.db_table), qn(rollup.get_field('experiment').column),
+            qn(experiment_table), qn('id')),
+    })
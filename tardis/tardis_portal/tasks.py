@@ -1,7 +1,11 @@
 from celery.task import task
 import os
+from collections import defaultdict
+from datetime import datetime, timedelta
 from os import path
+from django.conf import settings
 from django.db import transaction
+from django.db.models import Q
 from django.contrib.auth.models import User
 
 from tardis.tardis_portal.models import Dataset_File, Dataset
@@ -13,7 +17,9 @@ from django.template import Context
 from django.contrib.sites.models import Site
 
 from tardis.tardis_portal.staging import stage_replica
-from tardis.tardis_portal.models import Replica, Location
+from tardis.tardis_portal.models import Replica, Location, FixityCheck
+from tardis.tardis_portal.verification import VerificationEngine, \
+    get_audit_batch
 
 # Ensure filters are loaded
 try:
@@ -27,13 +33,109 @@ try:
 except Exception:
     pass
 
+# The number of replicas checked by each verify_replicas task
+VERIFY_BATCH_SIZE = 50
+
+# The number of ids in each "IN" clause (SQLite allows at most 999 parameters)
+ID_CHUNK_SIZE = 500
+
 @task(name="tardis_portal.verify_files", ignore_result=True)
 def verify_files():
-    for replica in Replica.objects.filter(verified=False).exclude(protocol='staging'):
-        if replica.stay_remote or replica.is_local():
-            verify_as_remote.delay(replica.id)
-        else:
-            make_local_copy.delay(replica.id)
+    """
+    Queue the unverified replicas that aren't already queued for
+    verification (or copying, for remote replicas).  Each queued replica is
+    leased for VERIFY_LEASE seconds, and no more than VERIFY_MAX_QUEUED are
+    leased at once, so a backlog is worked through in manageable amounts
+    rather than queued again on every run.  Replicas that failed
+    verification are retried after VERIFY_RETRY_DELAY seconds.
+    """
+    now = datetime.now()
+    in_flight = Replica.objects.filter(verified=False,
+                                       verification_lease__gt=now).count()
+    budget = getattr(settings, 'VERIFY_MAX_QUEUED', 2000) - in_flight
+    if budget <= 0:
+        return
+    retry_before = now - timedelta(
+        seconds=getattr(settings, 'VERIFY_RETRY_DELAY', 300))
+    unleased = Q(verification_lease__isnull=True) | \
+        Q(verification_lease__lte=now)
+    candidates = Replica.objects.filter(verified=False) \
+                                .exclude(protocol='staging') \
+                                .filter(unleased) \
+                                .filter(Q(last_fixity_check__isnull=True) |
+                                        Q(last_fixity_check__lte=retry_before))
+    # Smallest files first, so that as many files as possible become
+    # available soon.
+    replica_ids = list(candidates.order_by('datafile__size_bytes', 'id')
+                       .values_list('id', flat=True)[:budget])
+    # (Whole seconds, as some databases don't store microseconds)
+    lease = (now + timedelta(seconds=getattr(settings, 'VERIFY_LEASE',
+                                             3600))).replace(microsecond=0)
+    # Replicas verified in place are batched by Location.
+    batches = defaultdict(list)
+    for i in range(0, len(replica_ids), ID_CHUNK_SIZE):
+        chunk = replica_ids[i:i + ID_CHUNK_SIZE]
+        # Claim the replicas; any claimed by someone else since they were
+        # chosen are left to them
+        Replica.objects.filter(unleased, id__in=chunk) \
+                       .update(verification_lease=lease)
+        for replica in Replica.objects.filter(id__in=chunk,
+                                              verification_lease=lease) \
+                                      .order_by('datafile__size_bytes', 'id'):
+            if replica.stay_remote or replica.is_local():
+                batch = batches[replica.location_id]
+                batch.append(replica.id)
+                if len(batch) >= VERIFY_BATCH_SIZE:
+                    verify_replicas.delay(batch)
+                    batches[replica.location_id] = []
+            else:
+                make_local_copy.delay(replica.id)
+    for batch in batches.values():
+        if batch:
+            verify_replicas.delay(batch)
+
+@task(name="tardis_portal.verify_replicas", ignore_result=True)
+def verify_replicas(replica_ids):
+    """
+    Verify a batch of replicas in place.  They are read one at a time,
+    as celery's worker processes can't have process pools of their own.
+    Their leases are released afterwards, so that any that failed can be
+    retried.
+    """
+    engine = VerificationEngine(processes=0, update=True)
+    engine.run(Replica.objects.filter(id__in=replica_ids, verified=False),
+               callback=FixityCheck.record)
+    Replica.objects.filter(id__in=replica_ids) \
+                   .update(verification_lease=None)
+
+@task(name="tardis_portal.audit_fixity", ignore_result=True)
+def audit_fixity(hours=1):
+    """
+    Queue the re-checking of the replicas due for a fixity audit in the
+    next 'hours', which should match this task's schedule.
+    """
+    replica_ids = get_audit_batch(timedelta(hours=hours))
+    # Lease the replicas (as verify_files does), so that they aren't chosen
+    # again while they wait to be checked
+    lease = datetime.now() + timedelta(
+        seconds=getattr(settings, 'VERIFY_LEASE', 3600))
+    for i in range(0, len(replica_ids), ID_CHUNK_SIZE):
+        Replica.objects.filter(id__in=replica_ids[i:i + ID_CHUNK_SIZE]) \
+                       .update(verification_lease=lease)
+    for i in range(0, len(replica_ids), VERIFY_BATCH_SIZE):
+        audit_replicas.delay(replica_ids[i:i + VERIFY_BATCH_SIZE])
+
+@task(name="tardis_portal.audit_replicas", ignore_result=True)
+def audit_replicas(replica_ids):
+    """
+    Re-check a batch of verified replicas, recording the results in the
+    fixity ledger.
+    """
+    engine = VerificationEngine(processes=0)
+    engine.run(Replica.objects.filter(id__in=replica_ids),
+               callback=FixityCheck.record)
+    Replica.objects.filter(id__in=replica_ids) \
+                   .update(verification_lease=None)
 
 @task(name="tardis_portal.verify_as_remote", ignore_result=True)
 def verify_as_remote(replica_id):
@@ -53,16 +155,42 @@ def verify_as_remote(replica_id):
 @task(name="tardis_portal.make_local_copy", ignore_result=True)
 def make_local_copy(replica_id):
     replica = Replica.objects.get(id=replica_id)
-    # Check that we still need to verify - it might have been done already
-    if replica.is_local():
-        return
-    # Use a transaction for safety
-    with transaction.commit_on_success():
-        # Get replica locked for write (to prevent concurrent actions)
-        replica = Replica.objects.select_for_update().get(id=replica_id)
-        # Second check after lock (concurrency paranoia)
+    try:
+        # Check that we still need to verify - it might have been done already
         if not replica.is_local():
-            stage_replica(replica)
+            # Use a transaction for safety
+            with transaction.commit_on_success():
+                # Get replica locked for write (to prevent concurrent actions)
+                replica = Replica.objects.select_for_update() \
+                                         .get(id=replica_id)
+                # Second check after lock (concurrency paranoia)
+                if not replica.is_local():
+                    stage_replica(replica)
+    finally:
+        # Release the lease taken by verify_files (a replica that was staged
+        # has been replaced by a verified local one).  One that is still
+        # unverified records the failed attempt, so that verify_files waits
+        # VERIFY_RETRY_DELAY before trying it again.
+        Replica.objects.filter(id=replica_id, verified=False) \
+                       .update(verification_lease=None,
+                               last_fixity_check=datetime.now())
+        Replica.objects.filter(id=replica_id, verified=True) \
+                       .update(verification_lease=None)
+
+@task(name="tardis_portal.generate_derivatives", ignore_result=True,
+      default_retry_delay=30)
+def generate_derivatives(datafile_id):
+    from tardis.tardis_portal.iiif import pregenerate_images
+    try:
+        datafile = Dataset_File.objects.get(id=datafile_id)
+    except Dataset_File.DoesNotExist as exc:
+        # The transaction that verified the replica may not be committed yet
+        generate_derivatives.retry(exc=exc)
+    try:
+        pregenerate_images(datafile)
+    except ValueError as exc:
+        # The preferred replica isn't verified (yet)
+        generate_derivatives.retry(exc=exc)
 
 @task(name="tardis_portal.create_staging_datafiles", ignore_result=True)
 def create_staging_datafiles(files, user_id, dataset_id, is_secure):
@@ -148,3 +276,65 @@ def create_staging_datafile(filepath, username, dataset_id):
 @task(name="tardis_portal.email_user_task", ignore_result=True)
 def email_user_task(subject, template_name, context, user):
     email_user(subject, template_name, context, user)
+
+@task(name="tardis_portal.refresh_experiment_access", ignore_result=True)
+def refresh_experiment_access(days=7):
+    """
+    ACLs come into and go out of effect without being saved, so update the
+    experiment access index for any ACLs that have done so in the last few
+    days.  (Looking back further than a day covers missed runs.)
+    """
+    from datetime import date, timedelta
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import Q
+    from tardis.tardis_portal.models import Experiment, ObjectACL, \
+        ExperimentAccess
+    today = date.today()
+    since = today - timedelta(days=days)
+    experiment_ids = ObjectACL.objects \
+        .filter(content_type=ContentType.objects.get_for_model(Experiment)) \
+        .filter(Q(effectiveDate__range=(since, today)) |
+                Q(expiryDate__range=(since - timedelta(days=1),
+                                     today - timedelta(days=1)))) \
+        .values_list('object_id', flat=True).distinct()
+    ExperimentAccess.update_for_experiments(experiment_ids)
+
+
+@task(name="tardis_portal.reconcile_site_stats", ignore_result=True)
+def reconcile_site_stats():
+    """
+    Correct any drift in the cached site statistics.
+    """
+    from tardis.tardis_portal import stats
+    stats.reconcile_site_stats()
+
+
+@task(name="tardis_portal.update_search_index", ignore_result=True)
+def update_search_index(datafile_ids, removed_ids=(), attempt=0,
+                        fields=None):
+    """
+    Index the Datafiles queued by SEARCH_INDEX_QUEUED mode (or by changes
+    to searchable parameters), and remove the deleted ones from the index.
+    Datafiles that can't be indexed yet are queued again, up to
+    SEARCH_INDEX_RETRIES times, as the transaction that saved them (or their
+    parameters' names) may not have been committed yet.
+    """
+    from tardis.tardis_portal.search_indexes import index_datafiles
+    from tardis.tardis_portal.search_queue import requeue
+    missing = index_datafiles(datafile_ids, removed_ids, fields=fields)
+    if missing:
+        requeue(missing, attempt, fields)
+
+
+@task(name="tardis_portal.reindex_search_fields", ignore_result=True)
+def reindex_search_fields(fields, attempt=0):
+    """
+    Queue the Datafiles that gain or lose search fields with a change to
+    which ParameterNames are searchable to be reindexed.  The task is
+    queued again, up to SEARCH_INDEX_RETRIES times, while the change can't
+    be seen, as it may not have been committed yet.
+    """
+    from tardis.tardis_portal.search_indexes import reindex_fields
+    from tardis.tardis_portal.search_queue import requeue_fields
+    if not reindex_fields(fields):
+        requeue_fields(fields, attempt)
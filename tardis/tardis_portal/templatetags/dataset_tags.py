@@ -65,7 +65,7 @@ def dataset_datafiles_badge(dataset):
     """
     Displays an badge with the number of datafiles for this experiment
     """
-    count = dataset.dataset_file_set.count()
+    count = dataset.get_file_count()
     return render_mustache('tardis_portal/badges/datafile_count', {
         'title': "%d file%s" % (count, pluralize(count)),
         'count': count,
@@ -29,7 +29,9 @@ def experiment_datasets_badge(experiment):
     """
     Displays an badge with the number of datasets for this experiment
     """
-    count = experiment.datasets.all().count()
+    count = getattr(experiment, 'dataset_count', None)
+    if count is None:
+        count = experiment.datasets.all().count()
     return render_mustache('tardis_portal/badges/dataset_count', {
         'title': "%d dataset%s" % (count, pluralize(count)),
         'count': count,
@@ -40,7 +42,9 @@ def experiment_datafiles_badge(experiment):
     """
     Displays an badge with the number of datafiles for this experiment
     """
-    count = experiment.get_datafiles().count()
+    count = getattr(experiment, 'file_count', None)
+    if count is None:
+        count = experiment.get_file_count()
     return render_mustache('tardis_portal/badges/datafile_count', {
         'title': "%d file%s" % (count, pluralize(count)),
         'count': count,
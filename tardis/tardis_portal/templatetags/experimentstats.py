@@ -1,15 +1,27 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from django import template
-from tardis.tardis_portal.models import Dataset_File
-from django.db.models import Sum
+from tardis.tardis_portal.stats import get_experiment_file_counts
 
 register = template.Library()
 
 
 @register.filter
 def experiment_file_count(value):
-    return Dataset_File.objects.filter(dataset__experiments__pk=value).count()
+    '''
+    The number of files in an experiment, given the experiment or its id.
+    Experiments from a listing that has been through
+    :py:func:`tardis.tardis_portal.stats.with_experiment_counts` already
+    have the count, so no query is needed for them.
+    '''
+    count = getattr(value, 'file_count', None)
+    if count is not None:
+        return count
+    experiment_id = getattr(value, 'pk', value)
+    if not experiment_id:
+        return 0
+    return get_experiment_file_counts([experiment_id]) \
+        .get(int(experiment_id), 0)
 
 # @register.filter
 # def experiment_file_size(value):....
@@ -0,0 +1,88 @@
+from datetime import date
+
+from compare import expect
+from django.conf import settings
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from tardis.tardis_portal import accesslog
+from tardis.tardis_portal.models import Dataset, Dataset_File, \
+    DatafileAccess
+
+
+class AccessLogTestCase(TestCase):
+
+    def setUp(self):
+        # Write (and so drop) any counts left over from other tests
+        accesslog.flush()
+        self.dataset = Dataset()
+        self.dataset.save()
+        self.ids = []
+        for i in range(3):
+            datafile = Dataset_File(dataset=self.dataset,
+                                    filename='file%d' % i, size='10',
+                                    sha512sum='0' * 128)
+            datafile.save()
+            self.ids.append(datafile.id)
+
+    def _counts(self):
+        return dict((access.datafile_id, access.count)
+                    for access in DatafileAccess.objects.all())
+
+    def testCountsAreBatched(self):
+        accesslog.record_access(self.ids[:2])
+        accesslog.record_access(self.ids[:1])
+        expect(DatafileAccess.objects.count()).to_equal(0)
+        accesslog.flush()
+        expect(self._counts()).to_equal({self.ids[0]: 2, self.ids[1]: 1})
+        # Existing counters are added to
+        accesslog.record_access(self.ids)
+        accesslog.flush()
+        expect(self._counts()).to_equal({self.ids[0]: 3, self.ids[1]: 2,
+                                         self.ids[2]: 1})
+        expect(DatafileAccess.objects.get(datafile=self.ids[0]).date) \
+            .to_equal(date.today())
+
+    def testFlushSize(self):
+        saved = getattr(settings, 'ACCESS_LOG_FLUSH_SIZE', None)
+        settings.ACCESS_LOG_FLUSH_SIZE = 2
+        try:
+            accesslog.record_access(self.ids[:1])
+            expect(DatafileAccess.objects.count()).to_equal(0)
+            accesslog.record_access(self.ids[1:2])
+            expect(self._counts()).to_equal({self.ids[0]: 1,
+                                             self.ids[1]: 1})
+        finally:
+            if saved is None:
+                del settings.ACCESS_LOG_FLUSH_SIZE
+            else:
+                settings.ACCESS_LOG_FLUSH_SIZE = saved
+
+    def testDeletedDatafilesAreDropped(self):
+        accesslog.record_access(self.ids)
+        Dataset_File.objects.filter(id=self.ids[2]).delete()
+        accesslog.flush()
+        expect(self._counts()).to_equal({self.ids[0]: 1, self.ids[1]: 1})
+
+
+class AccessLogTransactionTestCase(TransactionTestCase):
+
+    def setUp(self):
+        accesslog.flush()
+
+    def testFlushJoinsTransaction(self):
+        @transaction.commit_on_success
+        def request():
+            dataset = Dataset(description='rolled back')
+            dataset.save()
+            datafile = Dataset_File(dataset=dataset, filename='file',
+                                    size='10', sha512sum='0' * 128)
+            datafile.save()
+            accesslog.record_access([datafile.id])
+            accesslog.flush()
+            raise ValueError('request failed')
+
+        self.assertRaises(ValueError, request)
+        # Writing the counts didn't commit the request's work
+        expect(Dataset.objects.count()).to_equal(0)
+        expect(DatafileAccess.objects.count()).to_equal(0)
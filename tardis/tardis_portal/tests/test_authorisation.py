@@ -577,6 +577,48 @@ class ObjectACLTestCase(TestCase):
         num_exps = Experiment.safe.owned(request.user).count()
         self.assertEqual(num_exps, 0)
 
+    def testAccessibleExperiments(self):
+        def accessible(user):
+            return set(Experiment.safe.all(user).values_list('id', flat=True))
+
+        def shared(user):
+            return set(Experiment.safe.owned_and_shared(user)
+                       .values_list('id', flat=True))
+
+        self.assertEqual(accessible(self.user1),
+                         set([self.experiment1.id, self.experiment3.id]))
+        self.assertEqual(shared(self.user1), set([self.experiment1.id]))
+        self.assertEqual(accessible(AnonymousUser()),
+                         set([self.experiment3.id]))
+
+        # ACLs that have expired don't count
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        acl = ObjectACL(pluginId=django_user,
+                        entityId=str(self.user1.id),
+                        content_object=self.experiment2,
+                        canRead=True,
+                        expiryDate=yesterday,
+                        aclOwnershipType=ObjectACL.OWNER_OWNED)
+        acl.save()
+        self.assertEqual(shared(self.user1), set([self.experiment1.id]))
+        acl.expiryDate = None
+        acl.save()
+        self.assertEqual(shared(self.user1),
+                         set([self.experiment1.id, self.experiment2.id]))
+
+        # ...including those that expire without being saved
+        from tardis.tardis_portal.tasks import refresh_experiment_access
+        ObjectACL.objects.filter(id=acl.id).update(expiryDate=yesterday)
+        refresh_experiment_access()
+        self.assertEqual(shared(self.user1), set([self.experiment1.id]))
+        acl.delete()
+
+        # Public access changes are picked up
+        self.experiment2.public_access = Experiment.PUBLIC_ACCESS_METADATA
+        self.experiment2.save()
+        self.assertEqual(accessible(AnonymousUser()),
+                         set([self.experiment2.id, self.experiment3.id]))
+
     def testCantAddTokenuserToGroups(self):
         from django.conf import settings
         login = self.client3.login(username=self.user3.username, password='secret')
@@ -56,6 +56,20 @@ class MockGroupProvider(GroupProvider):
             yield group
 
 
+class CachedMockGroupProvider(MockGroupProvider):
+
+    cache_groups = True
+
+    def __init__(self):
+        MockGroupProvider.__init__(self)
+        self.name = u'mockcached'
+        self.lookups = 0
+
+    def getGroups(self, user):
+        self.lookups += 1
+        return MockGroupProvider.getGroups(self, user)
+
+
 class MockRequest(HttpRequest):
 
     def __init__(self):
@@ -177,6 +191,42 @@ class AuthServiceTestCase(TestCase):
         self.assertEqual(len([g for g in a.getGroupsForEntity('Group 123')]),
                          1)
 
+    def testGroupCache(self):
+        from tardis.tardis_portal.auth import AuthService
+        s = MockSettings()
+        s.GROUP_PROVIDERS = \
+            ('tardis.tardis_portal.tests.test_authservice.MockGroupProvider',
+             'tardis.tardis_portal.tests.test_authservice.'
+             'CachedMockGroupProvider')
+        s.GROUP_MEMBERSHIP_CACHE_TIMEOUT = 60
+        a = AuthService(settings=s)
+        a._manual_init()
+        provider = a._group_providers[1]
+
+        groups = sorted(a.getGroups(self.user1))
+        self.assertEqual(groups, [(u'mockcached', '1'), (u'mockcached', '2'),
+                                  (u'mockdb', '1'), (u'mockdb', '2')])
+        self.assertEqual(sorted(a.getGroups(self.user1)), groups)
+        self.assertEqual(provider.lookups, 1)
+
+        # The memberships are shared with other processes
+        b = AuthService(settings=s)
+        b._manual_init()
+        self.assertEqual(sorted(b.getGroups(self.user1)), groups)
+        self.assertEqual(b._group_providers[1].lookups, 0)
+
+        # Invalidating them (as happens on login) forces a new lookup
+        a.invalidateGroups(self.user1)
+        self.assertEqual(sorted(a.getGroups(self.user1)), groups)
+        self.assertEqual(provider.lookups, 2)
+
+        # ... in other processes too, despite their own copies
+        self.assertEqual(sorted(b.getGroups(self.user1)), groups)
+        self.assertEqual(b._group_providers[1].lookups, 0)
+        a.invalidateGroups(self.user1)
+        self.assertEqual(sorted(b.getGroups(self.user1)), groups)
+        self.assertEqual(b._group_providers[1].lookups, 1)
+
     def testAuthenticate(self):
         from tardis.tardis_portal.auth import AuthService
         s = MockSettings()
@@ -18,9 +18,11 @@ from nose.plugins.skip import SkipTest
 
 import filecmp, urlparse
 
-from tardis.tardis_portal.download import StreamingFile, StreamableZipFile
+from tardis.tardis_portal.download import ArchiveBuffer, StreamableZipFile, \
+    _write_tar, _write_zip, _get_archive_length
 from tardis.tardis_portal.models import \
-    Experiment, Dataset, Dataset_File, Location, Replica
+    Experiment, Dataset, Dataset_File, Location, Replica, ObjectACL, \
+    UserProfile
 
 from tempfile import NamedTemporaryFile, mkstemp
 
@@ -49,46 +51,60 @@ def _generate_test_image(testfile):
         f.write("II\x2a\x00")
         f.close()
 
-class StreamingFileTestCase(TestCase):
-
-    def testDirectCopy(self):
-
-        def writeTestData(filename):
-            with open(filename, 'w') as f:
-                from time import sleep
-                for i in range(1,10):
-                    print i
-                    sleep(0.1)
-                    f.write("%d\n" % i)
-
-        # Test the asynchronous flavor
-        reader = StreamingFile(writeTestData, asynchronous_file_creation=True)
-        expect(reader.thread.is_alive()).to_be_truthy()
-        expect(exists(reader.name)).to_be_truthy()
-        contents = reader.read(10)
-        expect(contents).to_equal("\n".join(map(str,range(1,6)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal("\n".join(map(str,range(6,10)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal('')
-        expect(exists(reader.name)).to_be_truthy()
-        reader.close()
-        expect(exists(reader.name)).to_be_falsy()
-        
-        # Test the synchronous flavor
-        reader = StreamingFile(writeTestData, asynchronous_file_creation=False)
-        expect(hasattr(reader, 'thread')).to_be_falsy()
-        expect(exists(reader.name)).to_be_truthy()
-        contents = reader.read(10)
-        expect(contents).to_equal("\n".join(map(str,range(1,6)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal("\n".join(map(str,range(6,10)))+"\n")
-        contents = reader.read(1024)
-        expect(contents).to_equal('')
-        expect(exists(reader.name)).to_be_truthy()
-        reader.close()
-        expect(exists(reader.name)).to_be_falsy()
-        
+class StreamingArchiveTestCase(TestCase):
+
+    def setUp(self):
+        from StringIO import StringIO
+        from time import time
+        contents = [('1/2/hello.txt', 'Hello World!\n'),
+                    (u'1/2/caf\xe9-' + 'x' * 150, 'y' * 1000),
+                    ('1/3/empty', '')]
+        self.files = [((lambda data=data: StringIO(data)), name,
+                       len(data), time())
+                      for name, data in contents]
+
+    def testStreamTar(self):
+        chunks = list(_write_tar(ArchiveBuffer(), self.files))
+        content = ''.join(chunks)
+        expect(len(content)).to_equal(_get_archive_length(_write_tar,
+                                                          self.files))
+        with NamedTemporaryFile() as tempfile:
+            tempfile.write(content)
+            tempfile.flush()
+            tf = TarFile(tempfile.name, 'r')
+            try:
+                expect(len(tf.getnames())).to_equal(3)
+                expect(tf.extractfile('1/2/hello.txt').read())\
+                    .to_equal('Hello World!\n')
+            finally:
+                tf.close()
+
+    def testStreamZip(self):
+        chunks = list(_write_zip(ArchiveBuffer(), self.files))
+        content = ''.join(chunks)
+        expect(len(content)).to_equal(_get_archive_length(_write_zip,
+                                                          self.files))
+        with NamedTemporaryFile() as tempfile:
+            tempfile.write(content)
+            tempfile.flush()
+            zf = ZipFile(tempfile.name, 'r')
+            try:
+                expect(zf.testzip()).to_be(None)
+                expect(len(zf.namelist())).to_equal(3)
+                expect(zf.read('1/2/hello.txt')).to_equal('Hello World!\n')
+            finally:
+                zf.close()
+
+    def testSizeMismatch(self):
+        from StringIO import StringIO
+        files = [((lambda: StringIO('short')), 'short', 10, 0)]
+        for writer in (_write_tar, _write_zip):
+            try:
+                list(writer(ArchiveBuffer(), files))
+                self.fail('Expected an IOError')
+            except IOError:
+                pass
+
 class StreamableZipFileTestCase(TestCase):
     def testCreateZip(self):
         (zipFileObj, self.zipFilename) = mkstemp(suffix='zip')
@@ -315,8 +331,10 @@ class DownloadTestCase(TestCase):
                          'attachment; filename="experiment%s-complete.zip"'
                          % self.experiment1.id)
         self.assertEqual(response.status_code, 200)
+        content = response.content
+        self.assertEqual(int(response['Content-Length']), len(content))
         self._check_zip_file(
-            response.content, str(self.experiment1.id),
+            content, str(self.experiment1.id),
             reduce(lambda x, y: x + y,
                    [ds.dataset_file_set.all() \
                         for ds in self.experiment1.datasets.all()]))
@@ -328,8 +346,10 @@ class DownloadTestCase(TestCase):
                          'attachment; filename="experiment%s-complete.tar"'
                          % self.experiment1.id)
         self.assertEqual(response.status_code, 200)
+        content = response.content
+        self.assertEqual(int(response['Content-Length']), len(content))
         self._check_tar_file(
-            response.content, str(self.experiment1.id),
+            content, str(self.experiment1.id),
             reduce(lambda x, y: x + y,
                    [ds.dataset_file_set.all() \
                         for ds in self.experiment1.datasets.all()]))
@@ -464,6 +484,133 @@ class DownloadTestCase(TestCase):
                              simpleNames=True)
 
 
+    def testAccessResolver(self):
+        from django.contrib.auth.models import AnonymousUser
+        from tardis.tardis_portal.auth.decorators import AccessResolver
+        datasets = [self.dataset1.id, self.dataset2.id]
+
+        resolver = AccessResolver(AnonymousUser())
+        expect(resolver.get_downloadable_dataset_ids(datasets))\
+            .to_equal(set([self.dataset1.id]))
+        # Dataset answers are remembered
+        with self.assertNumQueries(0):
+            expect(resolver.can_download_dataset(self.dataset2.id))\
+                .to_be_falsy()
+        with self.assertNumQueries(2):
+            datafiles = resolver.filter_downloadable_datafiles(
+                Dataset_File.objects.filter(dataset__in=datasets))
+            expect(list(datafiles)).to_equal([self.datafile1])
+
+        # Shared experiments are downloadable
+        UserProfile(user=self.user).save()
+        ObjectACL(content_object=self.experiment2,
+                  pluginId='django_user',
+                  entityId=str(self.user.id),
+                  canRead=True,
+                  aclOwnershipType=ObjectACL.OWNER_OWNED).save()
+        resolver = AccessResolver(self.user)
+        expect(resolver.get_downloadable_dataset_ids(datasets))\
+            .to_equal(set(datasets))
+        expect(resolver.can_download_datafile(self.datafile2.id))\
+            .to_be_truthy()
+        expect(resolver.can_download_experiment(self.experiment2.id))\
+            .to_be_truthy()
+
+    def testRangeDownload(self):
+        client = Client()
+        url = '/download/datafile/%i/' % self.datafile1.id
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Length'], '13')
+        etag = response['ETag']
+        self.assertEqual(etag, '"%s"' % self.datafile1.sha512sum)
+
+        # A single range
+        response = client.get(url, HTTP_RANGE='bytes=6-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 6-10/13')
+        self.assertEqual(response.content, 'World')
+
+        # The tail of a file, as used to resume a download
+        response = client.get(url, HTTP_RANGE='bytes=-7')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, 'World!\n')
+
+        # Multiple ranges
+        response = client.get(url, HTTP_RANGE='bytes=0-4,6-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type']
+                        .startswith('multipart/byteranges; boundary='))
+        content = response.content
+        self.assertEqual(int(response['Content-Length']), len(content))
+        self.assertTrue('Content-Range: bytes 0-4/13\r\n\r\nHello\r\n'
+                        in content)
+        self.assertTrue('Content-Range: bytes 6-10/13\r\n\r\nWorld\r\n'
+                        in content)
+
+        # Unsatisfiable range
+        response = client.get(url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */13')
+
+        # Stale If-Range means the whole file is sent
+        response = client.get(url, HTTP_RANGE='bytes=6-10',
+                              HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'Hello World!\n')
+
+        # Conditional GET
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        response = client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+        # ... but not for users without access
+        response = client.get('/download/datafile/%i/' % self.datafile2.id,
+                              HTTP_IF_NONE_MATCH='"%s"' %
+                              self.datafile2.sha512sum)
+        self.assertEqual(response.status_code, 403)
+
+    def testOffloadDownload(self):
+        client = Client()
+        url = '/download/datafile/%i/' % self.datafile1.id
+        filepath = self.datafile1.get_absolute_filepath()
+        saved = getattr(settings, 'DOWNLOAD_OFFLOAD', None)
+        try:
+            settings.DOWNLOAD_OFFLOAD = 'x-sendfile'
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Sendfile'], filepath)
+            self.assertEqual(response.content, '')
+            self.assertEqual(response['Content-Disposition'],
+                             'attachment; filename="%s"'
+                             % self.datafile1.filename)
+
+            settings.DOWNLOAD_OFFLOAD = 'x-accel-redirect'
+            settings.DOWNLOAD_OFFLOAD_LOCATIONS = {
+                settings.FILE_STORE_PATH: '/protected/'}
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Accel-Redirect'],
+                             '/protected/%d/%d/testfile.txt' %
+                             (self.experiment1.id, self.dataset1.id))
+
+            # Unmapped files are sent by Django
+            settings.DOWNLOAD_OFFLOAD_LOCATIONS = {'/elsewhere': '/other/'}
+            response = client.get(url)
+            self.assertFalse(response.has_header('X-Accel-Redirect'))
+            self.assertEqual(response.content, 'Hello World!\n')
+
+            # Access checks still apply
+            response = client.get('/download/datafile/%i/' %
+                                  self.datafile2.id)
+            self.assertEqual(response.status_code, 403)
+        finally:
+            settings.DOWNLOAD_OFFLOAD = saved
+
     def testDatasetFile(self):
 
         # check registered text file for physical file meta information
@@ -384,3 +384,152 @@ class ExtraTestCases(TestCase):
         # By default the image is now private, so
         ensure('private' in response['Cache-Control'], True,
                "Image should have a Cache-Control header")
+
+
+class DerivativeCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.datafile = _create_datafile()
+        self.cache_dir = tempfile.mkdtemp()
+        self.saved_cache_dir = settings.IIIF_CACHE_DIR
+        settings.IIIF_CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        from shutil import rmtree
+        settings.IIIF_CACHE_DIR = self.saved_cache_dir
+        rmtree(self.cache_dir)
+
+    def _get_cached_files(self):
+        return [f for _, _, files in os.walk(self.cache_dir) for f in files]
+
+    def testRendersAreCached(self):
+        from tardis.tardis_portal.derivatives import get_derivative_key
+        client = Client()
+        kwargs = {'datafile_id': self.datafile.id,
+                  'region': 'full',
+                  'size': '50,',
+                  'rotation': '0',
+                  'quality': 'native',
+                  'format': 'jpg' }
+        url = reverse('tardis.tardis_portal.iiif.download_image',
+                      kwargs=kwargs)
+        response = client.get(url)
+        expect(response.status_code).to_equal(200)
+        key = get_derivative_key(self.datafile, 'full', '50,', '0',
+                                 'native', 'jpg')
+        expect(self._get_cached_files()).to_equal([key])
+
+        # The second request is served from the cache
+        with open(os.path.join(self.cache_dir, key[:2], key), 'wb') as f:
+            f.write(response.content + 'cached')
+        response = client.get(url)
+        expect(response.status_code).to_equal(200)
+        expect(response.content.endswith('cached')).to_be_truthy()
+        expect(response['Content-Type']).to_equal('image/jpeg')
+
+        # Different arguments give a different render
+        kwargs['size'] = '20,'
+        response = client.get(reverse('tardis.tardis_portal.iiif.'+
+                                      'download_image', kwargs=kwargs))
+        expect(response.status_code).to_equal(200)
+        expect(len(self._get_cached_files())).to_equal(2)
+
+    def testLeastRecentlyUsedAreEvicted(self):
+        import time
+        from tardis.tardis_portal.derivatives import DerivativeCache
+        cache = DerivativeCache(self.cache_dir, 250)
+        for key in ('aa1', 'bb2', 'cc3'):
+            cache.put(key, 'x' * 100)
+            # Make each one older than the last
+            path = cache.get_path(key)
+            os.utime(path, (time.time() - 1000, time.time() - 1000))
+        expect(cache.get_path('aa1')).to_be_falsy()
+        # Reading bumps the entry's recency ...
+        expect(cache.get('bb2')).to_equal('x' * 100)
+        cache.put('dd4', 'x' * 100)
+        # ... so the other old one went first
+        expect(cache.get('cc3')).to_be(None)
+        expect(cache.get('bb2')).to_equal('x' * 100)
+        expect(cache.get('dd4')).to_equal('x' * 100)
+
+    def testRendersArePregenerated(self):
+        from tardis.tardis_portal.iiif import pregenerate_images
+        renders = [('full', '50,', '0', 'native', 'jpg'),
+                   ('full', ',10', '0', 'native', 'png')]
+        expect(pregenerate_images(self.datafile, renders)).to_equal(2)
+        # (The renders, plus the image's manifest)
+        expect(len(self._get_cached_files())).to_equal(3)
+        # Existing renders are skipped
+        expect(pregenerate_images(self.datafile, renders)).to_equal(0)
+
+        # Verifying a new image triggers the background rendering
+        saved = settings.IIIF_PREGENERATED_RENDERS
+        try:
+            settings.IIIF_PREGENERATED_RENDERS = \
+                [('full', '30,', '0', 'native', 'jpg')]
+            replica = self.datafile.get_preferred_replica()
+            replica.verified = False
+            replica.save()
+            replica.verify(allowEmptyChecksums=True)
+            replica.save()
+            expect(len(self._get_cached_files())).to_equal(4)
+        finally:
+            settings.IIIF_PREGENERATED_RENDERS = saved
+
+    def testLargeImagesAreServedFromTiles(self):
+        from tardis.tardis_portal.derivatives import get_derivative_key
+        from tardis.tardis_portal.iiif import pregenerate_images, \
+            get_image_manifest
+        saved = (settings.IIIF_TILING_THRESHOLD, settings.IIIF_TILE_SIZE)
+        try:
+            settings.IIIF_TILING_THRESHOLD = 32
+            settings.IIIF_TILE_SIZE = 16
+            pregenerate_images(self.datafile, [])
+            # 70x46 becomes 5x3 + 3x2 + 2x1 + 1 tiles, plus the manifest
+            expect(len(self._get_cached_files())).to_equal(25)
+            manifest = get_image_manifest(self.datafile)
+            expect(manifest['scale_factors']).to_equal([1, 2, 4, 8])
+
+            client = Client()
+            response = client.get(
+                reverse('tardis.tardis_portal.iiif.download_info',
+                        kwargs={'datafile_id': self.datafile.id,
+                                'format': 'json'}))
+            data = json.loads(response.content)
+            expect(data['width']).to_equal(70)
+            expect(data['tile_width']).to_equal(16)
+            expect(data['scale_factors']).to_equal([1, 2, 4, 8])
+
+            def get_image(region, size):
+                kwargs = {'datafile_id': self.datafile.id,
+                          'region': region,
+                          'size': size,
+                          'rotation': '0',
+                          'quality': 'native',
+                          'format': 'png' }
+                response = client.get(
+                    reverse('tardis.tardis_portal.iiif.download_image',
+                            kwargs=kwargs))
+                expect(response.status_code).to_equal(200)
+                return Image(blob=response.content)
+
+            # Full resolution regions are pixel-perfect
+            with get_image('10,10,40,20', 'full') as img:
+                expect((img.width, img.height)).to_equal((40, 20))
+                with Image(filename='magick:rose') as rose:
+                    rose.crop(10, 10, width=40, height=20)
+                    expect(img.make_blob('rgb'))\
+                        .to_equal(rose.make_blob('rgb'))
+            with get_image('full', '10,') as img:
+                expect((img.width, img.height)).to_equal((10, 7))
+
+            # Missing tiles fall back to decoding the image
+            manifest_key = get_derivative_key(self.datafile, 'pyramid')
+            for dirpath, _, filenames in os.walk(self.cache_dir):
+                for filename in filenames:
+                    if filename != manifest_key:
+                        os.unlink(os.path.join(dirpath, filename))
+            with get_image('0,0,20,20', 'full') as img:
+                expect((img.width, img.height)).to_equal((20, 20))
+        finally:
+            settings.IIIF_TILING_THRESHOLD, settings.IIIF_TILE_SIZE = saved
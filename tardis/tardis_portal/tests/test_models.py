@@ -36,7 +36,8 @@ http://docs.djangoproject.com/en/dev/topics/testing/
 
 """
 from django.conf import settings
-from django.test import TestCase
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 
 
 class ModelTestCase(TestCase):
@@ -193,6 +194,65 @@ class ModelTestCase(TestCase):
             settings.REQUIRE_DATAFILE_CHECKSUMS = save2
             
 
+    def test_size_rollups(self):
+        from tardis.tardis_portal.models import Experiment, Dataset, \
+            Dataset_File, DatasetRollup, ExperimentRollup
+
+        exp = Experiment(title='test exp1',
+                         institution_name='monash',
+                         created_by=self.user)
+        exp.save()
+        dataset1 = Dataset(description="dataset 1")
+        dataset1.save()
+        dataset1.experiments.add(exp)
+        dataset2 = Dataset(description="dataset 2")
+        dataset2.save()
+
+        md5sum = '0' * 32
+        saved = settings.REQUIRE_DATAFILE_SIZES
+        try:
+            settings.REQUIRE_DATAFILE_SIZES = False
+            df1 = Dataset_File(dataset=dataset1, filename='1', size='100',
+                               md5sum=md5sum)
+            df1.save()
+            Dataset_File(dataset=dataset1, filename='2', size='23',
+                         md5sum=md5sum).save()
+            Dataset_File(dataset=dataset1, filename='3', size='',
+                         md5sum=md5sum).save()
+            Dataset_File(dataset=dataset2, filename='4', size='1000',
+                         md5sum=md5sum).save()
+        finally:
+            settings.REQUIRE_DATAFILE_SIZES = saved
+
+        def check(obj, file_count, size):
+            obj = obj.__class__.objects.get(id=obj.id)
+            self.assertEqual(obj.get_file_count(), file_count)
+            self.assertEqual(obj.get_size(), size)
+
+        self.assertEqual(df1.size_bytes, 100)
+        self.assertEqual(Dataset_File.sum_sizes(Dataset_File.objects.all()),
+                         1123)
+        check(dataset1, 3, 123)
+        check(exp, 3, 123)
+
+        # Changes are rolled up once the rollups exist...
+        df1.size = '1'
+        df1.save()
+        check(dataset1, 3, 24)
+        check(exp, 3, 24)
+        df1.delete()
+        check(dataset1, 2, 23)
+        check(exp, 2, 23)
+        # ...as are changes to the datasets in the experiment
+        dataset2.experiments.add(exp)
+        check(exp, 3, 1023)
+        dataset1.delete()
+        check(exp, 1, 1000)
+        # Rollups are computed if missing
+        ExperimentRollup.objects.all().delete()
+        check(exp, 1, 1000)
+        self.assertEqual(DatasetRollup.get_for(dataset2).size, 1000)
+
     def test_location(self):
         from tardis.tardis_portal.models import Location
         self.assertEquals(Location.get_default_location().name,
@@ -300,3 +360,29 @@ class ModelTestCase(TestCase):
         remove(path.join(settings.FILE_STORE_PATH, df_parameter.string_value))
         remove(path.join(settings.FILE_STORE_PATH, ds_parameter.string_value))
         remove(path.join(settings.FILE_STORE_PATH, exp_parameter.string_value))
+
+
+class RollupTransactionTestCase(TransactionTestCase):
+
+    def setUp(self):
+        from tardis.tardis_portal.models import Location
+        Location.force_initialize()
+
+    def test_update_for_joins_transaction(self):
+        from tardis.tardis_portal.models import Dataset, Dataset_File, \
+            DatasetRollup
+
+        @transaction.commit_on_success
+        def ingest():
+            dataset = Dataset(description='rolled back')
+            dataset.save()
+            Dataset_File(dataset=dataset, filename='1', size='1',
+                         md5sum='0' * 32).save()
+            DatasetRollup.update_for([dataset.id])
+            raise ValueError('ingest failed')
+
+        self.assertRaises(ValueError, ingest)
+        # Recomputing the rollup didn't commit the ingest's work
+        self.assertEqual(Dataset.objects.count(), 0)
+        self.assertEqual(Dataset_File.objects.count(), 0)
+        self.assertEqual(DatasetRollup.objects.count(), 0)
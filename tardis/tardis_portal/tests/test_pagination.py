@@ -0,0 +1,79 @@
+from compare import expect
+from django.test import TestCase
+from django.test.client import Client
+
+from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File, \
+    User
+from tardis.tardis_portal.pagination import get_keyset_page
+
+
+class KeysetPaginationTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', '', 'pwd')
+        self.dataset = Dataset()
+        self.dataset.save()
+        # Duplicate filenames, so pages must be split by id
+        for filename in ['c', 'a', 'b', 'a', 'c', 'b', 'a']:
+            Dataset_File.objects.create(dataset=self.dataset,
+                                        filename=filename, size='1',
+                                        md5sum='bogus')
+
+    def _get_all_pages(self, queryset, ordering, per_page):
+        pages = []
+        cursor = None
+        while True:
+            with self.assertNumQueries(1):
+                page = get_keyset_page(queryset, ordering, cursor, per_page)
+            pages.append([obj.id for obj in page])
+            if not page.has_next():
+                return pages
+            cursor = page.next_cursor
+
+    def testPagesFollowOrdering(self):
+        datafiles = Dataset_File.objects.filter(dataset=self.dataset)
+        expected = list(datafiles.order_by('filename', 'id')
+                                 .values_list('id', flat=True))
+        pages = self._get_all_pages(datafiles, ('filename', 'id'), 2)
+        expect(len(pages)).to_equal(4)
+        expect(sum(pages, [])).to_equal(expected)
+
+    def testDescendingDateOrdering(self):
+        for i in range(5):
+            Experiment.objects.create(title='Experiment %d' % i,
+                                      created_by=self.user)
+        experiments = Experiment.objects.all()
+        expected = list(experiments.order_by('-update_time', '-id')
+                                   .values_list('id', flat=True))
+        pages = self._get_all_pages(experiments, ('-update_time', '-id'), 3)
+        expect(sum(pages, [])).to_equal(expected)
+
+    def testInvalidCursorGivesFirstPage(self):
+        datafiles = Dataset_File.objects.filter(dataset=self.dataset)
+        first = get_keyset_page(datafiles, ('filename', 'id'), None, 2)
+        for cursor in ('junk', 'WyJhIl0=', ''):
+            page = get_keyset_page(datafiles, ('filename', 'id'), cursor, 2)
+            expect(page.object_list).to_equal(first.object_list)
+
+    def testExperimentListScrolling(self):
+        from tardis.tardis_portal import views
+        for i in range(3):
+            Experiment.objects.create(title='Experiment %d' % i,
+                                      created_by=self.user,
+                                      public_access=100)
+        page_size = views.EXPERIMENT_LIST_PAGE_SIZE
+        views.EXPERIMENT_LIST_PAGE_SIZE = 2
+        try:
+            client = Client()
+            response = client.get('/experiment/list/public')
+            expect(response.status_code).to_equal(200)
+            cursor = response.context['experiments'].next_cursor
+            expect(cursor).to_be_truthy()
+            response = client.get('/experiment/list/public',
+                                  {'cursor': cursor},
+                                  HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            expect(response.status_code).to_equal(200)
+            expect(response.content).to_contain('Experiment 0')
+            expect(response.content).not_to_contain('<table')
+        finally:
+            views.EXPERIMENT_LIST_PAGE_SIZE = page_size
@@ -0,0 +1,83 @@
+from compare import expect
+from django.test import TestCase
+
+from tardis.tardis_portal.models import Dataset, Dataset_File, Schema, \
+    ParameterName, DatafileParameterSet, DatafileParameter
+from tardis.tardis_portal.parameter_search import filter_by_parameters, \
+    get_parameter_constraints
+
+
+class ParameterSearchTestCase(TestCase):
+
+    def setUp(self):
+        schema = Schema(namespace='http://test.com/search',
+                        type=Schema.DATAFILE)
+        schema.save()
+        self.energy = ParameterName(
+            schema=schema, name='energy', full_name='Energy',
+            data_type=ParameterName.NUMERIC,
+            comparison_type=ParameterName.RANGE_COMPARISON)
+        self.energy.save()
+        self.beamline = ParameterName(
+            schema=schema, name='beamline', full_name='Beamline',
+            data_type=ParameterName.STRING,
+            comparison_type=ParameterName.CONTAINS_COMPARISON)
+        self.beamline.save()
+        self.schema = schema
+        dataset = Dataset()
+        dataset.save()
+        self.datafiles = [
+            self._create_datafile(dataset, 'a', 10.0, 'MX1'),
+            self._create_datafile(dataset, 'b', 20.0, 'MX1'),
+            self._create_datafile(dataset, 'c', 20.0, 'MX2'),
+            self._create_datafile(dataset, 'd', 20.0, None),
+        ]
+
+    def _create_datafile(self, dataset, filename, energy, beamline):
+        datafile = Dataset_File(dataset=dataset, filename=filename,
+                                size='1', sha512sum='0' * 128)
+        datafile.save()
+        parameterset = DatafileParameterSet(schema=self.schema,
+                                            dataset_file=datafile)
+        parameterset.save()
+        DatafileParameter(parameterset=parameterset, name=self.energy,
+                          numerical_value=energy).save()
+        if beamline:
+            DatafileParameter(parameterset=parameterset, name=self.beamline,
+                              string_value=beamline).save()
+        return datafile
+
+    def _search(self, formData):
+        constraints = get_parameter_constraints(
+            [self.energy, self.beamline], formData)
+        return sorted(filter_by_parameters(
+            Dataset_File.objects.all(), DatafileParameter, 'dataset_file',
+            constraints).values_list('filename', flat=True))
+
+    def testConstraints(self):
+        formData = {'energy_%d' % self.energy.id + 'From': 15.0,
+                    'energy_%d' % self.energy.id + 'To': None,
+                    'beamline_%d' % self.beamline.id: 'mx1'}
+        expect(get_parameter_constraints([self.energy, self.beamline],
+                                         formData)) \
+            .to_equal([(self.energy.id, 'numerical_value__range',
+                        (15.0, 9999999999)),
+                       (self.beamline.id, 'string_value__icontains', 'mx1')])
+        # Parameters without values aren't constrained
+        formData['beamline_%d' % self.beamline.id] = ''
+        expect(len(get_parameter_constraints([self.energy, self.beamline],
+                                             formData))).to_equal(1)
+
+    def testEveryConstraintMustMatch(self):
+        formData = {'energy_%d' % self.energy.id + 'From': 15.0,
+                    'energy_%d' % self.energy.id + 'To': 25.0,
+                    'beamline_%d' % self.beamline.id: 'mx1'}
+        expect(self._search(formData)).to_equal(['b'])
+        formData['beamline_%d' % self.beamline.id] = 'mx'
+        expect(self._search(formData)).to_equal(['b', 'c'])
+        formData['beamline_%d' % self.beamline.id] = ''
+        expect(self._search(formData)).to_equal(['b', 'c', 'd'])
+        # No constraints at all
+        formData['energy_%d' % self.energy.id + 'From'] = None
+        formData['energy_%d' % self.energy.id + 'To'] = None
+        expect(self._search(formData)).to_equal(['a', 'b', 'c', 'd'])
@@ -0,0 +1,278 @@
+from datetime import timedelta
+
+from compare import expect
+from django.test import TestCase
+from flexmock import flexmock
+from haystack import site
+
+from tardis.tardis_portal.models import Experiment, Author_Experiment, \
+    Dataset, Dataset_File, Schema, ParameterName, DatafileParameterSet, \
+    DatafileParameter, DatasetParameterSet, DatasetParameter, \
+    ExperimentParameterSet, ExperimentParameter, FreeTextSearchField, User
+from tardis.tardis_portal import search_indexes, search_queue
+from tardis.tardis_portal.search_indexes import LRUCache, index_datafiles, \
+    prepareFieldName, reindex_fields, search_fields, \
+    SearchFieldRegistry, get_datafiles_with_parameters
+from tardis.tardis_portal.tasks import reindex_search_fields
+
+
+class StubBackend(object):
+    """ Records the documents that would have been sent to Solr. """
+
+    def __init__(self):
+        self.documents = {}
+        self.removed = []
+        self.commits = 0
+        self.conn = self
+
+    def update(self, index, iterable, commit=True):
+        for obj in iterable:
+            self.documents[obj.pk] = dict(index.prepare(obj))
+
+    def remove(self, obj_or_string, commit=True):
+        self.removed.append(obj_or_string)
+
+    def commit(self):
+        self.commits += 1
+
+
+class LRUCacheTestCase(TestCase):
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        expect(cache.get('a')).to_equal(1)
+        cache['c'] = 3
+        expect(len(cache)).to_equal(2)
+        expect(cache.get('b')).to_be(None)
+        expect(cache.get('a')).to_equal(1)
+        expect(cache.get('c')).to_equal(3)
+
+    def testHeapIsRebuilt(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        for _ in range(1000):
+            cache.get('b')
+        # The pairs for old uses of 'b' don't pile up
+        expect(len(cache._heap) <= 2 * cache.size + 100).to_be_truthy()
+        cache['c'] = 3
+        expect(cache.get('a')).to_be(None)
+        expect(cache.get('b')).to_equal(2)
+
+    def testDiscardAndClear(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.discard('a')
+        cache.discard('missing')
+        expect(cache.get('a')).to_be(None)
+        # A discarded entry's heap pair doesn't evict anything later
+        cache['c'] = 3
+        expect(cache.get('b')).to_equal(2)
+        cache.clear()
+        expect(len(cache)).to_equal(0)
+
+
+class SearchIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.index = site.get_index(Dataset_File)
+        self.backend = self.index.backend
+        self.index.backend = StubBackend()
+        user = User.objects.create_user('indexuser', 'user@email.test', 'pwd')
+        self.experiment = Experiment.objects.create(
+            title='Indexed Experiment', institution_name='Test University',
+            created_by=user)
+        Author_Experiment.objects.create(experiment=self.experiment,
+                                         author='Joe Bloggs', order=0)
+        self.dataset = Dataset(description='Indexed Dataset')
+        self.dataset.save()
+        self.dataset.experiments.add(self.experiment)
+        schema = Schema.objects.create(namespace='http://test.com/index',
+                                       name='Index', type=Schema.DATAFILE)
+        self.energy = ParameterName.objects.create(
+            schema=schema, name='energy', full_name='Energy',
+            data_type=ParameterName.NUMERIC, is_searchable=True)
+        self.datafile = Dataset_File(dataset=self.dataset, filename='indexed',
+                                     size='1', sha512sum='0' * 128)
+        self.datafile.save()
+        parameterset = DatafileParameterSet.objects.create(
+            schema=schema, dataset_file=self.datafile)
+        DatafileParameter.objects.create(parameterset=parameterset,
+                                         name=self.energy,
+                                         numerical_value=12.5)
+
+    def tearDown(self):
+        self.index.backend = self.backend
+
+    def testIndexDatafiles(self):
+        missing = index_datafiles([self.datafile.id, 999999], [42])
+        expect(missing).to_equal([999999])
+        backend = self.index.backend
+        expect(backend.commits).to_equal(1)
+        expect(len(backend.removed)).to_equal(1)
+        document = backend.documents[self.datafile.id]
+        expect(document['experiment_id_stored']).to_equal(self.experiment.id)
+        expect(document['experiment_title']).to_equal('Indexed Experiment')
+        expect(document['experiment_authors']).to_equal(['Joe Bloggs'])
+        expect(document['experiment_creator']).to_contain('indexuser')
+        expect(document['dataset_description']).to_equal('Indexed Dataset')
+        expect(document[prepareFieldName(self.energy)]).to_equal(12.5)
+        for text in ('indexed', 'Indexed Experiment', 'Test University',
+                     'Indexed Dataset', 'Joe Bloggs'):
+            expect(document['text']).to_contain(text)
+
+    def testDatasetWithoutExperiment(self):
+        dataset = Dataset(description='Orphan')
+        dataset.save()
+        datafile = Dataset_File(dataset=dataset, filename='orphan',
+                                size='1', sha512sum='0' * 128)
+        datafile.save()
+        expect(index_datafiles([datafile.id])).to_equal([])
+        document = self.index.backend.documents[datafile.id]
+        expect(document.get('experiment_id_stored')).to_be(None)
+        expect(document['text']).to_contain('Orphan')
+
+    def testRealTimeMatchesBulk(self):
+        # A datafile indexed on its own has the same document
+        index_datafiles([self.datafile.id])
+        expect(self.index.prepare(self.datafile)) \
+            .to_equal(self.index.backend.documents[self.datafile.id])
+
+    def _cached_experiment(self):
+        return self.index._cache.get(('experiment', self.experiment.id))
+
+    def testCacheInvalidation(self):
+        index_datafiles([self.datafile.id])
+        expect(self._cached_experiment()).to_be_truthy()
+        Author_Experiment.objects.create(experiment=self.experiment,
+                                         author='Jane Doe', order=1)
+        expect(self._cached_experiment()).to_be(None)
+        document = self.index.prepare(self.datafile)
+        expect(document['experiment_authors']) \
+            .to_equal(['Joe Bloggs', 'Jane Doe'])
+        expect(self._cached_experiment()).to_be_truthy()
+        # Changing which parameters are free text indexed drops everything
+        FreeTextSearchField.objects.create(parameter_name=self.energy)
+        expect(len(self.index._cache)).to_equal(0)
+
+    def testChangesByOtherProcesses(self):
+        schema = Schema.objects.create(namespace='http://test.com/ds-index',
+                                       name='Dataset Index',
+                                       type=Schema.DATASET)
+        size = ParameterName.objects.create(
+            schema=schema, name='size', full_name='Size',
+            data_type=ParameterName.NUMERIC, is_searchable=True)
+        parameterset = DatasetParameterSet.objects.create(
+            schema=schema, dataset=self.dataset)
+        DatasetParameter.objects.create(parameterset=parameterset, name=size,
+                                        numerical_value=1)
+        document = self.index.prepare(self.datafile)
+        expect(document[prepareFieldName(size)]).to_equal(1)
+
+        # (Updating the rows directly sends no signals, as if another
+        # process had made the changes)
+        DatasetParameter.objects.filter(name=size).update(numerical_value=2)
+        Dataset.objects.filter(id=self.dataset.id) \
+                       .update(description='Redescribed')
+        Experiment.objects.filter(id=self.experiment.id).update(
+            title='Retitled',
+            update_time=self.experiment.update_time + timedelta(hours=1))
+        document = self.index.prepare(Dataset_File.objects.get(
+            id=self.datafile.id))
+        expect(document[prepareFieldName(size)]).to_equal(2)
+        expect(document['dataset_description']).to_equal('Redescribed')
+        expect(document['experiment_title']).to_equal('Retitled')
+        expect(document['text']).to_contain('Redescribed')
+        expect(document['text']).to_contain('Retitled')
+
+    def testRegistryRefresh(self):
+        registry = SearchFieldRegistry()
+        expect(registry.refresh()).to_contain(self.energy.id)
+        version = registry.version
+        expect(registry.names[self.energy.id]) \
+            .to_equal(prepareFieldName(self.energy))
+        # Not due to be checked again yet, and unchanged when it is
+        expect(registry.refresh()).to_equal(set())
+        expect(registry.refresh(force=True)).to_equal(set())
+        expect(registry.version).to_equal(version)
+        ParameterName.objects.filter(id=self.energy.id) \
+                             .update(is_searchable=False)
+        expect(registry.refresh(force=True)).to_equal(set([self.energy.id]))
+        expect(registry.version).to_equal(version + 1)
+        expect(registry.names.get(self.energy.id)).to_be(None)
+
+    def testRefreshFieldsAddsAndRemovesFields(self):
+        field_name = prepareFieldName(self.energy)
+        expect(self.index.fields).to_contain(field_name)
+        version = search_fields.version
+        ParameterName.objects.filter(id=self.energy.id) \
+                             .update(is_searchable=False)
+        expect(self.index.refresh_fields(force=True)) \
+            .to_equal(set([self.energy.id]))
+        expect(field_name in self.index.fields).to_equal(False)
+        expect(search_fields.version).to_equal(version + 1)
+        ParameterName.objects.filter(id=self.energy.id) \
+                             .update(is_searchable=True)
+        self.index.refresh_fields(force=True)
+        expect(self.index.fields[field_name].instance_name) \
+            .to_equal(field_name)
+        document = self.index.prepare(self.datafile)
+        expect(document[field_name]).to_equal(12.5)
+
+    def testGetDatafilesWithParameters(self):
+        other = Dataset_File(dataset=self.dataset, filename='other',
+                             size='1', sha512sum='0' * 128)
+        other.save()
+        dataset = Dataset(description='Second')
+        dataset.save()
+        dataset.experiments.add(self.experiment)
+        third = Dataset_File(dataset=dataset, filename='third', size='1',
+                             sha512sum='0' * 128)
+        third.save()
+        names = {}
+        for schema_type, set_model, param_model, field, target in (
+                (Schema.DATASET, DatasetParameterSet, DatasetParameter,
+                 'dataset', self.dataset),
+                (Schema.EXPERIMENT, ExperimentParameterSet,
+                 ExperimentParameter, 'experiment', self.experiment)):
+            schema = Schema.objects.create(
+                namespace='http://test.com/index/%s' % field, name=field,
+                type=schema_type)
+            names[field] = ParameterName.objects.create(
+                schema=schema, name='size', full_name='Size',
+                data_type=ParameterName.NUMERIC)
+            param_model.objects.create(
+                parameterset=set_model.objects.create(
+                    schema=schema, **{field: target}),
+                name=names[field], numerical_value=1)
+        expect(get_datafiles_with_parameters([self.energy.id])) \
+            .to_equal([self.datafile.id])
+        expect(get_datafiles_with_parameters([names['dataset'].id])) \
+            .to_equal([self.datafile.id, other.id])
+        expect(get_datafiles_with_parameters([names['experiment'].id])) \
+            .to_equal([self.datafile.id, other.id, third.id])
+        expect(get_datafiles_with_parameters([])).to_equal([])
+
+    def testFieldChangesAreLookedUpByTask(self):
+        # Saving the ParameterName only queues the task
+        flexmock(search_indexes).should_receive(
+            'get_datafiles_with_parameters').never()
+        flexmock(search_queue).should_receive('queue_fields') \
+            .with_args([(self.energy.id, None)]).once()
+        self.energy.is_searchable = False
+        self.energy.save()
+
+    def testReindexFields(self):
+        fields = [(self.energy.id, prepareFieldName(self.energy))]
+        flexmock(search_queue).should_receive('queue') \
+            .with_args([self.datafile.id], (), fields=fields).once()
+        expect(reindex_fields(fields)).to_equal(True)
+        # A change that can't be seen yet is looked for again later
+        fields = [(self.energy.id, None)]
+        expect(reindex_fields(fields)).to_equal(False)
+        flexmock(search_queue).should_receive('queue_fields') \
+            .with_args(fields, 1).once()
+        reindex_search_fields(fields, 0)
@@ -0,0 +1,52 @@
+from django.db import transaction
+from django.test import TestCase
+from flexmock import flexmock
+
+from tardis.tardis_portal import search_queue
+from tardis.tardis_portal.tasks import update_search_index
+
+
+class SearchQueueTestCase(TestCase):
+
+    def setUp(self):
+        # Drop anything queued by other tests
+        flexmock(update_search_index).should_receive('apply_async')
+        search_queue.flush()
+
+    def testChangesAreCoalesced(self):
+        flexmock(update_search_index).should_receive('apply_async') \
+            .with_args(args=[[1, 2], [3], 0], countdown=5).once()
+        search_queue.enqueue_update(2)
+        search_queue.enqueue_update(1)
+        search_queue.enqueue_update(2)
+        search_queue.enqueue_update(3)
+        search_queue.enqueue_removal(3)
+        search_queue.flush()
+        # Nothing is left to queue
+        search_queue.flush()
+
+    def testFullBatchIsQueued(self):
+        from django.conf import settings
+        flexmock(update_search_index).should_receive('apply_async') \
+            .with_args(args=[[1, 2], [], 0], countdown=5).once()
+        batch_size = getattr(settings, 'SEARCH_INDEX_BATCH_SIZE', None)
+        settings.SEARCH_INDEX_BATCH_SIZE = 2
+        try:
+            # Within a transaction, the batch waits to be flushed
+            search_queue.enqueue_update(1)
+            search_queue.enqueue_update(2)
+            flexmock(transaction).should_receive('is_managed') \
+                .and_return(False)
+            search_queue.enqueue_update(1)
+        finally:
+            if batch_size is None:
+                del settings.SEARCH_INDEX_BATCH_SIZE
+            else:
+                settings.SEARCH_INDEX_BATCH_SIZE = batch_size
+
+    def testMissingDatafilesAreRequeued(self):
+        flexmock(update_search_index).should_receive('apply_async') \
+            .with_args(args=[[2], [], 1], countdown=5).once()
+        search_queue.requeue([2], 0)
+        # Until they've been tried SEARCH_INDEX_RETRIES times
+        search_queue.requeue([2], 3)
@@ -0,0 +1,58 @@
+from compare import expect
+from django.core.cache import cache
+from django.test import TestCase
+
+from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File, \
+    ExperimentRollup, User
+from tardis.tardis_portal import stats
+
+
+class StatsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('testuser', '', 'pwd')
+        self.experiment = self._create_experiment('Stats Test')
+
+    def _create_experiment(self, title):
+        experiment = Experiment.objects.create(title=title,
+                                               created_by=self.user)
+        dataset = Dataset()
+        dataset.save()
+        dataset.experiments.add(experiment)
+        for i in range(3):
+            Dataset_File.objects.create(dataset=dataset, filename=str(i),
+                                        size='100', md5sum='bogus')
+        return experiment
+
+    def testSiteStats(self):
+        expected = {'experiment_count': 1, 'dataset_count': 1,
+                    'datafile_count': 3, 'datafile_size': 300}
+        expect(stats.get_site_stats()).to_equal(expected)
+        # Served from the cache, and kept up to date
+        with self.assertNumQueries(0):
+            expect(stats.get_site_stats()).to_equal(expected)
+        self._create_experiment('More Stats')
+        Dataset_File.objects.get(filename='0',
+                                 dataset__experiments=self.experiment).delete()
+        expected = {'experiment_count': 2, 'dataset_count': 2,
+                    'datafile_count': 5, 'datafile_size': 500}
+        with self.assertNumQueries(0):
+            expect(stats.get_site_stats()).to_equal(expected)
+        # Changes that bypass signals are reconciled
+        Dataset_File.objects.update(size_bytes=1)
+        expect(stats.get_site_stats()['datafile_size']).to_equal(500)
+        stats.reconcile_site_stats()
+        expect(stats.get_site_stats()['datafile_size']).to_equal(5)
+
+    def testExperimentCounts(self):
+        other = self._create_experiment('More Stats')
+        ExperimentRollup.objects.filter(experiment=other).delete()
+        experiments = stats.with_experiment_counts(
+            Experiment.objects.order_by('id'))
+        with self.assertNumQueries(1):
+            counts = [(e.dataset_count, e.file_count) for e in experiments]
+        expect(counts).to_equal([(1, 3), (1, None)])
+        expect(stats.get_experiment_file_counts([self.experiment.id,
+                                                 other.id])) \
+            .to_equal({self.experiment.id: 3, other.id: 3})
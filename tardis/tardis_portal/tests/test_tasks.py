@@ -1,13 +1,15 @@
 import hashlib
+from datetime import datetime, timedelta
 from os import path, urandom
 
 from compare import ensure, expect
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.test import TestCase
 from tempfile import NamedTemporaryFile
 
 from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File, \
-    Replica, Location, User, UserProfile
+    Replica, Location, User, UserProfile, FixityCheck
 from tardis.tardis_portal.staging import write_uploaded_file_to_dataset
 
 from tardis.tardis_portal.tasks import verify_files
@@ -66,6 +68,69 @@ class BackgroundTaskTestCase(TestCase):
         expect(get_replica(datafile).verified).to_be(True)
 
 
+    def _create_local_replica(self, content, sha512sum=None):
+        cf = ContentFile(content, 'background_task_testfile')
+        datafile = Dataset_File(dataset=self.dataset)
+        datafile.filename = cf.name
+        datafile.size = len(content)
+        datafile.sha512sum = sha512sum or hashlib.sha512(content).hexdigest()
+        datafile.save()
+        replica = Replica(datafile=datafile,
+                          url=write_uploaded_file_to_dataset(self.dataset, cf),
+                          location=Location.get_default_location())
+        replica.save()
+        return replica
+
+    def testLeasedReplicasAreNotQueued(self):
+        replica = self._create_local_replica(urandom(1024))
+        # Already queued
+        Replica.objects.filter(id=replica.id).update(
+            verification_lease=datetime.now() + timedelta(hours=1))
+        verify_files()
+        expect(Replica.objects.get(id=replica.id).verified).to_be(False)
+        # Queued, but the lease has expired
+        Replica.objects.filter(id=replica.id).update(
+            verification_lease=datetime.now() - timedelta(seconds=1))
+        verify_files()
+        replica = Replica.objects.get(id=replica.id)
+        expect(replica.verified).to_be(True)
+        expect(replica.verification_lease).to_be(None)
+
+    def testQueueLimit(self):
+        replicas = [self._create_local_replica(urandom(1024))
+                    for _ in range(3)]
+        saved = getattr(settings, 'VERIFY_MAX_QUEUED', None)
+        settings.VERIFY_MAX_QUEUED = 2
+        try:
+            # One replica is still queued from an earlier run
+            Replica.objects.filter(id=replicas[2].id).update(
+                verification_lease=datetime.now() + timedelta(hours=1))
+            verify_files()
+            expect(Replica.objects.filter(verified=True).count()).to_equal(1)
+        finally:
+            if saved is None:
+                del settings.VERIFY_MAX_QUEUED
+            else:
+                settings.VERIFY_MAX_QUEUED = saved
+
+    def testFailedReplicasAreRetriedLater(self):
+        replica = self._create_local_replica(urandom(1024), '0' * 128)
+        verify_files()
+        expect(FixityCheck.objects.filter(replica=replica).count()) \
+            .to_equal(1)
+        replica = Replica.objects.get(id=replica.id)
+        expect(replica.verified).to_be(False)
+        expect(replica.verification_lease).to_be(None)
+        # Not checked again until the retry delay has passed
+        verify_files()
+        expect(FixityCheck.objects.filter(replica=replica).count()) \
+            .to_equal(1)
+        Replica.objects.filter(id=replica.id).update(
+            last_fixity_check=datetime.now() - timedelta(hours=1))
+        verify_files()
+        expect(FixityCheck.objects.filter(replica=replica).count()) \
+            .to_equal(2)
+
     def testRemoteFile(self):
             content = urandom(1024)
             with NamedTemporaryFile() as f:
@@ -98,12 +163,20 @@ class BackgroundTaskTestCase(TestCase):
                 verify_files()
                 expect(get_replica(replica).verified).to_be(False)
                 expect(get_replica(replica).is_local()).to_be(False)
+                # The failed copy is recorded, and not retried straight away
+                expect(get_replica(replica).last_fixity_check).to_be_truthy()
+                expect(get_replica(replica).verification_lease).to_be(None)
 
                 # Fill in the content
                 f.write(content)
                 f.flush()
 
-                # Check it now verifies
+                verify_files()
+                expect(get_replica(replica).is_local()).to_be(False)
+
+                # Check it verifies once the retry delay has passed
+                Replica.objects.filter(id=replica.id).update(
+                    last_fixity_check=datetime.now() - timedelta(hours=1))
                 verify_files()
                 expect(get_replica(replica)).to_be(None)
                 expect(get_new_replica(datafile).verified).to_be(True)
@@ -0,0 +1,52 @@
+import hashlib
+from os import urandom
+from StringIO import StringIO
+from tempfile import NamedTemporaryFile, TemporaryFile
+
+from compare import expect
+from django.test import TestCase
+
+from tardis.tardis_portal.util import generate_file_checksums, \
+    CHECKSUM_BLOCK_SIZE
+
+
+class ChecksumTestCase(TestCase):
+
+    def setUp(self):
+        # Several blocks, and a bit more
+        self.content = urandom(3 * CHECKSUM_BLOCK_SIZE + 1234)
+        self.expected = (hashlib.md5(self.content).hexdigest(),
+                         hashlib.sha512(self.content).hexdigest(),
+                         len(self.content), self.content[:8096])
+        self.file = NamedTemporaryFile()
+        self.file.write(self.content)
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+
+    def testLocalFile(self):
+        for use_mmap in (False, True):
+            result = generate_file_checksums(open(self.file.name, 'rb'),
+                                             None, use_mmap=use_mmap)
+            expect(result).to_equal(self.expected)
+
+    def testStream(self):
+        # No readinto or fileno
+        result = generate_file_checksums(StringIO(self.content), None)
+        expect(result).to_equal(self.expected)
+
+    def testTempFile(self):
+        with TemporaryFile() as tempfile:
+            result = generate_file_checksums(open(self.file.name, 'rb'),
+                                             tempfile)
+            expect(result).to_equal(self.expected)
+            tempfile.seek(0)
+            expect(tempfile.read() == self.content).to_be_truthy()
+
+    def testSmallFiles(self):
+        for content in ('', 'abc'):
+            result = generate_file_checksums(StringIO(content), None)
+            expect(result).to_equal((hashlib.md5(content).hexdigest(),
+                                     hashlib.sha512(content).hexdigest(),
+                                     len(content), content))
@@ -0,0 +1,159 @@
+import hashlib
+from datetime import datetime, timedelta
+from os import path, urandom
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from compare import expect
+from django.core.files.base import ContentFile
+from django.test import TestCase
+
+from tardis.tardis_portal.models import Experiment, Dataset, Dataset_File, \
+    Replica, Location, FixityCheck, User
+from tardis.tardis_portal.staging import write_uploaded_file_to_dataset
+from tardis.tardis_portal.verification import VerificationEngine, \
+    Checkpoint, get_audit_batch
+
+
+class VerificationEngineTestCase(TestCase):
+
+    def setUp(self):
+        Location.force_initialize()
+        user = User.objects.create_user('testuser', 'user@email.test', 'pwd')
+        experiment = Experiment.objects.create(title='Verification Test',
+                                               created_by=user)
+        self.dataset = Dataset()
+        self.dataset.save()
+        self.dataset.experiments.add(experiment)
+        self.tempdir = mkdtemp()
+        self.replicas = [self._create_replica('file%d' % i) for i in range(4)]
+        # Corrupt one of the datafiles' checksums
+        self.bad = self.replicas[2]
+        Dataset_File.objects.filter(id=self.bad.datafile_id) \
+                            .update(sha512sum='0' * 128)
+
+    def tearDown(self):
+        rmtree(self.tempdir)
+
+    def _create_replica(self, filename):
+        content = urandom(1024)
+        datafile = Dataset_File(dataset=self.dataset, filename=filename,
+                                size=str(len(content)),
+                                sha512sum=hashlib.sha512(content).hexdigest())
+        datafile.save()
+        replica = Replica(datafile=datafile,
+                          url=write_uploaded_file_to_dataset(
+                              self.dataset, ContentFile(content, filename)),
+                          location=Location.get_default_location())
+        replica.save()
+        return replica
+
+    def _run(self, processes=0, **kwargs):
+        results = []
+        engine = VerificationEngine(processes=processes,
+                                    report=lambda _: None, **kwargs)
+        progress = engine.run(Replica.objects.all(), results.append)
+        return progress, dict((r.replica_id, r.ok) for r in results)
+
+    def testCheckReportsFailures(self):
+        progress, results = self._run()
+        expected = dict((r.id, r.id != self.bad.id) for r in self.replicas)
+        expect(results).to_equal(expected)
+        expect(progress.files).to_equal(4)
+        expect(progress.failed).to_equal(1)
+        expect(progress.bytes).to_equal(4 * 1024)
+        # Nothing is changed without 'update'
+        expect(Replica.objects.filter(verified=True).count()).to_equal(0)
+
+    def testUpdateMarksVerified(self):
+        self._run(update=True)
+        verified = Replica.objects.filter(verified=True)
+        expect(sorted(verified.values_list('id', flat=True))) \
+            .to_equal(sorted(r.id for r in self.replicas
+                             if r.id != self.bad.id))
+
+    def testWorkerProcesses(self):
+        progress, results = self._run(processes=2)
+        expect(results).to_equal(dict((r.id, r.id != self.bad.id)
+                                      for r in self.replicas))
+        expect(progress.bytes).to_equal(4 * 1024)
+
+    def testDatafilesWithoutChecksumsFail(self):
+        Dataset_File.objects.filter(id=self.replicas[0].datafile_id) \
+                            .update(md5sum='', sha512sum='')
+        _, results = self._run(update=True)
+        expect(results[self.replicas[0].id]).to_be(False)
+        expect(Replica.objects.get(id=self.replicas[0].id).verified) \
+            .to_be(False)
+        # Unless they're allowed to
+        _, results = self._run(update=True, allow_empty_checksums=True)
+        expect(results[self.replicas[0].id]).to_be(True)
+
+    def testCheckpointResumes(self):
+        filename = path.join(self.tempdir, 'checkpoint.json')
+        _, results = self._run(checkpoint=filename)
+        expect(len(results)).to_equal(4)
+        checkpoint = Checkpoint(filename)
+        expect(checkpoint.low_water).to_equal(max(r.id for r in self.replicas))
+        # A second run only checks new replicas
+        new = self._create_replica('file4')
+        _, results = self._run(checkpoint=filename)
+        expect(results).to_equal({new.id: True})
+
+    def testCheckpointKeepsIdsAboveLowWater(self):
+        filename = path.join(self.tempdir, 'checkpoint.json')
+        checkpoint = Checkpoint(filename)
+        for replica_id in (1, 2, 5):
+            checkpoint.mark_done(replica_id)
+        checkpoint.save(2)
+        checkpoint = Checkpoint(filename)
+        expect(checkpoint.low_water).to_equal(2)
+        expect(checkpoint.done).to_equal(set([5]))
+        expect(checkpoint.is_done(1)).to_be_truthy()
+        expect(checkpoint.is_done(3)).to_be_falsy()
+        expect(checkpoint.is_done(5)).to_be_truthy()
+
+    def testFixityLedger(self):
+        results = []
+        VerificationEngine(processes=0, report=lambda _: None) \
+            .run(Replica.objects.all(), results.append)
+        for result in results:
+            FixityCheck.record(result)
+        check = FixityCheck.objects.get(replica=self.replicas[0])
+        expect(check.ok).to_be_truthy()
+        expect(check.sha512sum).to_equal(
+            self.replicas[0].datafile.sha512sum)
+        check = FixityCheck.objects.get(replica=self.bad)
+        expect(check.ok).to_be_falsy()
+        expect(Replica.objects.get(id=self.bad.id).last_fixity_check) \
+            .to_equal(check.time)
+
+    def testAuditBatch(self):
+        from django.conf import settings
+        Replica.objects.update(verified=True)
+        # Each replica holds 1024 of the 4096 bytes
+        fraction = getattr(settings, 'FIXITY_AUDIT_DAILY_FRACTION', None)
+        settings.FIXITY_AUDIT_DAILY_FRACTION = 0.5
+        try:
+            # Never-checked replicas come first ...
+            expect(get_audit_batch(timedelta(days=1))) \
+                .to_equal([r.id for r in self.replicas[:2]])
+            # ... then those checked longest ago, but not in the last day
+            now = datetime.now()
+            for i, replica in enumerate(self.replicas):
+                Replica.objects.filter(id=replica.id).update(
+                    last_fixity_check=now - timedelta(days=i))
+            expect(get_audit_batch(timedelta(days=1))) \
+                .to_equal([self.replicas[3].id, self.replicas[2].id])
+            expect(get_audit_batch(timedelta(hours=1))) \
+                .to_equal([self.replicas[3].id])
+            # Replicas already queued aren't chosen again
+            Replica.objects.filter(id=self.replicas[3].id).update(
+                verification_lease=now + timedelta(hours=1))
+            expect(get_audit_batch(timedelta(hours=1))) \
+                .to_equal([self.replicas[2].id])
+        finally:
+            if fraction is None:
+                del settings.FIXITY_AUDIT_DAILY_FRACTION
+            else:
+                settings.FIXITY_AUDIT_DAILY_FRACTION = fraction
@@ -39,6 +39,7 @@ http://docs.djangoproject.com/en/dev/topics/testing/
 """
 
 from compare import expect, ensure
+from flexmock import flexmock
 from os import path
 import unittest
 import datetime
@@ -54,6 +55,8 @@ from tardis.tardis_portal.models import *
 from tardis.tardis_portal.views import _registerExperimentDocument
 from tardis.tardis_portal.metsparser import MetsExperimentStructCreator
 from tardis.tardis_portal.metsparser import MetsDataHolder
+from tardis.tardis_portal.metsparser import BulkIngest
+from tardis.tardis_portal import metsparser
 from tardis.tardis_portal.auth.localdb_auth import django_user
 
 from tardis.tardis_portal.transfer import TransferProvider
@@ -421,6 +424,8 @@ class MetsExperimentStructCreatorTestCase(TestCase):
 
 class MetsMetadataInfoHandlerTestCase(TestCase):
 
+    bulk_ingest = False
+
     def setUp(self):
         # Load schemas for test
         from django.core.management import call_command
@@ -439,9 +444,13 @@ class MetsMetadataInfoHandlerTestCase(TestCase):
         filename = path.join(path.abspath(path.dirname(__file__)),
                              './METS_test.xml')
 
+        self.bulk = BulkIngest() if self.bulk_ingest else None
         expid, sync_path = _registerExperimentDocument(filename,
                                                        self.user,
-                                                       expid=None)
+                                                       expid=None,
+                                                       bulk=self.bulk)
+        if self.bulk:
+            self.bulk.finish()
         ensure(sync_path.startswith(settings.SYNC_TEMP_PATH), True,
                "Sync path should be influenced by SYNC_TEMP_PATH: %s" %
                sync_path)
@@ -554,6 +563,30 @@ class MetsMetadataInfoHandlerTestCase(TestCase):
                          'attachment; filename="mets_expid_%s.xml"' % expid)
 
 
+class BulkMetsMetadataInfoHandlerTestCase(MetsMetadataInfoHandlerTestCase):
+    ''' Runs the same checks against a bulk ingest of the document '''
+
+    bulk_ingest = True
+
+    def testBulkIngestTimings(self):
+        phases = [name for name, _ in self.bulk.timings]
+        expect(phases).to_equal(['structure', 'metadata', 'datafiles',
+                                 'parameters', 'post-commit'])
+        for datafile in Dataset_File.objects.filter(
+                dataset__experiments=self.experiment):
+            expect(datafile.replica_set.count()).to_equal(1)
+
+    def testSiteStatsUpdatedByFinish(self):
+        datafiles = Dataset_File.objects.filter(
+            dataset__experiments=self.experiment)
+        # Only once the ingest has committed, for all the datafiles at once
+        flexmock(metsparser).should_receive('add_to_site_stats').with_args(
+            datafile_count=datafiles.count(),
+            datafile_size=sum(datafile.size_bytes or 0
+                              for datafile in datafiles)).once()
+        self.bulk.finish()
+
+
 def suite():
     userInterfaceSuite = \
         unittest.TestLoader().loadTestsFromTestCase(UserInterfaceTestCase)
@@ -563,11 +596,15 @@ def suite():
     parserSuite2 = \
         unittest.TestLoader().loadTestsFromTestCase(
         MetsMetadataInfoHandlerTestCase)
+    parserSuite3 = \
+        unittest.TestLoader().loadTestsFromTestCase(
+        BulkMetsMetadataInfoHandlerTestCase)
     searchSuite = \
         unittest.TestLoader().loadTestsFromTestCase(SearchTestCase)
 
     allTests = unittest.TestSuite([parserSuite1,
                                    parserSuite2,
+                                   parserSuite3,
                                    userInterfaceSuite,
                                    searchSuite,
                                    equipmentSuite,
@@ -27,6 +27,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 
+import os
+from tempfile import NamedTemporaryFile
 from urllib import quote
 
 
@@ -49,6 +51,18 @@ class TransferProvider(object):
     def generate_url(self, replica):
         return replica.generate_default_url()
 
+    def open_archive(self, experiment):
+        """
+        Return (url, file) where 'file' is a writable file object for an
+        archive of 'experiment', which is stored at 'url' when the file is
+        closed.  Calling the file's discard() method instead abandons the
+        archive.  This implementation collects the archive in a temporary
+        file and sends it with put_archive; providers that can write to the
+        destination as the archive is created override it.
+        """
+        return (self._generate_archive_url(experiment),
+                _ArchiveUpload(self, experiment))
+
     def _generate_archive_url(self, experiment):
         path = '%s-archive.tar.gz' % experiment.id
         # (For reasons I don't understand, urljoin doesn't work here.
@@ -70,3 +84,32 @@ class TransferProvider(object):
         else:
             return value
 
+
+
+class _ArchiveUpload(object):
+    """ A temporary file for an archive, which is sent to the destination
+    with put_archive when it is closed. """
+
+    def __init__(self, provider, experiment):
+        self.provider = provider
+        self.experiment = experiment
+        self.file = NamedTemporaryFile(prefix='mytardis_tmp_ar',
+                                       suffix='.tar.gz', delete=False)
+        self.name = self.file.name
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        try:
+            self.provider.put_archive(self.name, self.experiment)
+        finally:
+            os.unlink(self.name)
+
+    def discard(self):
+        if not self.file.closed:
+            self.file.close()
+            os.unlink(self.name)
@@ -31,6 +31,7 @@ from urllib2 import Request, HTTPError
 from urllib import quote, unquote
 from urlparse import urlparse, urljoin
 from os import path
+import os
 from contextlib import closing
 
 from django.utils import simplejson
@@ -106,6 +107,13 @@ class BaseLocalTransfer(TransferProvider):
             target_replica.protocol = ''
             target_replica.save()
     
+    def open_archive(self, experiment):
+        url = self._generate_archive_url(experiment)
+        try:
+            return (url, ArchiveFile(self._uri_to_filename(url)))
+        except (IOError, OSError) as e:
+            raise TransferError(e.strerror)
+
     def remove_file(self, replica):
         path = self._uri_to_filename(replica.url)
         try:
@@ -125,6 +133,33 @@ class BaseLocalTransfer(TransferProvider):
         return unquote('/%s/%s' % (parts.netloc, parts.path))
 
 
+class ArchiveFile(object):
+    """ An archive file written straight to 'pathname'.  It is written under
+    a temporary name, and only renamed when it is closed, so a partly
+    written archive is never mistaken for a complete one. """
+
+    def __init__(self, pathname):
+        dirname = path.dirname(pathname)
+        if not path.isdir(dirname):
+            os.makedirs(dirname)
+        self.name = pathname
+        self.file = open(pathname + '.part', 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.close()
+        os.rename(self.file.name, self.name)
+
+    def discard(self):
+        if not self.file.closed:
+            self.file.close()
+            os.unlink(self.file.name)
+
+
 class LocalTransfer(BaseLocalTransfer):
     def __init__(self, name, base_url, params):
         BaseLocalTransfer.__init__(self, name, base_url, params)
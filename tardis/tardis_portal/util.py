@@ -53,30 +53,150 @@ def get_free_space(fs_dir):
         raise RuntimeError('Unsupported / unexpected platform type: %s' % \
                                sys_type)
 
-def generate_file_checksums(sourceFile, tempFile):
+# Files are checksummed in blocks of this many bytes (a multiple of the
+# page size, so that reads are aligned)
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+# The number of blocks read ahead of the hashing
+CHECKSUM_READ_AHEAD = 2
+
+# The length of the start of the file returned for mimetype guessing
+MIMETYPE_BUFFER_SIZE = 8096 # Arbitrary memory limit
+
+def generate_file_checksums(sourceFile, tempFile, use_mmap=False):
     '''
     Generate checksums, etcetera for a file read from 'sourceFile'.
     If 'tempFile' is provided, the bytes are written to it as they are read.
     The result is a tuple comprising the MD5 checksum, the SHA512 checksum,
     the file length, and chunk containing the start of the file (for doing
     mimetype guessing if necessary).
+
+    Large files are read in blocks into reused buffers by a separate thread,
+    so that reading overlaps hashing, and the MD5 and SHA512 checksums are
+    computed in parallel (hashlib releases the GIL while it works).  If
+    'use_mmap' is True, a local file is mapped into memory rather than read.
     '''
 
     from contextlib import closing
     with closing(sourceFile) as f:
-        md5 = hashlib.new('md5')
-        sha512 = hashlib.new('sha512')
-        size = 0
-        mimetype_buffer = ''
-        for chunk in iter(lambda: f.read(32 * sha512.block_size), ''):
-            size += len(chunk)
-            if len(mimetype_buffer) < 8096: # Arbitrary memory limit
-                mimetype_buffer += chunk
-            md5.update(chunk)
-            sha512.update(chunk)
+        size = _get_local_file_size(f)
+        if size is not None and size <= CHECKSUM_BLOCK_SIZE:
+            # Not worth the threads
+            return _hash_blocks([f.read()], tempFile, parallel=False)
+        if size is not None and use_mmap:
+            return _hash_blocks(_mapped_blocks(f, size), tempFile)
+        return _hash_blocks(_read_blocks(f), tempFile)
+
+def _get_local_file_size(f):
+    '''
+    Return the size of 'f' if it is a local file that hasn't been read
+    from yet, or None.
+    '''
+    try:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode) and f.tell() == 0:
+            return st.st_size
+    except (AttributeError, EnvironmentError, ValueError):
+        pass
+    return None
+
+def _mapped_blocks(f, size):
+    '''
+    Yield successive blocks of a local file, mapped into memory.
+    '''
+    import mmap
+    m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        for offset in xrange(0, size, CHECKSUM_BLOCK_SIZE):
+            yield buffer(m, offset, CHECKSUM_BLOCK_SIZE)
+    finally:
+        m.close()
+
+def _read_blocks(f):
+    '''
+    Yield successive blocks of a file, read ahead by a separate thread.
+    Each block is only valid until the next one is asked for, as the
+    buffers it is read into are reused.
+    '''
+    import sys, threading
+    from Queue import Queue
+    readinto = getattr(f, 'readinto', None)
+    free = Queue()
+    full = Queue()
+    for _ in range(CHECKSUM_READ_AHEAD + 1):
+        free.put(bytearray(CHECKSUM_BLOCK_SIZE))
+
+    def read():
+        try:
+            for buf in iter(free.get, None):
+                if readinto:
+                    view = buffer(buf, 0, readinto(buf))
+                else:
+                    view = f.read(CHECKSUM_BLOCK_SIZE)
+                if not len(view):
+                    break
+                full.put((buf, view))
+            full.put(None)
+        except Exception:
+            full.put((None, sys.exc_info()))
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        for buf, view in iter(full.get, None):
+            if buf is None:
+                # The read failed
+                raise view[0], view[1], view[2]
+            yield view
+            free.put(buf)
+    finally:
+        # Stops the reader if it is still going
+        free.put(None)
+        reader.join()
+
+def _hash_blocks(blocks, tempFile, parallel=True):
+    import threading
+    from Queue import Queue
+    md5 = hashlib.new('md5')
+    sha512 = hashlib.new('sha512')
+    size = 0
+    mimetype_buffer = ''
+    if parallel:
+        pending = Queue()
+        done = Queue()
+
+        def update():
+            for block in iter(pending.get, None):
+                try:
+                    sha512.update(block)
+                finally:
+                    done.put(True)
+
+        hasher = threading.Thread(target=update)
+        hasher.daemon = True
+        hasher.start()
+    try:
+        for block in blocks:
+            if parallel:
+                pending.put(block)
+            else:
+                sha512.update(block)
+            md5.update(block)
+            size += len(block)
+            if len(mimetype_buffer) < MIMETYPE_BUFFER_SIZE:
+                mimetype_buffer += str(buffer(
+                    block, 0, MIMETYPE_BUFFER_SIZE - len(mimetype_buffer)))
             if tempFile:
-                tempFile.write(chunk)
-    return (md5.hexdigest(), sha512.hexdigest(), 
+                # (Not every file-like object accepts buffers)
+                tempFile.write(str(block))
+            if parallel:
+                # The block mustn't be reused until both digests have it
+                done.get()
+    finally:
+        if parallel:
+            pending.put(None)
+    return (md5.hexdigest(), sha512.hexdigest(),
             size, mimetype_buffer)
 
 def _load_template(template_name):
@@ -0,0 +1,425 @@
+"""
+verification.py
+
+Checks the data of stored replicas against their Datafiles' checksums.
+
+The :py:class:`VerificationEngine` reads replicas in a pool of worker
+processes, computing the MD5 and SHA-512 sums of each in a single pass
+(see :py:func:`tardis.tardis_portal.util.generate_file_checksums`), and
+compares them in the main process.  The number of replicas being read from
+any one Location at a time can be limited, so that a slow or shared store
+isn't overwhelmed.  A run can keep a checkpoint file, so that an
+interrupted run carries on where it left off, and reports its throughput
+and expected time to completion as it goes.
+
+It is used by the 'checkhashes' management command and the
+'tardis_portal.verify_replicas' task, and for fixity auditing: the
+'tardis_portal.audit_fixity' task re-checks a share of the stored replicas
+each hour (see :py:func:`get_audit_batch`), recording the results as
+:py:class:`tardis.tardis_portal.models.FixityCheck` entries.
+
+"""
+import json
+import os
+import time
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime, timedelta
+from multiprocessing import Pool, cpu_count
+from Queue import Queue, Empty
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+
+from tardis.tardis_portal.util import generate_file_checksums
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The number of replica ids fetched from the database at a time
+FETCH_SIZE = 500
+
+VerificationResult = namedtuple('VerificationResult',
+                                'replica_id ok error size duration '
+                                'md5sum sha512sum')
+
+
+def hash_replica(replica_id):
+    """
+    Read a replica's data, and return (replica id, the result of
+    generate_file_checksums or None, error message or None, seconds taken).
+    This runs in the worker processes, so doesn't raise exceptions.
+    """
+    from tardis.tardis_portal.models import Replica
+    start = time.time()
+    try:
+        replica = Replica.objects.select_related('location') \
+                                 .get(id=replica_id)
+        sourcefile = replica.get_file(requireVerified=False)
+        if not sourcefile:
+            return (replica_id, None, 'content not accessible',
+                    time.time() - start)
+        digests = generate_file_checksums(sourcefile, None)
+        return (replica_id, digests, None, time.time() - start)
+    except Exception as e:
+        logger.exception('Unable to read replica %s' % replica_id)
+        return (replica_id, None, str(e) or e.__class__.__name__,
+                time.time() - start)
+
+
+def _close_connection():
+    """
+    Close this process's database connection before worker processes are
+    started, so that they don't share it.  An in-memory SQLite database (as
+    used by the tests) would be lost, so it is left open, and each worker
+    reads from its own copy.
+    """
+    if connection.vendor == 'sqlite' and \
+            connection.settings_dict['NAME'] in ('', ':memory:'):
+        return
+    connection.close()
+
+
+class Checkpoint(object):
+    """
+    The replicas that a run has checked, kept in a file so that an
+    interrupted run can be resumed.  Replicas are checked in (roughly)
+    ascending id order, so the file holds the id up to which every replica
+    has been checked, plus the ids of the replicas above it that have been.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.low_water = 0
+        self.done = set()
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                state = json.load(f)
+            self.low_water = state['low_water']
+            self.done = set(state['done'])
+
+    def is_done(self, replica_id):
+        return replica_id <= self.low_water or replica_id in self.done
+
+    def mark_done(self, replica_id):
+        self.done.add(replica_id)
+
+    def save(self, low_water):
+        """
+        Record that every replica with an id up to 'low_water' has been
+        checked, and write the checkpoint file (if any).
+        """
+        self.low_water = max(self.low_water, low_water)
+        self.done = set(id_ for id_ in self.done if id_ > self.low_water)
+        if not self.filename:
+            return
+        # Write a new file and rename it, so that an interruption can't
+        # leave a half-written checkpoint
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump({'low_water': self.low_water,
+                       'done': sorted(self.done)}, f)
+        os.rename(tmpname, self.filename)
+
+
+class Progress(object):
+    """ Counts the files processed (with results that have 'ok' and 'size'
+    attributes), and estimates the time remaining. """
+
+    def __init__(self, total_files, total_bytes, verb='checked'):
+        self.start = time.time()
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.verb = verb
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+
+    def add(self, result):
+        self.files += 1
+        self.bytes += result.size or 0
+        if not result.ok:
+            self.failed += 1
+
+    def get_eta(self):
+        elapsed = time.time() - self.start
+        if self.bytes and self.total_bytes:
+            remaining = (self.total_bytes - self.bytes) * elapsed / self.bytes
+        elif self.files:
+            remaining = (self.total_files - self.files) * elapsed / self.files
+        else:
+            return None
+        return timedelta(seconds=max(int(remaining), 0))
+
+    def __str__(self):
+        elapsed = max(time.time() - self.start, 0.001)
+        return '%d of %d files %s (%d failed), ' \
+               '%.1f files/s, %.1f MB/s, ETA %s' % (
+                   self.files, self.total_files, self.verb, self.failed,
+                   self.files / elapsed,
+                   self.bytes / elapsed / (1024 * 1024),
+                   self.get_eta() or 'unknown')
+
+
+class VerificationEngine(object):
+    """
+    Checks replicas' data against their Datafiles' checksums.
+
+    :param processes: the number of worker processes reading replicas
+        (default: one per CPU).  With 0, replicas are read one at a time
+        in this process, as is necessary in a celery worker.
+    :param location_limits: {Location name: the most replicas to read from
+        it at once} (default: the VERIFICATION_LOCATION_LIMITS setting)
+    :param checkpoint: the name of a file to keep a checkpoint in
+    :param update: if True, replicas that pass are marked as verified, and
+        missing checksums, sizes and mimetypes are filled in.  Otherwise
+        nothing is changed.
+    :param allow_empty_checksums: if True, replicas of Datafiles without
+        any checksum pass on their size alone (as with
+        :py:meth:`tardis.tardis_portal.models.Replica.verify`).  Otherwise
+        they fail.
+    :param report: a function to call with progress reports (default:
+        logging them)
+    :param report_interval: the seconds between progress reports (and
+        checkpoint saves)
+    """
+
+    def __init__(self, processes=None, location_limits=None,
+                 checkpoint=None, update=False, report=None,
+                 report_interval=60, allow_empty_checksums=False):
+        self.processes = cpu_count() if processes is None else processes
+        if location_limits is None:
+            location_limits = getattr(settings,
+                                      'VERIFICATION_LOCATION_LIMITS', {})
+        self.location_limits = dict(location_limits)
+        self.checkpoint = Checkpoint(checkpoint)
+        self.update = update
+        self.allow_empty_checksums = allow_empty_checksums
+        self.report = report or logger.info
+        self.report_interval = report_interval
+
+    def run(self, replicas, callback=None):
+        """
+        Check the replicas in a query set, calling 'callback' (if given)
+        with a :py:class:`VerificationResult` for each.  Returns the final
+        :py:class:`Progress`.
+        """
+        replicas = replicas.filter(id__gt=self.checkpoint.low_water)
+        totals = replicas.exclude(id__in=self.checkpoint.done) \
+                         .aggregate(count=Count('id'),
+                                    size=Sum('datafile__size_bytes'))
+        progress = Progress(totals['count'], totals['size'] or 0)
+        # Replicas waiting to be read, by Location name
+        self._waiting = defaultdict(deque)
+        # Replicas being read: {id: (Location name, expected size)}
+        self._in_flight = {}
+        self._location_counts = defaultdict(int)
+        self._results = Queue()
+        last_id = self.checkpoint.low_water
+        exhausted = False
+        last_report = time.time()
+        if self.processes > 0:
+            _close_connection()
+            pool = Pool(self.processes)
+            # Keep every worker busy while results are being checked
+            capacity = self.processes * 2
+        else:
+            pool = None
+            capacity = 1
+        try:
+            while True:
+                # Replicas are fetched in chunks to bound memory use.  If a
+                # limited Location has a long backlog, fetching pauses until
+                # it is worked through.
+                if not exhausted and self._count_waiting() < FETCH_SIZE:
+                    chunk = list(replicas.filter(id__gt=last_id)
+                                         .order_by('id')
+                                         .values_list('id', 'location__name',
+                                                      'datafile__size_bytes')
+                                 [:FETCH_SIZE])
+                    exhausted = len(chunk) < FETCH_SIZE
+                    for replica_id, location, size in chunk:
+                        last_id = replica_id
+                        if not self.checkpoint.is_done(replica_id):
+                            self._waiting[location].append((replica_id,
+                                                            size))
+                self._dispatch(pool, capacity)
+                if not self._in_flight:
+                    if exhausted and not self._count_waiting():
+                        break
+                    continue
+                try:
+                    result = self._results.get(True, 1)
+                except Empty:
+                    result = None
+                if result:
+                    result = self._check(*result)
+                    self.checkpoint.mark_done(result.replica_id)
+                    progress.add(result)
+                    if callback:
+                        callback(result)
+                if time.time() - last_report >= self.report_interval:
+                    self.report(str(progress))
+                    self.checkpoint.save(self._get_low_water(last_id))
+                    last_report = time.time()
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+            self.checkpoint.save(self._get_low_water(last_id))
+        self.report(str(progress))
+        return progress
+
+    def _count_waiting(self):
+        return sum(len(queue) for queue in self._waiting.values())
+
+    def _get_low_water(self, last_id):
+        """ Return the id up to which every replica has been checked. """
+        pending = list(self._in_flight)
+        pending.extend(replica_id for queue in self._waiting.values()
+                       for replica_id, _ in queue)
+        return min(pending) - 1 if pending else last_id
+
+    def _has_room(self, location):
+        limit = self.location_limits.get(location)
+        return not limit or self._location_counts[location] < limit
+
+    def _dispatch(self, pool, capacity):
+        """ Start reading waiting replicas, taking turns between Locations,
+        as far as the capacity and Location limits allow.
+        """
+        dispatched = True
+        while dispatched:
+            dispatched = False
+            for location, queue in self._waiting.items():
+                if len(self._in_flight) >= capacity:
+                    return
+                if not (queue and self._has_room(location)):
+                    continue
+                replica_id, size = queue.popleft()
+                self._in_flight[replica_id] = (location, size)
+                self._location_counts[location] += 1
+                if pool:
+                    pool.apply_async(hash_replica, (replica_id,),
+                                     callback=self._results.put)
+                else:
+                    self._results.put(hash_replica(replica_id))
+                dispatched = True
+
+    def _check(self, replica_id, digests, error, duration):
+        """ Compare a replica's checksums with its Datafile's. """
+        from tardis.tardis_portal.models import Replica
+        location, size = self._in_flight.pop(replica_id)
+        self._location_counts[location] -= 1
+        md5sum = sha512sum = None
+        if digests:
+            md5sum, sha512sum, size = digests[:3]
+            try:
+                error = self._check_digests(replica_id, digests)
+            except Replica.DoesNotExist:
+                error = 'deleted'
+        return VerificationResult(replica_id, error is None, error,
+                                  size, duration, md5sum, sha512sum)
+
+    def _check_digests(self, replica_id, digests):
+        """ Return why the replica fails the check, or None if it passes. """
+        from tardis.tardis_portal.models import Replica
+        if not self.update:
+            replica = Replica.objects.select_related('datafile') \
+                                     .get(id=replica_id)
+            if not self._has_checksums(replica):
+                return 'no checksums'
+            if not replica.check_digests(*digests, fill_in=False):
+                return 'checksum or size mismatch'
+            return None
+        with transaction.commit_on_success():
+            # Lock the replica only while it is updated, not while it is read
+            replica = Replica.objects.select_for_update().get(id=replica_id)
+            if not self._has_checksums(replica):
+                return 'no checksums'
+            if not replica.check_digests(*digests):
+                return 'checksum or size mismatch'
+            if not replica.verified:
+                replica.verified = True
+                # Tells the post_save hooks that verification has just
+                # happened
+                replica._newly_verified = True
+                replica.save()
+            return None
+
+    def _has_checksums(self, replica):
+        datafile = replica.datafile
+        if self.allow_empty_checksums or datafile.md5sum or \
+                datafile.sha512sum:
+            return True
+        logger.error("Datafile for %s has no checksums", replica.url)
+        return False
+
+
+def _take_oldest(replicas, budget):
+    """ Return the ids of the replicas, in order, until their sizes add up
+    to the budget, and the total of their sizes. """
+    ids = []
+    total = 0
+    offset = 0
+    while True:
+        chunk = list(replicas.values_list('id', 'datafile__size_bytes')
+                     [offset:offset + FETCH_SIZE])
+        for replica_id, size in chunk:
+            if total >= budget:
+                return ids, total
+            ids.append(replica_id)
+            total += size or 0
+        if len(chunk) < FETCH_SIZE:
+            return ids, total
+        offset += FETCH_SIZE
+
+
+def get_audit_batch(period):
+    """
+    Return the ids of the verified replicas to re-check in the next
+    'period' (a timedelta), so that FIXITY_AUDIT_DAILY_FRACTION of the
+    stored bytes are checked each day.  The bytes are shared between
+    Location types in proportion to their FIXITY_AUDIT_LOCATION_WEIGHTS
+    and to the bytes stored in each; types without a weight aren't
+    audited.  Replicas never checked come first, then those checked
+    longest ago.  Replicas checked within the last day, and those already
+    queued for checking (with an unexpired verification_lease), aren't
+    chosen.
+    """
+    from tardis.tardis_portal.models import Replica
+    fraction = getattr(settings, 'FIXITY_AUDIT_DAILY_FRACTION', 0.01) \
+        * (period.days * 86400 + period.seconds) / 86400.0
+    weights = getattr(settings, 'FIXITY_AUDIT_LOCATION_WEIGHTS',
+                      {'online': 1})
+    replicas = Replica.objects.filter(verified=True)
+    stored = dict((type_, size or 0) for type_, size in
+                  replicas.filter(location__type__in=weights.keys())
+                          .order_by()
+                          .values_list('location__type')
+                          .annotate(Sum('datafile__size_bytes')))
+    weighted = sum(weights[type_] * size for type_, size in stored.items())
+    if not weighted:
+        return []
+    budget = sum(stored.values()) * fraction
+    now = datetime.now()
+    cutoff = now - timedelta(days=1)
+    unleased = Q(verification_lease__isnull=True) | \
+        Q(verification_lease__lte=now)
+    ids = []
+    for type_, size in stored.items():
+        candidates = replicas.filter(unleased, location__type=type_)
+        type_budget = budget * weights[type_] * size / weighted
+        # Two queries, as databases differ in where they sort nulls
+        for oldest in (candidates.filter(last_fixity_check__isnull=True)
+                                 .order_by('id'),
+                       candidates.filter(last_fixity_check__lt=cutoff)
+                                 .order_by('last_fixity_check', 'id')):
+            taken, taken_size = _take_oldest(oldest, type_budget)
+            ids.extend(taken)
+            type_budget -= taken_size
+            if type_budget <= 0:
+                break
+    return ids
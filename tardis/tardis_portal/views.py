@@ -57,7 +57,6 @@ from django.contrib.auth.models import User, Group, AnonymousUser
 from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, HttpResponseNotFound
 from django.contrib.auth.decorators import login_required, permission_required
 from django.core.urlresolvers import reverse
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.core.exceptions import PermissionDenied
 from django.forms.models import model_to_dict
 from django.views.decorators.http import require_POST
@@ -79,6 +78,8 @@ from tardis.tardis_portal.forms import ExperimentForm, DatasetForm, \
     CreateUserPermissionsForm
 
 from tardis.tardis_portal.errors import UnsupportedSearchQueryTypeError
+from tardis.tardis_portal.parameter_search import filter_by_parameters, \
+    get_parameter_constraints
 
 from tardis.tardis_portal.staging import get_full_staging_path, \
     write_uploaded_file_to_dataset, get_staging_url_and_size, \
@@ -93,7 +94,6 @@ from tardis.tardis_portal.models import Experiment, ExperimentParameter, \
     Dataset, Location, Replica, ExperimentParameterSet, DatasetParameterSet, \
     License, UserProfile, UserAuthentication, Token
 
-from tardis.tardis_portal import constants
 from tardis.tardis_portal.auth.localdb_auth import django_user
 from tardis.tardis_portal.auth.localdb_auth import auth_key as localdb_auth_key
 from tardis.tardis_portal.auth import decorators as authz
@@ -102,10 +102,12 @@ from tardis.tardis_portal.shortcuts import render_response_index, \
     return_response_error, return_response_not_found, \
     render_response_search, render_error_message, \
     get_experiment_referer
-from tardis.tardis_portal.metsparser import parseMets
+from tardis.tardis_portal.metsparser import parseMets, BulkIngest
 from tardis.tardis_portal.creativecommonshandler import CreativeCommonsHandler
 from tardis.tardis_portal.hacks import oracle_dbops_hack
 from tardis.tardis_portal.util import render_public_access_badge
+from tardis.tardis_portal.stats import get_site_stats, with_experiment_counts
+from tardis.tardis_portal.pagination import get_keyset_page
 
 from haystack.views import SearchView
 from haystack.query import SearchQuerySet
@@ -116,6 +118,10 @@ from django.contrib.auth import logout as django_logout
 
 logger = logging.getLogger(__name__)
 
+# Listings are paged (see pagination.py) by these many items at a time
+EXPERIMENT_LIST_PAGE_SIZE = 20
+DATAFILE_LIST_PAGE_SIZE = 100
+
 def get_dataset_info(dataset, include_thumbnail=False):
     def get_thumbnail_url(datafile):
         return reverse('tardis.tardis_portal.iiif.download_image',
@@ -131,7 +137,7 @@ def get_dataset_info(dataset, include_thumbnail=False):
     obj['url'] = dataset.get_absolute_url()
 
     obj['size'] = dataset.get_size()
-    obj['size_human_readable'] = filesizeformat(dataset.get_size())
+    obj['size_human_readable'] = filesizeformat(obj['size'])
 
     if include_thumbnail:
         try:
@@ -313,19 +319,36 @@ def experiment_index(request):
     else:
         return redirect('tardis_portal.experiment_list_public')
 
+def _render_experiment_list(request, experiments, template_name, c):
+    """
+    Render a page of an experiment listing, most recently updated first.
+    Later pages are requested with the cursor of the page before; for AJAX
+    requests (i.e. infinite scrolling) only the rows of the page are
+    rendered.
+    """
+    c['experiments'] = get_keyset_page(with_experiment_counts(experiments),
+                                       ('-update_time', '-id'),
+                                       request.GET.get('cursor'),
+                                       EXPERIMENT_LIST_PAGE_SIZE)
+    if request.is_ajax() and 'cursor' in request.GET:
+        template_name = 'tardis_portal/experiment/list_page.html'
+    else:
+        c['experiment_count'] = experiments.count()
+    return HttpResponse(render_response_search(request, template_name, c))
+
 @login_required
 def experiment_list_mine(request):
 
     c = Context({
         'subtitle': 'My Experiments',
         'can_see_private': True,
-        'experiments': authz.get_owned_experiments(request)\
-                            .order_by('-update_time'),
     })
 
     # TODO actually change loaders to load this based on stuff
-    return HttpResponse(render_response_search(request,
-                        'tardis_portal/experiment/list_mine.html', c))
+    return _render_experiment_list(request,
+                                   authz.get_owned_experiments(request),
+                                   'tardis_portal/experiment/list_mine.html',
+                                   c)
 
 @login_required
 def experiment_list_shared(request):
@@ -333,13 +356,13 @@ def experiment_list_shared(request):
     c = Context({
         'subtitle': 'Shared Experiments',
         'can_see_private': True,
-        'experiments': authz.get_shared_experiments(request) \
-                            .order_by('-update_time'),
     })
 
     # TODO actually change loaders to load this based on stuff
-    return HttpResponse(render_response_search(request,
-                        'tardis_portal/experiment/list_shared.html', c))
+    return _render_experiment_list(request,
+                                   authz.get_shared_experiments(request),
+                                   'tardis_portal/experiment/list_shared.html',
+                                   c)
 
 def experiment_list_public(request):
 
@@ -348,12 +371,12 @@ def experiment_list_public(request):
     c = Context({
         'subtitle': 'Public Experiments',
         'can_see_private': False,
-        'experiments': Experiment.objects.exclude(private_filter) \
-                                         .order_by('-update_time'),
     })
 
-    return HttpResponse(render_response_search(request,
-                        'tardis_portal/experiment/list_public.html', c))
+    return _render_experiment_list(request,
+                                   Experiment.objects.exclude(private_filter),
+                                   'tardis_portal/experiment/list_public.html',
+                                   c)
 
 
 @authz.experiment_access_required
@@ -570,23 +593,10 @@ def view_dataset(request, dataset_id):
                     continue
 
     def get_datafiles_page():
-        # pagination was removed by someone in the interface but not here.
-        # need to fix.
-        pgresults = 100
-
-        paginator = Paginator(dataset.dataset_file_set.all(), pgresults)
-
-        try:
-            page = int(request.GET.get('page', '1'))
-        except ValueError:
-            page = 1
-
-        # If page request (9999) is out of range, deliver last page of results.
-
-        try:
-            return paginator.page(page)
-        except (EmptyPage, InvalidPage):
-            return paginator.page(paginator.num_pages)
+        return get_keyset_page(dataset.dataset_file_set.all(),
+                               ('filename', 'id'),
+                               request.GET.get('cursor'),
+                               DATAFILE_LIST_PAGE_SIZE)
 
     upload_method = getattr(settings, "UPLOAD_METHOD", "uploadify")
 
@@ -940,7 +950,7 @@ def manage_auth_methods(request):
 # TODO removed username from arguments
 @transaction.commit_on_success
 def _registerExperimentDocument(filename, created_by, expid=None,
-                                owners=[], username=None):
+                                owners=[], username=None, bulk=None):
     '''
     Register the experiment document and return the experiment id.
 
@@ -953,6 +963,9 @@ def _registerExperimentDocument(filename, created_by, expid=None,
     :param owners: a list of owners
     :type owner: list
     :param username: **UNUSED**
+    :param bulk: if given, datafiles and parameters are collected in it and
+        written in batches; call its ``finish()`` method once this returns
+    :type bulk: :py:class:`tardis.tardis_portal.metsparser.BulkIngest`
     :rtype: int
 
     '''
@@ -963,7 +976,7 @@ def _registerExperimentDocument(filename, created_by, expid=None,
     f.close()
 
     logger.debug('processing METS')
-    eid, sync_root = parseMets(filename, created_by, expid)
+    eid, sync_root = parseMets(filename, created_by, expid, bulk)
 
     auth_key = ''
     try:
@@ -1025,6 +1038,7 @@ def register_experiment_ws_xmldata(request):
             username = form.cleaned_data['username']
             origin_id = form.cleaned_data['originid']
             from_url = form.cleaned_data['from_url']
+            bulk = BulkIngest() if form.cleaned_data['bulk'] else None
 
             user = auth_service.authenticate(request=request,
                                              authMethod=localdb_auth_key)
@@ -1056,12 +1070,21 @@ def register_experiment_ws_xmldata(request):
                                                            created_by=user,
                                                            expid=local_id,
                                                            owners=owners,
-                                                           username=username)
+                                                           username=username,
+                                                           bulk=bulk)
                 logger.info('=== processing experiment %s: DONE' % local_id)
             except:
                 logger.exception('=== processing experiment %s: FAILED!' % local_id)
                 return return_response_error(request)
 
+            if bulk:
+                # The experiment is in, so this is no reason to fail
+                try:
+                    bulk.finish()
+                except Exception:
+                    logger.exception('=== finishing bulk ingest of '
+                                     'experiment %s: FAILED!' % local_id)
+
             if from_url:
                 logger.info('Sending received_remote signal')
                 from tardis.tardis_portal.signals import received_remote
@@ -1171,7 +1194,7 @@ def retrieve_datafile_list(request, dataset_id, template_name='tardis_portal/aja
     dataset_results = \
         Dataset_File.objects.filter(
             dataset__pk=dataset_id,
-        ).order_by('filename')
+        )
 
     if request.GET.get('limit', False) and len(highlighted_dsf_pks):
         dataset_results = \
@@ -1187,23 +1210,13 @@ def retrieve_datafile_list(request, dataset_id, template_name='tardis_portal/aja
 
         params['filename'] = filename_search
 
-    # pagination was removed by someone in the interface but not here.
-    # need to fix.
-    pgresults = 100
-
-    paginator = Paginator(dataset_results, pgresults)
-
-    try:
-        page = int(request.GET.get('page', '1'))
-    except ValueError:
-        page = 1
-
-    # If page request (9999) is out of range, deliver last page of results.
-
-    try:
-        dataset = paginator.page(page)
-    except (EmptyPage, InvalidPage):
-        dataset = paginator.page(paginator.num_pages)
+    # Later pages are loaded (by infinite scrolling) with the cursor of the
+    # page before, and are just rows to add to the list
+    datafiles = get_keyset_page(dataset_results, ('filename', 'id'),
+                                request.GET.get('cursor'),
+                                DATAFILE_LIST_PAGE_SIZE)
+    if 'cursor' in request.GET:
+        template_name = 'tardis_portal/ajax/datafile_rows.html'
 
     is_owner = False
     has_download_permissions = authz.has_dataset_download_access(request,
@@ -1219,8 +1232,7 @@ def retrieve_datafile_list(request, dataset_id, template_name='tardis_portal/aja
     params = urlencode(params)
 
     c = Context({
-        'datafiles': dataset,
-        'paginator': paginator,
+        'datafiles': datafiles,
         'immutable': immutable,
         'dataset': Dataset.objects.get(id=dataset_id),
         'filename_search': filename_search,
@@ -1343,11 +1355,11 @@ def __getFilteredDatafiles(request, searchQueryType, searchFilterData):
                     access to any experiments""".format(request.user))
         return datafile_results
 
-    datafile_results = \
-        datafile_results.filter(
-datafileparameterset__datafileparameter__name__schema__namespace__in=Schema
-    .getNamespaces(
-        Schema.DATAFILE, searchQueryType)).distinct()
+    datafile_results = datafile_results.filter(
+        id__in=DatafileParameter.objects.filter(
+            name__schema__namespace__in=Schema.getNamespaces(
+                Schema.DATAFILE, searchQueryType))
+        .values('parameterset__dataset_file'))
 
     # if filename is searchable which i think will always be the case...
     if searchFilterData['filename'] != '':
@@ -1362,8 +1374,9 @@ datafileparameterset__datafileparameter__name__schema__namespace__in=Schema
         schema__namespace__in=Schema.getNamespaces(Schema.DATAFILE,
         searchQueryType))]
 
-    datafile_results = __filterParameters(parameters, datafile_results,
-            searchFilterData, 'datafileparameterset__datafileparameter')
+    datafile_results = filter_by_parameters(datafile_results,
+        DatafileParameter, 'dataset_file',
+        get_parameter_constraints(parameters, searchFilterData))
 
     # get all the dataset parameters for given schema
     parameters = [p for p in
@@ -1371,8 +1384,10 @@ datafileparameterset__datafileparameter__name__schema__namespace__in=Schema
         schema__namespace__in=Schema.getNamespaces(Schema.DATASET,
         searchQueryType))]
 
-    datafile_results = __filterParameters(parameters, datafile_results,
-            searchFilterData, 'dataset__datasetparameterset__datasetparameter')
+    datafile_results = filter_by_parameters(datafile_results,
+        DatasetParameter, 'dataset',
+        get_parameter_constraints(parameters, searchFilterData),
+        lookup='dataset__in')
 
     # let's sort it in the end
 
@@ -1430,145 +1445,14 @@ def __getFilteredExperiments(request, searchFilterData):
     parameters = ParameterName.objects.filter(
         schema__namespace__in=exp_schema_namespaces, is_searchable=True)
 
-    experiments = __filterParameters(parameters, experiments,
-            searchFilterData, 'experimentparameterset__experimentparameter')
+    experiments = filter_by_parameters(experiments,
+        ExperimentParameter, 'experiment',
+        get_parameter_constraints(parameters, searchFilterData))
 
     # let's sort it in the end
     experiments = experiments.order_by('title')
 
-    return experiments
-
-
-def __filterParameters(parameters, datafile_results,
-                       searchFilterData, paramType):
-    """Go through each parameter and apply it as a filter (together with its
-    specified comparator) on the provided list of datafiles.
-
-    :param parameters: list of ParameterNames model
-    :type parameters: list containing
-       :py:class:`tardis.tardis_portal.models.ParameterNames`
-    :param datafile_results: list of datafile to apply the filter
-    :param searchFilterData: the cleaned up search form data
-    :param paramType: either ``datafile`` or ``dataset``
-    :type paramType: :py:class:`tardis.tardis_portal.models.Dataset` or
-       :py:class:`tardis.tardis_portal.models.Dataset_File`
-
-    :returns: A list of datafiles as a result of the query or None if the
-      provided search request is invalid
-
-    """
-
-    for parameter in parameters:
-        fieldName = parameter.getUniqueShortName()
-        kwargs = {paramType + '__name__id': parameter.id}
-        try:
-
-            # if parameter is a string...
-            if not parameter.data_type == ParameterName.NUMERIC:
-                if searchFilterData[fieldName] != '':
-                    # let's check if this is a field that's specified to be
-                    # displayed as a dropdown menu in the form
-                    if parameter.choices != '':
-                        if searchFilterData[fieldName] != '-':
-                            kwargs[paramType + '__string_value__iexact'] = \
-                                searchFilterData[fieldName]
-                    else:
-                        if parameter.comparison_type == \
-                                ParameterName.EXACT_VALUE_COMPARISON:
-                            kwargs[paramType + '__string_value__iexact'] = \
-                                searchFilterData[fieldName]
-                        elif parameter.comparison_type == \
-                                ParameterName.CONTAINS_COMPARISON:
-                            # we'll implement exact comparison as 'icontains'
-                            # for now
-                            kwargs[paramType + '__string_value__icontains'] = \
-                                searchFilterData[fieldName]
-                        else:
-                            # if comparison_type on a string is a comparison
-                            # type that can only be applied to a numeric value,
-                            # we'll default to just using 'icontains'
-                            # comparison
-                            kwargs[paramType + '__string_value__icontains'] = \
-                                searchFilterData[fieldName]
-                else:
-                    pass
-            else:  # parameter.isNumeric():
-                if parameter.comparison_type == \
-                        ParameterName.RANGE_COMPARISON:
-                    fromParam = searchFilterData[fieldName + 'From']
-                    toParam = searchFilterData[fieldName + 'To']
-                    if fromParam is None and toParam is None:
-                        pass
-                    else:
-                        # if parameters are provided and we want to do a range
-                        # comparison
-                        # note that we're using '1' as the lower range as using
-                        # '0' in the filter would return all the data
-                        # TODO: investigate on why the oddness above is
-                        #       happening
-                        # TODO: we should probably move the static value here
-                        #       to the constants module
-                        kwargs[paramType + '__numerical_value__range'] = \
-                            (fromParam is None and
-                             constants.FORM_RANGE_LOWEST_NUM or fromParam,
-                             toParam is not None and toParam or
-                             constants.FORM_RANGE_HIGHEST_NUM)
-
-                elif searchFilterData[fieldName] is not None:
-
-                    # if parameter is an number and we want to handle other
-                    # type of number comparisons
-                    if parameter.comparison_type == \
-                            ParameterName.EXACT_VALUE_COMPARISON:
-                        kwargs[paramType + '__numerical_value__exact'] = \
-                            searchFilterData[fieldName]
-
-                    # TODO: is this really how not equal should be declared?
-                    # elif parameter.comparison_type ==
-                    #       ParameterName.NOT_EQUAL_COMPARISON:
-                    #   datafile_results = \
-                    #       datafile_results.filter(
-                    #  datafileparameter__name__name__icontains=parameter.name)
-                    #       .filter(
-                    #  ~Q(datafileparameter__numerical_value=searchFilterData[
-                    #       parameter.name]))
-
-                    elif parameter.comparison_type == \
-                            ParameterName.GREATER_THAN_COMPARISON:
-                        kwargs[paramType + '__numerical_value__gt'] = \
-                            searchFilterData[fieldName]
-                    elif parameter.comparison_type == \
-                            ParameterName.GREATER_THAN_EQUAL_COMPARISON:
-                        kwargs[paramType + '__numerical_value__gte'] = \
-                            searchFilterData[fieldName]
-                    elif parameter.comparison_type == \
-                            ParameterName.LESS_THAN_COMPARISON:
-                        kwargs[paramType + '__numerical_value__lt'] = \
-                            searchFilterData[fieldName]
-                    elif parameter.comparison_type == \
-                            ParameterName.LESS_THAN_EQUAL_COMPARISON:
-                        kwargs[paramType + '__numerical_value__lte'] = \
-                            searchFilterData[fieldName]
-                    else:
-                        # if comparison_type on a numeric is a comparison type
-                        # that can only be applied to a string value, we'll
-                        # default to just using 'exact' comparison
-                        kwargs[paramType + '__numerical_value__exact'] = \
-                            searchFilterData[fieldName]
-                else:
-                    # ignore...
-                    pass
-
-            # we will only update datafile_results if we have an additional
-            # filter (based on the 'passed' condition) in addition to the
-            # initial value of kwargs
-            if len(kwargs) > 1:
-                logger.debug(kwargs)
-                datafile_results = datafile_results.filter(**kwargs)
-        except KeyError:
-            pass
-
-    return datafile_results
+    return with_experiment_counts(experiments)
 
 
 def __forwardToSearchDatafileFormPage(request, searchQueryType,
@@ -1787,7 +1671,8 @@ def search_datafile(request):
     # get experiments associated with datafiles
     if datafile_results:
         experiment_pks = list(set(datafile_results.values_list('dataset__experiments', flat=True)))
-        experiments = Experiment.safe.in_bulk(experiment_pks)
+        experiments = with_experiment_counts(Experiment.objects.all()) \
+            .in_bulk(experiment_pks)
     else:
         experiments = {}
 
@@ -1886,13 +1771,16 @@ def retrieve_group_list(request):
 
 def retrieve_field_list(request):
 
-    from tardis.tardis_portal.search_indexes import DatasetFileIndex
+    from haystack import site
 
-    # Get all of the fields in the indexes
+    # Get all of the fields in the indexes, including those for any
+    # parameters made searchable since they were loaded
     #
     # TODO: these should be onl read from registered indexes
     #
-    allFields = DatasetFileIndex.fields.items()
+    index = site.get_index(Dataset_File)
+    index.refresh_fields()
+    allFields = index.fields.items()
 
     users = User.objects.all()
 
@@ -2505,13 +2393,7 @@ def remove_experiment_access_group(request, experiment_id, group_id):
     return HttpResponse('')
 
 def stats(request):
-    # using count() is more efficient than using len() on a query set
-    c = Context({
-        'experiment_count': Experiment.objects.all().count(),
-        'dataset_count': Dataset.objects.all().count(),
-        'datafile_count': Dataset_File.objects.all().count(),
-        'datafile_size': Dataset_File.sum_sizes(Dataset_File.objects.all()),
-    })
+    c = Context(get_site_stats())
     return HttpResponse(render_response_index(request,
                         'tardis_portal/stats.html', c))
 
@@ -2967,7 +2849,8 @@ class ExperimentSearchView(SearchView):
         access_list.extend([e.pk for e in Experiment.objects.exclude(public_access=Experiment.PUBLIC_ACCESS_NONE)])
 
         ids = list(set(experiment_ids) & set(access_list))
-        experiments = Experiment.objects.filter(pk__in=ids).order_by('-update_time')
+        experiments = with_experiment_counts(
+            Experiment.objects.filter(pk__in=ids).order_by('-update_time'))
 
         results = []
         for e in experiments:
@@ -35,6 +35,12 @@ STAGING_PATH = path.abspath(path.join(path.dirname(__file__),
                                       "../var/test/staging/"))
 SYNC_TEMP_PATH = path.abspath(path.join(path.dirname(__file__),
                                         '../var/test/sync/'))
+IIIF_CACHE_DIR = path.abspath(path.join(path.dirname(__file__),
+                                        '../var/test/iiif_cache/'))
+# Tests that want background rendering turn it on themselves
+IIIF_PREGENERATED_RENDERS = []
+IIIF_TILING_THRESHOLD = 4096
+IIIF_TILE_SIZE = 512
 SYNC_LOCATION = "sync"
 SYNC_LOCATION_URL = "http://example.com/sync"
 
@@ -172,6 +178,8 @@ INITIAL_LOCATIONS = [{'name': DEFAULT_LOCATION,
 ]
 
 DEFAULT_MIGRATION_DESTINATION = 'test'
+# Migrate in the test's thread, as worker threads can't see its transaction
+MIGRATION_WORKERS = 0
 DEFAULT_ARCHIVE_LOCATION = 'archtest'
 DEFAULT_EXPERIMENT_URL_BASE = 'http://mytardis.example.com/experiments'
 